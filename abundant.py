@@ -11,6 +11,7 @@ from master_config import MasterConfigAgent
 from archive import create_archive, ArchiveAgent
 from log import ABUNDANT_LOGGER
 from hash import VALID_ALGORITHMS
+from pool import ObjectPoolAgent
 
 __author__ = 'Kevin'
 
@@ -19,28 +20,37 @@ class AbundantAgent:
     """Abundant provides a universal interface for backup operations."""
 
     def __init__(self):
-        """Create the abundant."""
-        self.master_config = MasterConfigAgent()
-
-    def create_archive(self, source_dir: str, archive_dir: str, algorithm: str, max_number_of_versions: int):
-        """Create an archive."""
+        """Create the abundant, which touches no config until it is used."""
+        self._master_config = None
+
+    @property
+    def master_config(self) -> MasterConfigAgent:
+        """Get the master config agent."""
+        if self._master_config is None:
+            self._master_config = MasterConfigAgent()
+        return self._master_config
+
+    def create_archive(self, source_dir: str, archive_dir: str, algorithm: str, max_number_of_versions: int,
+                       storage_config=None):
+        """Create an archive.
+        Version data goes to the archive directory unless a storage backend config is given."""
         # validity check
         if not os.path.exists(source_dir):
-            ABUNDANT_LOGGER.error('Source directory does not exist: %s' % source_dir)
+            ABUNDANT_LOGGER.error('Source directory does not exist: %s', source_dir)
             raise FileNotFoundError('Source directory does not exist: %s' % source_dir)
         if not os.path.exists(archive_dir):
-            ABUNDANT_LOGGER.error('Archive directory does not exist: %s' % archive_dir)
+            ABUNDANT_LOGGER.error('Archive directory does not exist: %s', archive_dir)
             raise FileNotFoundError('Archive directory does not exist: %s' % archive_dir)
         if self.master_config.get_archive_record(archive_dir=archive_dir):
-            ABUNDANT_LOGGER.error('Archive directory has already been used: %s' % archive_dir)
+            ABUNDANT_LOGGER.error('Archive directory has already been used: %s', archive_dir)
             raise FileNotFoundError('Archive directory has already been used: %s' % archive_dir)
         algorithm = algorithm.lower()
         if algorithm not in VALID_ALGORITHMS:
-            ABUNDANT_LOGGER.error('Invalid hash algorithm: %s' % algorithm)
+            ABUNDANT_LOGGER.error('Invalid hash algorithm: %s', algorithm)
             raise NotImplementedError('Requested algorithm is either invalid or has not been implemented yet: %s'
                                       % algorithm)
         if max_number_of_versions < 0:
-            ABUNDANT_LOGGER.error('At least one version should be kept: %s' % max_number_of_versions)
+            ABUNDANT_LOGGER.error('At least one version should be kept: %s', max_number_of_versions)
             raise ValueError('At least one version should be kept: %s' % max_number_of_versions)
 
         # create archive record
@@ -48,8 +58,8 @@ class AbundantAgent:
 
         # create archive
         try:
-            archive = create_archive(new_archive_record, algorithm, max_number_of_versions)
-        except OSError as e:
+            archive = create_archive(new_archive_record, algorithm, max_number_of_versions, storage_config)
+        except (OSError, ValueError, NotImplementedError) as e:
             # delete the archive record previously created
             self.master_config.remove_archive_record(uuid=new_archive_record['UUID'])
             ABUNDANT_LOGGER.debug('Archive record added removed')
@@ -58,7 +68,7 @@ class AbundantAgent:
 
         # create base version
         archive.create_base()
-        ABUNDANT_LOGGER.info('Created archive %s' % archive.uuid)
+        ABUNDANT_LOGGER.info('Created archive %s', archive.uuid)
         return archive
 
     def get_archive(self, uuid=None, source_dir=None, archive_dir=None) -> ArchiveAgent:
@@ -76,6 +86,19 @@ class AbundantAgent:
         """Get all available archives."""
         return self.master_config['ArchiveRecords']
 
+    def set_object_pool(self, pool_dir):
+        """Share identical files of archives through an object pool in a directory, or stop with None.
+        Files already stored stay where they are and later ones are linked."""
+        if pool_dir is not None and not os.path.isdir(pool_dir):
+            ABUNDANT_LOGGER.error('Object pool directory does not exist: %s', pool_dir)
+            raise FileNotFoundError('Object pool directory does not exist: %s' % pool_dir)
+        self.master_config['SharedObjectPool'] = os.path.abspath(pool_dir) if pool_dir is not None else ''
+
+    def get_object_pool(self) -> ObjectPoolAgent:
+        """Get the shared object pool, None if there is none."""
+        pool_dir = self.master_config.get('SharedObjectPool')
+        return ObjectPoolAgent(pool_dir) if pool_dir else None
+
     def remove_archive(self, uuid=None, source_dir=None, archive_dir=None):
         """Remove an archive."""
         archive = self.get_archive(uuid, source_dir, archive_dir)
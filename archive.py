@@ -8,8 +8,22 @@ Archive agent.
 import os
 import json
 import shutil
-
-from version import VersionAgent, create_version, get_versions
+import contextlib
+import concurrent.futures
+
+from version import VersionAgent, create_version, get_versions, VERSION_CONFIG_TEMPLATE
+from config import get_config, create_config
+from throttle import ThrottleAgent, THROTTLE_CONFIG_TEMPLATE
+from pool import open_object_pool
+from space import summarise_space
+from merkle import DirectoryCover, ROOT_DIRECTORY, build_directory_digests, get_common_directories, \
+    get_equal_directories
+from storage import StorageBackend, create_storage_backend, transfer_object, STORAGE_CONFIG_TEMPLATE
+from verify import verify_archive
+from estimate import estimate_next_version, DEFAULT_TOP_DIRECTORIES
+from metrics import MetricsAgent, MetricsHistoryAgent
+from profiling import ProfileAgent
+from progress import check_cancellation
 from log import ABUNDANT_LOGGER
 
 __author__ = 'Kevin'
@@ -19,6 +33,11 @@ ARCHIVE_CONFIG_TEMPLATE = {
     'SourceDirectory': '',
     'HashAlgorithm': '',
     'MaxNumberOfVersions': 1,
+    'MaxArchiveBytes': 0,
+    'BackupInterval': 24 * 60 * 60,
+    'Throttle': THROTTLE_CONFIG_TEMPLATE,
+    'StorageBackend': STORAGE_CONFIG_TEMPLATE,
+    'MetricsTextfile': '',
     'UUID': ''
 }
 
@@ -31,9 +50,25 @@ class ArchiveAgent:
         self.archive_dir = archive_dir
         self.archive_config_path = os.path.join(self.archive_dir, 'meta', 'archive_config.json')
         self.on_creation_pardon = on_creation_pardon
-        self.versions = []
+        self._versions = None
+        self._throttle = None
+        self._storage = None
+        self._metrics = None
+        self._profiles = None
+        self._object_pool = None
         self.load_config()
-        self.load_versions()
+
+    @property
+    def versions(self) -> list:
+        """Get all versions from oldest to latest, loading them on first use."""
+        if self._versions is None:
+            self.load_versions()
+        return self._versions
+
+    @versions.setter
+    def versions(self, versions: list):
+        """Replace the loaded versions."""
+        self._versions = versions
 
     def load_versions(self):
         """Load all versions in this archive."""
@@ -46,18 +81,24 @@ class ArchiveAgent:
             assert self.validate_versions(), 'Fatal internal error: either more than one base version' \
                                              'is found or sorting function is not working'
         number_of_versions = len(self.versions)
-        ABUNDANT_LOGGER.debug('Found %s version%s' % (number_of_versions, 's' if number_of_versions > 1 else ''))
+        ABUNDANT_LOGGER.debug('Found %s version%s', number_of_versions, 's' if number_of_versions > 1 else '')
 
     def load_config(self):
         """Load archive configurations."""
         if not os.path.exists(self.archive_config_path):
-            ABUNDANT_LOGGER.error('Archive config not found at %s' % self.archive_config_path)
+            ABUNDANT_LOGGER.error('Archive config not found at %s', self.archive_config_path)
             raise FileNotFoundError('Archive config not found at %s' % self.archive_config_path)
 
         with open(self.archive_config_path, mode='r', encoding='utf-8') as raw_archive_config:
             self.archive_config = json.load(raw_archive_config)
         ABUNDANT_LOGGER.debug('Loaded archive config')
 
+    def save_config(self):
+        """Save archive configurations."""
+        with open(self.archive_config_path, mode='w', encoding='utf-8') as raw_archive_config:
+            json.dump(self.archive_config, raw_archive_config)
+        ABUNDANT_LOGGER.debug('Saved archive config')
+
     def validate_versions(self):
         """Validate versions."""
         # make sure only one base version exists
@@ -114,6 +155,119 @@ class ArchiveAgent:
     def max_number_of_versions(self):
         return self.archive_config['MaxNumberOfVersions']
 
+    @property
+    def max_archive_bytes(self) -> int:
+        """Get the number of bytes the versions of this archive may store, zero if unlimited."""
+        return self.archive_config.get('MaxArchiveBytes', ARCHIVE_CONFIG_TEMPLATE['MaxArchiveBytes'])
+
+    @max_archive_bytes.setter
+    def max_archive_bytes(self, max_archive_bytes: int):
+        """Set the number of bytes the versions of this archive may store, zero for unlimited."""
+        if max_archive_bytes < 0:
+            ABUNDANT_LOGGER.error('Archive quota cannot be negative: %s', max_archive_bytes)
+            raise ValueError('Archive quota cannot be negative: %s' % max_archive_bytes)
+        self.archive_config['MaxArchiveBytes'] = max_archive_bytes
+        self.save_config()
+        ABUNDANT_LOGGER.info('Archive %s may now store %s byte(s)', self.uuid, max_archive_bytes or 'unlimited')
+
+    @property
+    def space(self) -> dict:
+        """Summarise the space of this archive from the counts kept by its versions."""
+        return summarise_space([version.space for version in self.versions], self.max_archive_bytes)
+
+    @property
+    def backup_interval(self) -> float:
+        """Get the number of seconds between two scheduled versions."""
+        return self.archive_config.get('BackupInterval', ARCHIVE_CONFIG_TEMPLATE['BackupInterval'])
+
+    @backup_interval.setter
+    def backup_interval(self, backup_interval: float):
+        """Set the number of seconds between two scheduled versions."""
+        if backup_interval <= 0:
+            ABUNDANT_LOGGER.error('Backup interval must be positive: %s', backup_interval)
+            raise ValueError('Backup interval must be positive: %s' % backup_interval)
+        self.archive_config['BackupInterval'] = backup_interval
+        self.save_config()
+        ABUNDANT_LOGGER.info('Backup interval of archive %s is now %s second(s)', self.uuid, backup_interval)
+
+    @property
+    def storage(self) -> StorageBackend:
+        """Get the storage backend holding version data of this archive."""
+        if self._storage is None:
+            self._storage = create_storage_backend(self.archive_config.get('StorageBackend'), self.archive_dir)
+        return self._storage
+
+    @property
+    def throttle(self) -> ThrottleAgent:
+        """Get the throttle shared by all I/O of this archive, None if it is unlimited."""
+        if self._throttle is None:
+            self._throttle = ThrottleAgent(self.archive_config.get('Throttle'))
+        return None if self._throttle.is_unlimited else self._throttle
+
+    @property
+    def metrics(self) -> MetricsAgent:
+        """Get the metrics agent shared by all operations of this archive."""
+        if self._metrics is None:
+            self._metrics = MetricsAgent(self.uuid)
+        return self._metrics
+
+    @property
+    def object_pool(self):
+        """Get the shared object pool this archive links identical files to, None if it does not use one.
+        :rtype: ObjectPoolAgent"""
+        if self._object_pool is None:
+            self._object_pool = open_object_pool(self) or False
+        return self._object_pool or None
+
+    @property
+    def profiles(self) -> ProfileAgent:
+        """Get the agent profiling operations of this archive when profiling is on."""
+        if self._profiles is None:
+            self._profiles = ProfileAgent(self.archive_dir)
+        return self._profiles
+
+    @contextlib.contextmanager
+    def record_run(self, operation: str, version_uuid: str = ''):
+        """Record metrics of the enclosed operation and save its summary into meta.
+        Operations run inside another one count towards the outer run.
+        The outer run is also profiled if profiling is on."""
+        if self.metrics.is_active:
+            yield self.metrics
+            return
+        self.metrics.start(operation, version_uuid)
+        succeeded = False
+        try:
+            with self.profiles.profile(operation, self.uuid):
+                yield self.metrics
+            succeeded = True
+        finally:
+            run = self.metrics.finish(succeeded)
+            metrics_history = MetricsHistoryAgent(self.archive_dir)
+            metrics_history.add_run(run)
+            if self.archive_config.get('MetricsTextfile'):
+                metrics_history.write_prometheus_textfile(self.archive_config['MetricsTextfile'])
+            ABUNDANT_LOGGER.info('Finished %s in %.2fs: %s file(s) scanned, %s hashed, %s skipped, %s copied, '
+                                 '%s deleted, %s byte(s) read, %s byte(s) written', operation, run['Seconds'],
+                                 run['FilesScanned'], run['FilesHashed'], run['FilesSkipped'], run['FilesCopied'],
+                                 run['FilesDeleted'], run['BytesRead'], run['BytesWritten'])
+
+    def set_throttle(self, bytes_per_second=0, files_per_second=0, windows=None):
+        """Set the I/O limits of this archive, zero meaning unlimited.
+        Each window is a dict with From, To, BytesPerSecond and FilesPerSecond."""
+        throttle_config = {
+            'BytesPerSecond': bytes_per_second,
+            'FilesPerSecond': files_per_second,
+            'Windows': list(windows or [])
+        }
+        throttle = ThrottleAgent(throttle_config)
+        self.archive_config['Throttle'] = throttle_config
+        self.save_config()
+        self._throttle = throttle
+        for version in self.versions:
+            version.hasher.throttle = self.throttle
+        ABUNDANT_LOGGER.info('Throttle of archive %s is now %s byte(s)/s and %s file(s)/s with %s window(s)',
+                             self.uuid, bytes_per_second, files_per_second, len(throttle_config['Windows']))
+
     @property
     def base_version(self) -> VersionAgent:
         """Get the base version in this archive."""
@@ -129,62 +283,313 @@ class ArchiveAgent:
         """Get the last version in this archive."""
         return self.versions[-1]
 
-    def create_base(self) -> VersionAgent:
-        """Create the base version."""
-        if self.base_version is None:
-            create_version(True, self)
-        else:
-            ABUNDANT_LOGGER.warning('Cannot create duplicate base versions')
-        self.load_versions()
-        return self.base_version
-
-    def create_version(self) -> VersionAgent:
-        """Add a new version."""
-        if self.max_number_of_versions == 1:
-            self.base_version.remove()
-            self.create_base()
-        else:
-            while len(self.versions) >= self.max_number_of_versions:
-                self.migrate_oldest_version_to_base()
+    def get_version_at(self, timestamp: float) -> VersionAgent:
+        """Get the version effective at a point in time, that is the latest one created before it."""
+        version_at = None
+        for version in self.versions:
+            if version.time_of_creation > timestamp:
+                break
+            version_at = version
+        return version_at
+
+    def restore(self, pattern: str, destination_dir: str, version_uuid=None, timestamp=None) -> int:
+        """Restore files matching a relative path or a glob from a version, or from the version
+        effective at a point in time, into destination directory."""
+        if (version_uuid is None) == (timestamp is None):
+            ABUNDANT_LOGGER.warning('Must provide either a version or a timestamp')
+            raise ValueError('Must provide either a version or a timestamp')
+        version = self.get_version(version_uuid) if version_uuid is not None else self.get_version_at(timestamp)
+        if version is None:
+            ABUNDANT_LOGGER.error('No version found for %s', version_uuid or timestamp)
+            raise FileNotFoundError('No version found for %s' % (version_uuid or timestamp))
+        with self.profiles.profile('restore', self.uuid):
+            return version.restore(pattern, destination_dir)
+
+    def create_base(self, progress=None, cancellation=None) -> VersionAgent:
+        """Create the base version.
+        A cancelled copy removes the partial version, leaving the archive as it was.
+        :type progress: ProgressReporter
+        :type cancellation: CancellationToken"""
+        with self.record_run('create_base'):
             if self.base_version is None:
-                ABUNDANT_LOGGER.warning('Cannot create non-base versions without a base version')
+                create_version(True, self, progress, cancellation)
             else:
-                create_version(False, self)
-        self.load_versions()
-        return self.versions[-1]
-
-    def migrate_oldest_version_to_base(self):
+                ABUNDANT_LOGGER.warning('Cannot create duplicate base versions')
+            self.load_versions()
+            return self.base_version
+
+    def create_version(self, progress=None, cancellation=None) -> VersionAgent:
+        """Add a new version.
+        Cancellation stops between migrations or during the copy, which removes the partial version.
+        :type progress: ProgressReporter
+        :type cancellation: CancellationToken"""
+        with self.record_run('create_version'):
+            if self.max_number_of_versions == 1:
+                check_cancellation(cancellation)
+                self.base_version.remove()
+                # the only version is gone, so the new one has to be completed
+                self.create_base(progress)
+            else:
+                while len(self.versions) >= self.max_number_of_versions:
+                    check_cancellation(cancellation)
+                    self.migrate_oldest_version_to_base(progress)
+                if self.base_version is None:
+                    ABUNDANT_LOGGER.warning('Cannot create non-base versions without a base version')
+                else:
+                    create_version(False, self, progress, cancellation)
+                    self.load_versions()
+                    self.enforce_byte_quota(progress, cancellation)
+            self.load_versions()
+            return self.versions[-1]
+
+    def enforce_byte_quota(self, progress=None, cancellation=None) -> int:
+        """Migrate the oldest versions to the base while the archive stores more than its quota, keeping at
+        least the latest version, and return the number of migrations.
+        Cancellation stops between two migrations, every finished one being kept.
+        :type progress: ProgressReporter
+        :type cancellation: CancellationToken"""
+        max_archive_bytes = self.max_archive_bytes
+        number_of_migrations = 0
+        if not max_archive_bytes:
+            return number_of_migrations
+        stored_bytes = self.space['StoredBytes']
+        while stored_bytes > max_archive_bytes and len(self.versions) > 1:
+            check_cancellation(cancellation)
+            self.migrate_oldest_version_to_base(progress)
+            number_of_migrations += 1
+            stored_bytes = self.space['StoredBytes']
+        if stored_bytes > max_archive_bytes:
+            ABUNDANT_LOGGER.warning('Archive %s stores %s byte(s) in its only version, over its quota of %s',
+                                    self.uuid, stored_bytes, max_archive_bytes)
+        elif number_of_migrations:
+            ABUNDANT_LOGGER.info('Migrated %s version(s) to keep archive %s under %s byte(s)', number_of_migrations,
+                                 self.uuid, max_archive_bytes)
+        return number_of_migrations
+
+    def _start_migration_progress(self, progress, number_of_migrations: int):
+        """Start reporting migrations, estimating that every one handles what the base holds now.
+        :type progress: ProgressReporter"""
+        if progress is None:
+            return
+        base_records = self.base_version.manifest_records
+        base_files = list(self.base_version.exact_files)
+        total_bytes = sum(base_records[relative_path]['Size'] for relative_path, _ in base_files
+                          if relative_path in base_records)
+        progress.start('migrate', len(base_files) * number_of_migrations, total_bytes * number_of_migrations)
+
+    def migrate_oldest_version_to_base(self, progress=None):
         """Migrate the oldest version to the base version.
-        But underneath it migrate the base version to the oldest version."""
+        But underneath it migrate the base version to the oldest version.
+        :type progress: ProgressReporter"""
         assert self.base_version == self.versions[0]
         if not self.versions:
             ABUNDANT_LOGGER.warning('No base version found')
         elif len(self.versions) == 1:
             ABUNDANT_LOGGER.warning('Cannot migrate when only base version exists')
         else:
-            self.base_version.migrate_to_next_version()
-            self.load_versions()
-
-    def migrate_all_versions_to_base(self):
-        """Migrate all versions to the base."""
+            with self.record_run('migrate', self.versions[1].uuid):
+                self._start_migration_progress(progress, 1)
+                self.base_version.migrate_to_next_version(progress)
+                self.load_versions()
+                if progress is not None:
+                    progress.finish()
+
+    def migrate_all_versions_to_base(self, progress=None, cancellation=None):
+        """Migrate all versions to the base.
+        Cancellation stops between two migrations, every finished one being kept.
+        :type progress: ProgressReporter
+        :type cancellation: CancellationToken"""
         assert self.base_version == self.versions[0]
-        while len(self.versions) > 1:
-            self.base_version.migrate_to_next_version()
-            self.load_versions()
+        with self.record_run('migrate', self.last_version.uuid):
+            self._start_migration_progress(progress, len(self.versions) - 1)
+            while len(self.versions) > 1:
+                check_cancellation(cancellation)
+                self.base_version.migrate_to_next_version(progress)
+                self.load_versions()
+            if progress is not None:
+                progress.finish()
+
+    @property
+    def version_config_path(self) -> str:
+        """Get the path of the version config."""
+        return os.path.join(self.archive_dir, 'meta', 'version_config.json')
+
+    def replicate(self, replica_dir: str, max_workers: int = 8) -> 'ArchiveAgent':
+        """Bring a replica of this archive in another directory up to date.
+        Migrations and removals done here are replayed on the replica as metadata moves,
+        then only missing or differing files are transferred."""
+        with self.profiles.profile('replicate', self.uuid):
+            return self._replicate(replica_dir, max_workers)
+
+    def _replicate(self, replica_dir: str, max_workers: int) -> 'ArchiveAgent':
+        """Replicate without profiling."""
+        replica = self._open_replica(replica_dir)
+        ABUNDANT_LOGGER.info('Replicating archive %s to %s', self.uuid, replica_dir)
+
+        # add records of versions the replica has never seen so
+        # that migrations can move files into them
+        source_uuids = [version.uuid for version in self.versions]
+        with get_config(replica.version_config_path, save_change=True) as replica_version_config:
+            replica_uuids = [record['UUID'] for record in replica_version_config['VersionRecords']]
+            new_uuids = [uuid for uuid in source_uuids if uuid not in replica_uuids]
+            for version in self.versions:
+                if version.uuid in new_uuids:
+                    record = dict(version.version_config)
+                    record['IsBaseVersion'] = record['IsBaseVersion'] and not replica_uuids
+                    replica_version_config['VersionRecords'].append(record)
+        for uuid in new_uuids:
+            replica.storage.create_prefix(uuid + '/')
+        replica.on_creation_pardon = True
+        replica.load_versions()
+
+        # replay migrations and removals
+        migrated_into = set()
+        source_base_version = self.base_version
+        for version in list(replica.versions):
+            if version.uuid in source_uuids:
+                continue
+            if version < source_base_version and version.next_version is not None:
+                migrated_into.add(version.next_version.uuid)
+                version.migrate_to_next_version()
+            else:
+                version.remove(base_version_pardon=True)
+        ABUNDANT_LOGGER.debug('Replayed %s migration(s) on replica', len(migrated_into))
+
+        # transfer missing and differing files of every version in parallel
+        # and check content where migrated files may be stale,
+        # skipping subtrees whose stored files have the same digest on both sides
+        number_of_file_transferred = number_of_file_removed = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for version in self.versions:
+                replica_version = replica.get_version(version.uuid)
+                replica_prefixes = set(replica.storage.list_prefixes(version.uuid + '/'))
+                for prefix in self.storage.list_prefixes(version.uuid + '/'):
+                    if prefix not in replica_prefixes:
+                        replica.storage.create_prefix(prefix)
+                compare_content = version.uuid in migrated_into and version.uuid in new_uuids
+                # the saved tree of the replica is a copy of the source one, blind to replica files lost or
+                # truncated since, so subtrees are only skipped where the listed sizes agree on both sides too
+                source_sizes = dict(self.storage.list_sizes(version.uuid + '/'))
+                replica_sizes = dict(replica.storage.list_sizes(version.uuid + '/'))
+                equal_directories = DirectoryCover(set() if compare_content else get_common_directories(
+                    get_equal_directories(version.merkle_tree['Stored'], replica_version.merkle_tree['Stored']),
+                    get_equal_directories(self._build_size_tree(version, source_sizes),
+                                          self._build_size_tree(version, replica_sizes))))
+                replica_version.path_filter_agent.remove()
+                replica_version.merkle_tree_agent.remove()
+                if equal_directories.covers_directory(ROOT_DIRECTORY):
+                    continue
+                replica_keys = {key for key in replica_sizes
+                                if not equal_directories.covers(version._get_relative_path_of_key(key))}
+                pending = []
+                for key, size in source_sizes.items():
+                    if equal_directories.covers(version._get_relative_path_of_key(key)):
+                        continue
+                    if key in replica_keys:
+                        replica_keys.remove(key)
+                        if size == replica_sizes[key] and not (
+                                compare_content and self._hash_key(key) != replica_version._hash_file(
+                                    replica_version._get_relative_path_of_key(key))):
+                            continue
+                    pending.append(executor.submit(transfer_object, self.storage, key, replica.storage,
+                                                   throttle=self.throttle))
+                for key in replica_keys:
+                    replica.storage.delete(key)
+                    number_of_file_removed += 1
+                for future in pending:
+                    future.result()
+                    number_of_file_transferred += 1
+
+        # finally mirror version records and manifests so base flags, times and digests match
+        with get_config(self.version_config_path) as version_config:
+            with get_config(replica.version_config_path, save_change=True) as replica_version_config:
+                replica_version_config['VersionRecords'] = version_config['VersionRecords']
+        replica.load_versions()
+        for version in self.versions:
+            replica_version = replica.get_version(version.uuid)
+            replica_version.manifest.save(version.manifest_records)
+            # both now store the same files
+            if version.path_filter is not None:
+                replica_version.path_filter_agent.save(version.path_filter)
+            if version.merkle_tree_agent.exists:
+                replica_version.merkle_tree_agent.save(version.merkle_tree)
+        ABUNDANT_LOGGER.info('Replicated archive %s: transferred %s file(s), removed %s file(s)', self.uuid,
+                             number_of_file_transferred, number_of_file_removed)
+        return replica
+
+    def verify(self, max_seconds=None, max_bytes=None, max_workers: int = 4) -> dict:
+        """Check stored files against their digests, least recently verified first.
+        Without a budget every file is verified."""
+        with self.profiles.profile('verify', self.uuid):
+            return verify_archive(self, max_seconds, max_bytes, max_workers)
+
+    def estimate(self, hash_uncertain=False, top_directories: int = DEFAULT_TOP_DIRECTORIES) -> dict:
+        """Dry run of create_version: predict files, bytes and duration of the next version
+        from stat data, recorded digests and past throughput, copying nothing."""
+        with self.profiles.profile('estimate', self.uuid):
+            return estimate_next_version(self, hash_uncertain, top_directories)
+
+    @staticmethod
+    def _build_size_tree(version: VersionAgent, sizes: dict) -> dict:
+        """Build directory digests of the stored files of a version from their listed sizes, keyed by storage key."""
+        return build_directory_digests(sorted((version._get_relative_path_of_key(key), '@%s' % size)
+                                              for key, size in sizes.items()))
+
+    def _hash_key(self, key: str) -> str:
+        """Hash an object of this archive."""
+        with self.storage.open(key) as file:
+            return self.base_version.hasher.hash_file(file)
+
+    def _open_replica(self, replica_dir: str) -> 'ArchiveAgent':
+        """Open the replica in a directory, creating an empty one if needed."""
+        if not os.path.exists(replica_dir):
+            ABUNDANT_LOGGER.error('Replica directory does not exist: %s', replica_dir)
+            raise FileNotFoundError('Replica directory does not exist: %s' % replica_dir)
+        if os.path.abspath(replica_dir) == os.path.abspath(self.archive_dir):
+            ABUNDANT_LOGGER.error('Cannot replicate an archive onto itself')
+            raise ValueError('Cannot replicate an archive onto itself')
+
+        replica_config_path = os.path.join(replica_dir, 'meta', 'archive_config.json')
+        if not os.path.exists(replica_config_path):
+            os.makedirs(os.path.join(replica_dir, 'archive'), exist_ok=True)
+            os.makedirs(os.path.join(replica_dir, 'meta'), exist_ok=True)
+            replica_config = dict(self.archive_config)
+            replica_config['StorageBackend'] = STORAGE_CONFIG_TEMPLATE
+            create_config(replica_config, replica_config_path)
+            create_config(VERSION_CONFIG_TEMPLATE, os.path.join(replica_dir, 'meta', 'version_config.json'))
+            ABUNDANT_LOGGER.info('Created replica of archive %s at %s', self.uuid, replica_dir)
+
+        replica = ArchiveAgent(replica_dir, on_creation_pardon=True)
+        if replica.uuid != self.uuid:
+            ABUNDANT_LOGGER.error('%s holds archive %s rather than a replica of %s', replica_dir, replica.uuid,
+                                  self.uuid)
+            raise ValueError('%s holds archive %s rather than a replica of %s' % (replica_dir, replica.uuid, self.uuid))
+        return replica
 
     def remove(self):
-        """Remove the archive."""
+        """Remove the archive, then the shared objects only it referred to."""
+        object_pool = self.object_pool
+        digests = [record['Digest'] for version in self.versions for record in version.manifest.records] \
+            if object_pool is not None else []
+        self.storage.delete_prefix('')
+        self.storage.close()
         shutil.rmtree(self.archive_dir)
+        if object_pool is not None:
+            object_pool.release(self.algorithm, digests)
 
 
-def create_archive(archive_record: dict, algorithm: str, max_number_of_versions: int) -> ArchiveAgent:
+def create_archive(archive_record: dict, algorithm: str, max_number_of_versions: int,
+                   storage_config=None) -> ArchiveAgent:
     """Create an archive according to the archive record.
     No validity check will be performed."""
     source_dir, archive_dir = archive_record['SourceDirectory'], archive_record['ArchiveDirectory']
     uuid = archive_record['UUID']
     archive_content_dir = os.path.join(archive_dir, 'archive')
     archive_meta_dir = os.path.join(archive_dir, 'meta')
-    ABUNDANT_LOGGER.debug('Creating archive: %s' % uuid)
+    ABUNDANT_LOGGER.debug('Creating archive: %s', uuid)
+
+    # make sure the storage backend can be built before touching anything
+    create_storage_backend(storage_config, archive_dir).close()
 
     try:
         # create archive and meta directories
@@ -197,18 +602,18 @@ def create_archive(archive_record: dict, algorithm: str, max_number_of_versions:
             'HashAlgorithm': algorithm,
             'SourceDirectory': source_dir,
             'MaxNumberOfVersions': max_number_of_versions,
+            'StorageBackend': storage_config or STORAGE_CONFIG_TEMPLATE,
             'UUID': uuid
         })
         with open(os.path.join(archive_meta_dir, 'archive_config.json'), mode='w', encoding='utf-8') \
                 as raw_archive_config:
             json.dump(archive_config, raw_archive_config)
-        ABUNDANT_LOGGER.debug('Created archive config: %s' % uuid)
+        ABUNDANT_LOGGER.debug('Created archive config: %s', uuid)
 
     except OSError as e:
         # OSError on file operations usually indicates insufficient privilege or
         # incorrect configurations
-        ABUNDANT_LOGGER.error('Cannot create archive %s, possibly caused by insufficient privilege' %
-                              uuid)
+        ABUNDANT_LOGGER.error('Cannot create archive %s, possibly caused by insufficient privilege', uuid)
 
         # undo previous change
         if os.path.exists(archive_content_dir):
@@ -220,5 +625,5 @@ def create_archive(archive_record: dict, algorithm: str, max_number_of_versions:
         # raise
         raise e
     else:
-        ABUNDANT_LOGGER.info('Created archive: %s' % uuid)
+        ABUNDANT_LOGGER.info('Created archive: %s', uuid)
         return ArchiveAgent(archive_dir, on_creation_pardon=True)
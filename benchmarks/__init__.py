@@ -0,0 +1,8 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Benchmarks for abundant, each runnable with python -m benchmarks.<name> from the package directory.
+"""
+
+__author__ = 'Kevin'
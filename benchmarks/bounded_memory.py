@@ -0,0 +1,117 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Benchmark of memory use as the number of files grows, with and without a memory ceiling.
+Every file count and ceiling runs in a fresh interpreter so peak RSS is its own, the growth of the peak RSS
+over each stage being reported along with the peak of traced allocations. The last stage migrates the base
+version into the next one.
+
+    python -m benchmarks.bounded_memory --files 10000 40000 160000 --ceiling 8388608
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from benchmarks.tree import TREE_PROFILE_TEMPLATE, generate_tree, apply_churn
+from benchmarks.measure import PACKAGE_DIR, get_package_environment
+
+__author__ = 'Kevin'
+
+STAGES = ['create_base', 'create_version', 'files', 'diff', 'migrate']
+
+
+def run_bounded_memory_case(source_dir: str, work_dir: str, memory_ceiling: int, seed: int) -> dict:
+    """Run every stage once in this interpreter under a memory ceiling, zero for unbounded."""
+    from log import set_std_out_logging
+    from external import set_memory_ceiling
+    from archive import create_archive
+    from benchmarks.measure import measure
+
+    set_std_out_logging(False)
+    set_memory_ceiling(memory_ceiling)
+    archive_dir = os.path.join(work_dir, 'archive')
+    os.makedirs(archive_dir)
+    archive_record = {'SourceDirectory': source_dir, 'ArchiveDirectory': archive_dir, 'UUID': str(uuid.uuid4())}
+    archive = create_archive(archive_record, 'md5', 3)
+
+    results = {}
+    with measure(trace_memory=True) as results['create_base']:
+        archive.create_base()
+    apply_churn(source_dir, 0.05, seed + 1)
+    with measure(trace_memory=True) as results['create_version']:
+        archive.create_version()
+    with measure(trace_memory=True) as results['files']:
+        results['files']['Files'] = sum(1 for _ in archive.last_version.files)
+    with measure(trace_memory=True) as results['diff']:
+        results['diff']['Changes'] = sum(1 for _ in archive.base_version.diff(archive.last_version))
+    with measure(trace_memory=True) as results['migrate']:
+        archive.base_version.migrate_to_next_version()
+    return results
+
+
+def time_bounded_memory_case(number_of_files: int, memory_ceiling: int, seed: int = 0, work_dir=None) -> dict:
+    """Generate a tree and run a case on it in a fresh interpreter."""
+    environment = get_package_environment()
+    with tempfile.TemporaryDirectory(dir=work_dir) as case_dir:
+        source_dir = os.path.join(case_dir, 'source')
+        tree = generate_tree(source_dir, dict(TREE_PROFILE_TEMPLATE, TinyFiles=number_of_files, TinyFileMaxSize=64),
+                             seed)
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.bounded_memory', '--run-case',
+                                 '--source-dir', source_dir, '--work-dir', case_dir, '--ceiling', str(memory_ceiling),
+                                 '--seed', str(seed)], cwd=PACKAGE_DIR, env=environment, stdout=subprocess.PIPE,
+                                check=True, universal_newlines=True).stdout
+    return {'Tree': tree, 'MemoryCeiling': memory_ceiling, 'Results': json.loads(output)}
+
+
+def run_bounded_memory_benchmark(file_counts: list, memory_ceiling: int, seed: int = 0, work_dir=None) -> dict:
+    """Run every file count unbounded and under the ceiling and return the comparable results."""
+    cases = []
+    for number_of_files in file_counts:
+        for ceiling in (0, memory_ceiling):
+            cases.append(time_bounded_memory_case(number_of_files, ceiling, seed, work_dir))
+            results = cases[-1]['Results']
+            peaks = {stage: results[stage]['PeakTracedBytes'] for stage in STAGES}
+            rss_growths = {stage: results[stage].get('MaxRSSGrowthKiB') for stage in STAGES}
+            print('%s file(s), ceiling %s: peak traced bytes %s, peak RSS growth KiB %s, peak RSS KiB %s' % (
+                number_of_files, ceiling or 'none', peaks, rss_growths, results[STAGES[-1]].get('MaxRSSKiB')),
+                file=sys.stderr)
+    return {
+        'Benchmark': 'bounded_memory',
+        'Time': time.time(),
+        'Python': platform.python_version(),
+        'Platform': platform.platform(),
+        'Parameters': {'Files': file_counts, 'MemoryCeiling': memory_ceiling, 'Seed': seed},
+        'Cases': cases
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark memory use against the number of files.')
+    parser.add_argument('--files', type=int, nargs='+', default=[10000, 40000, 160000], help='file counts')
+    parser.add_argument('--ceiling', type=int, default=8 * 1024 * 1024, help='memory ceiling in bytes')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated trees')
+    parser.add_argument('--work-dir', help='directory for the temporary trees and archives')
+    parser.add_argument('--output', help='JSON results file, stdout if omitted')
+    parser.add_argument('--run-case', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--source-dir', help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.run_case:
+        json.dump(run_bounded_memory_case(arguments.source_dir, arguments.work_dir, arguments.ceiling,
+                                          arguments.seed), sys.stdout)
+        sys.exit()
+    benchmark_results = run_bounded_memory_benchmark(arguments.files, arguments.ceiling, arguments.seed,
+                                                     arguments.work_dir)
+    if arguments.output:
+        with open(arguments.output, mode='w', encoding='utf-8') as output_file:
+            json.dump(benchmark_results, output_file, indent=2)
+    else:
+        json.dump(benchmark_results, sys.stdout, indent=2)
@@ -0,0 +1,57 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Comparing two operations benchmark results.
+
+    python -m benchmarks.compare baseline.json candidate.json
+"""
+
+import json
+import argparse
+
+__author__ = 'Kevin'
+
+COMPARED_METRICS = ['Seconds', 'CPUSeconds', 'CharsRead', 'CharsWritten', 'ReadSyscalls', 'WriteSyscalls',
+                    'PeakTracedBytes']
+
+
+def summarise(results: dict) -> dict:
+    """Sum every metric of every operation over its runs."""
+    return {operation: {metric: sum(run[metric] for run in runs if metric in run) for metric in COMPARED_METRICS
+                        if any(metric in run for run in runs)}
+            for operation, runs in results['Results'].items()}
+
+
+def compare_results(baseline: dict, candidate: dict) -> dict:
+    """Ratio of candidate to baseline for every metric both runs recorded."""
+    if baseline['Parameters'] != candidate['Parameters']:
+        raise ValueError('Results come from different parameters: %s and %s'
+                         % (baseline['Parameters'], candidate['Parameters']))
+    baseline_summary, candidate_summary = summarise(baseline), summarise(candidate)
+    comparison = {}
+    for operation, metrics in baseline_summary.items():
+        for metric, baseline_value in metrics.items():
+            candidate_value = candidate_summary.get(operation, {}).get(metric)
+            if candidate_value is None:
+                continue
+            comparison.setdefault(operation, {})[metric] = {
+                'Baseline': baseline_value,
+                'Candidate': candidate_value,
+                'Ratio': candidate_value / baseline_value if baseline_value else None
+            }
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two operations benchmark results.')
+    parser.add_argument('baseline', help='results of the reference run')
+    parser.add_argument('candidate', help='results of the run to judge')
+    arguments = parser.parse_args()
+    with open(arguments.baseline, mode='r', encoding='utf-8') as baseline_file, \
+            open(arguments.candidate, mode='r', encoding='utf-8') as candidate_file:
+        comparison = compare_results(json.load(baseline_file), json.load(candidate_file))
+    for operation, metrics in comparison.items():
+        for metric, values in metrics.items():
+            ratio = '%.3f' % values['Ratio'] if values['Ratio'] is not None else '-'
+            print('%-24s %-14s %14s %14s %8s' % (operation, metric, values['Baseline'], values['Candidate'], ratio))
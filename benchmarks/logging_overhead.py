@@ -0,0 +1,134 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Benchmark of the cost of per-file logging.
+The same operations run at Error level, at Debug level with sampled file events and at Debug level with every
+file event logged, each in a fresh interpreter writing to a throwaway log file.
+Modes are interleaved and repeated, overheads come from the fastest run of each mode.
+
+    python -m benchmarks.logging_overhead --profile tiny --output results.json
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from benchmarks.tree import TREE_PROFILES, generate_tree
+from benchmarks.measure import PACKAGE_DIR, get_package_environment
+
+__author__ = 'Kevin'
+
+LOGGING_MODES = ['Error', 'Debug', 'DebugEveryEvent']
+
+NUMBER_OF_EVENTS = 100000
+
+
+def run_logging_mode(mode: str, source_dir: str, work_dir: str) -> dict:
+    """Run the operations once in this interpreter with logging set up for a mode.
+    Must run in a fresh interpreter since logging is configured only once."""
+    import logging
+    import log
+    from log import configure_logging, flush_logging, set_std_out_logging, FileEventLog
+    from archive import create_archive
+    from benchmarks.measure import measure
+
+    log_path = os.path.join(work_dir, 'abundant.log')
+    set_std_out_logging(False)
+    configure_logging(logging.ERROR if mode == 'Error' else logging.DEBUG, log_path)
+    log.get_init_config()['LogEveryFileEvent'] = mode == 'DebugEveryEvent'
+
+    results = {}
+    file_events = FileEventLog()
+    start_time = time.perf_counter()
+    for i in range(NUMBER_OF_EVENTS):
+        file_events.debug('Copied %s', i)
+    results['SecondsPerEvent'] = (time.perf_counter() - start_time) / NUMBER_OF_EVENTS
+    flush_logging()
+
+    archive_dir = os.path.join(work_dir, 'archive')
+    export_dir = os.path.join(work_dir, 'export')
+    os.makedirs(archive_dir)
+    os.makedirs(export_dir)
+    archive_record = {'SourceDirectory': source_dir, 'ArchiveDirectory': archive_dir, 'UUID': str(uuid.uuid4())}
+    archive = create_archive(archive_record, 'md5', 2)
+    with measure() as result:
+        archive.create_base()
+        flush_logging()
+    results['create_base'] = result
+    with measure() as result:
+        archive.last_version.export(export_dir)
+        flush_logging()
+    results['export'] = result
+    results['LogBytes'] = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+    return results
+
+
+def time_logging_mode(mode: str, source_dir: str, work_dir=None) -> dict:
+    """Run a mode in a fresh interpreter."""
+    environment = get_package_environment()
+    with tempfile.TemporaryDirectory(dir=work_dir) as mode_dir:
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.logging_overhead', '--run-mode', mode,
+                                 '--source-dir', source_dir, '--work-dir', mode_dir], cwd=PACKAGE_DIR,
+                                env=environment, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return json.loads(output)
+
+
+def run_logging_benchmark(profile_name: str = 'tiny', seed: int = 0, repeat: int = 3, work_dir=None) -> dict:
+    """Run every logging mode on the same tree and return the comparable results.
+    Overheads are per file, relative to Error level."""
+    runs = {mode: [] for mode in LOGGING_MODES}
+    with tempfile.TemporaryDirectory(dir=work_dir) as temporary_dir:
+        source_dir = os.path.join(temporary_dir, 'source')
+        tree = generate_tree(source_dir, TREE_PROFILES[profile_name], seed)
+        for _ in range(repeat):
+            for mode in LOGGING_MODES:
+                runs[mode].append(time_logging_mode(mode, source_dir, work_dir))
+
+    fastest = {mode: {operation: min(run[operation]['Seconds'] for run in runs[mode])
+                      for operation in ('create_base', 'export')} for mode in LOGGING_MODES}
+    results = {}
+    for mode in LOGGING_MODES:
+        results[mode] = {'Runs': runs[mode], 'SecondsPerEvent': min(run['SecondsPerEvent'] for run in runs[mode])}
+        for operation in ('create_base', 'export'):
+            overhead = fastest[mode][operation] - fastest['Error'][operation]
+            results[mode][operation] = {'Seconds': fastest[mode][operation],
+                                        'OverheadPerFile': overhead / tree['Files'] if tree['Files'] else 0}
+    return {
+        'Benchmark': 'logging_overhead',
+        'Time': time.time(),
+        'Python': platform.python_version(),
+        'Platform': platform.platform(),
+        'Parameters': {'Profile': profile_name, 'Seed': seed, 'Repeat': repeat},
+        'Tree': tree,
+        'Results': results
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the cost of per-file logging.')
+    parser.add_argument('--profile', choices=sorted(TREE_PROFILES), default='tiny', help='shape of the source tree')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated tree')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every mode')
+    parser.add_argument('--work-dir', help='directory for the temporary tree and archives')
+    parser.add_argument('--output', help='JSON results file, stdout if omitted')
+    parser.add_argument('--run-mode', choices=LOGGING_MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--source-dir', help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.run_mode:
+        json.dump(run_logging_mode(arguments.run_mode, arguments.source_dir, arguments.work_dir), sys.stdout)
+        sys.exit()
+    benchmark_results = run_logging_benchmark(arguments.profile, arguments.seed, arguments.repeat,
+                                              arguments.work_dir)
+    if arguments.output:
+        with open(arguments.output, mode='w', encoding='utf-8') as output_file:
+            json.dump(benchmark_results, output_file, indent=2)
+    else:
+        json.dump(benchmark_results, sys.stdout, indent=2)
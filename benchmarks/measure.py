@@ -0,0 +1,75 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Measuring wall time, I/O, system calls and memory of an operation.
+"""
+
+import os
+import time
+import tracemalloc
+import contextlib
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+__author__ = 'Kevin'
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROC_IO_PATH = '/proc/self/io'
+
+PROC_IO_FIELDS = {
+    'rchar': 'CharsRead',
+    'wchar': 'CharsWritten',
+    'syscr': 'ReadSyscalls',
+    'syscw': 'WriteSyscalls',
+    'read_bytes': 'BytesRead',
+    'write_bytes': 'BytesWritten'
+}
+
+
+def get_package_environment() -> dict:
+    """Get the environment of this process with the package on the Python path, for benchmarks
+    running in fresh interpreters."""
+    python_paths = [PACKAGE_DIR, os.environ.get('PYTHONPATH')]
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, python_paths)))
+
+
+def read_process_io() -> dict:
+    """Read I/O counters of this process, empty where the platform does not provide them."""
+    try:
+        with open(PROC_IO_PATH, mode='r') as raw_io:
+            counters = dict(line.split(': ') for line in raw_io.read().splitlines())
+    except OSError:
+        return {}
+    return {PROC_IO_FIELDS[name]: int(value) for name, value in counters.items() if name in PROC_IO_FIELDS}
+
+
+@contextlib.contextmanager
+def measure(trace_memory=False):
+    """Measure the enclosed block into the yielded dict.
+    Tracing memory gives the peak of Python allocations in the block but slows it down.
+    The peak RSS of a process never goes down, so its growth tells what the block alone pushed it to."""
+    result = {}
+    max_rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else 0
+    if trace_memory:
+        tracemalloc.start()
+    io_before = read_process_io()
+    cpu_before = time.process_time()
+    start_time = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result['Seconds'] = time.perf_counter() - start_time
+        result['CPUSeconds'] = time.process_time() - cpu_before
+        io_after = read_process_io()
+        result.update({name: io_after[name] - io_before[name] for name in io_after})
+        if trace_memory:
+            result['PeakTracedBytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if resource is not None:
+            result['MaxRSSKiB'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            result['MaxRSSGrowthKiB'] = result['MaxRSSKiB'] - max_rss_before
@@ -0,0 +1,102 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Benchmark of the main archive operations on a synthetic source tree.
+Archives are created in a temporary directory and never recorded in the master config.
+
+    python -m benchmarks.operations --profile mixed --output results.json
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import platform
+import tempfile
+
+from benchmarks.tree import TREE_PROFILES, generate_tree, apply_churn
+from benchmarks.measure import measure
+
+__author__ = 'Kevin'
+
+OPERATIONS = ['create_base', 'create_version', 'files', 'export', 'migrate_to_next_version']
+
+
+def run_operations_benchmark(profile_name: str, versions: int = 3, churn: float = 0.05, seed: int = 0,
+                             algorithm: str = 'md5', trace_memory=False, work_dir=None) -> dict:
+    """Run every operation once per version and return the comparable results."""
+    from archive import create_archive
+
+    profile = TREE_PROFILES[profile_name]
+    results = {operation: [] for operation in OPERATIONS}
+    with tempfile.TemporaryDirectory(dir=work_dir) as temporary_dir:
+        source_dir = os.path.join(temporary_dir, 'source')
+        archive_dir = os.path.join(temporary_dir, 'archive')
+        export_dir = os.path.join(temporary_dir, 'export')
+        os.makedirs(archive_dir)
+        tree = generate_tree(source_dir, profile, seed)
+
+        archive_record = {'SourceDirectory': source_dir, 'ArchiveDirectory': archive_dir, 'UUID': str(uuid.uuid4())}
+        archive = create_archive(archive_record, algorithm, versions + 1)
+        with measure(trace_memory) as result:
+            archive.create_base()
+        results['create_base'].append(result)
+
+        for round_number in range(versions):
+            apply_churn(source_dir, churn, seed + round_number + 1)
+            with measure(trace_memory) as result:
+                archive.create_version()
+            results['create_version'].append(result)
+
+        for version in archive.versions:
+            with measure(trace_memory) as result:
+                result['Files'] = sum(1 for _ in version.files)
+            results['files'].append(result)
+
+        os.makedirs(export_dir)
+        with measure(trace_memory) as result:
+            result.update(archive.last_version.export(export_dir))
+        results['export'].append(result)
+
+        while len(archive.versions) > 1:
+            with measure(trace_memory) as result:
+                archive.migrate_oldest_version_to_base()
+            results['migrate_to_next_version'].append(result)
+        shutil.rmtree(export_dir)
+
+    return {
+        'Benchmark': 'operations',
+        'Time': time.time(),
+        'Python': platform.python_version(),
+        'Platform': platform.platform(),
+        'Parameters': {'Profile': profile_name, 'Versions': versions, 'Churn': churn, 'Seed': seed,
+                       'HashAlgorithm': algorithm, 'TraceMemory': trace_memory},
+        'Tree': tree,
+        'Results': results
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark archive operations on a synthetic tree.')
+    parser.add_argument('--profile', choices=sorted(TREE_PROFILES), default='mixed', help='shape of the source tree')
+    parser.add_argument('--versions', type=int, default=3, help='versions created after the base')
+    parser.add_argument('--churn', type=float, default=0.05, help='fraction of files modified between versions')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated tree')
+    parser.add_argument('--algorithm', default='md5', help='hash algorithm of the archive')
+    parser.add_argument('--trace-memory', action='store_true', help='record peak Python allocations')
+    parser.add_argument('--work-dir', help='directory for the temporary tree and archive')
+    parser.add_argument('--output', help='JSON results file, stdout if omitted')
+    arguments = parser.parse_args()
+
+    benchmark_results = run_operations_benchmark(arguments.profile, arguments.versions, arguments.churn,
+                                                 arguments.seed, arguments.algorithm, arguments.trace_memory,
+                                                 arguments.work_dir)
+    if arguments.output:
+        with open(arguments.output, mode='w', encoding='utf-8') as output_file:
+            json.dump(benchmark_results, output_file, indent=2)
+    else:
+        json.dump(benchmark_results, sys.stdout, indent=2)
@@ -0,0 +1,67 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Startup-time benchmark.
+Every stage runs in a fresh interpreter started from a foreign working directory.
+"""
+
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+from benchmarks.measure import get_package_environment
+
+__author__ = 'Kevin'
+
+STARTUP_STAGES = {
+    'import': 'import abundant',
+    'list': 'from abundant import Abundant\n'
+            'Abundant.get_all_archives()',
+    'open': 'from abundant import Abundant\n'
+            'for record in Abundant.get_all_archives():\n'
+            '    Abundant.get_archive(uuid=record["UUID"])',
+    'versions': 'from abundant import Abundant\n'
+                'for record in Abundant.get_all_archives():\n'
+                '    Abundant.get_archive(uuid=record["UUID"]).versions'
+}
+
+STAGE_SCRIPT = '''import time
+start_time = time.perf_counter()
+%s
+print(time.perf_counter() - start_time)
+'''
+
+
+def time_stage(stage: str, working_dir: str) -> tuple:
+    """Run a stage once, returning seconds spent in the stage and in the whole process."""
+    environment = get_package_environment()
+    start_time = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', STAGE_SCRIPT % STARTUP_STAGES[stage]], cwd=working_dir,
+                            env=environment, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return float(output.strip().splitlines()[-1]), time.perf_counter() - start_time
+
+
+def run_startup_benchmark(repeat: int = 5) -> dict:
+    """Time every stage a few times and summarise them."""
+    results = {}
+    with tempfile.TemporaryDirectory() as working_dir:
+        for stage in STARTUP_STAGES:
+            timings = [time_stage(stage, working_dir) for _ in range(repeat)]
+            results[stage] = {
+                'Seconds': statistics.median(timing[0] for timing in timings),
+                'MinSeconds': min(timing[0] for timing in timings),
+                'ProcessSeconds': statistics.median(timing[1] for timing in timings)
+            }
+    return {'Benchmark': 'startup', 'Repeat': repeat, 'Stages': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure how long abundant takes to start.')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per stage')
+    arguments = parser.parse_args()
+    print(json.dumps(run_startup_benchmark(arguments.repeat), indent=2))
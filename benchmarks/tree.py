@@ -0,0 +1,90 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Reproducible synthetic source trees for benchmarks.
+"""
+
+import os
+import random
+
+__author__ = 'Kevin'
+
+TREE_PROFILE_TEMPLATE = {
+    'TinyFiles': 0,
+    'TinyFileMaxSize': 4 * 1024,
+    'FilesPerDirectory': 64,
+    'HugeFiles': 0,
+    'HugeFileSize': 64 * 1024 * 1024,
+    'Depth': 0,
+    'FilesPerLevel': 2
+}
+
+TREE_PROFILES = {
+    'tiny': dict(TREE_PROFILE_TEMPLATE, TinyFiles=20000),
+    'huge': dict(TREE_PROFILE_TEMPLATE, HugeFiles=4),
+    'deep': dict(TREE_PROFILE_TEMPLATE, Depth=64, FilesPerLevel=4),
+    'mixed': dict(TREE_PROFILE_TEMPLATE, TinyFiles=5000, HugeFiles=2, HugeFileSize=32 * 1024 * 1024, Depth=16)
+}
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def _write_random_file(path: str, size: int, rng: random.Random):
+    """Write a file of random content, the same for the same generator state."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode='wb') as file:
+        while size > 0:
+            block_size = min(size, BLOCK_SIZE)
+            file.write(rng.randbytes(block_size))
+            size -= block_size
+
+
+def generate_tree(root_dir: str, profile: dict, seed: int = 0) -> dict:
+    """Generate a source tree under root directory, returning the number of files and bytes written."""
+    rng = random.Random(seed)
+    summary = {'Files': 0, 'Bytes': 0}
+
+    def add_file(relative_path: str, size: int):
+        _write_random_file(os.path.join(root_dir, relative_path), size, rng)
+        summary['Files'] += 1
+        summary['Bytes'] += size
+
+    for i in range(profile['TinyFiles']):
+        add_file(os.path.join('tiny', 'd%05d' % (i // profile['FilesPerDirectory']), 'f%07d.bin' % i),
+                 rng.randint(0, profile['TinyFileMaxSize']))
+    for i in range(profile['HugeFiles']):
+        add_file(os.path.join('huge', 'h%03d.bin' % i), profile['HugeFileSize'])
+    nested_dir = 'deep'
+    for level in range(profile['Depth']):
+        nested_dir = os.path.join(nested_dir, 'l%03d' % level)
+        for i in range(profile['FilesPerLevel']):
+            add_file(os.path.join(nested_dir, 'f%03d.bin' % i), rng.randint(0, profile['TinyFileMaxSize']))
+    return summary
+
+
+def apply_churn(root_dir: str, churn: float, seed: int = 0) -> dict:
+    """Modify, delete and add files under root directory.
+    Churn is the fraction of existing files modified; half as many are deleted and as many added."""
+    rng = random.Random(seed)
+    paths = sorted(os.path.join(directory, file_name)
+                   for directory, _, file_names in os.walk(root_dir) for file_name in file_names)
+    number_of_changes = int(len(paths) * churn)
+    summary = {'Modified': 0, 'Deleted': 0, 'Added': 0}
+    if not paths or not number_of_changes:
+        return summary
+
+    for path in rng.sample(paths, min(number_of_changes + number_of_changes // 2, len(paths))):
+        if summary['Modified'] < number_of_changes:
+            # rewrite the head of the file so huge files are not rewritten entirely
+            size = os.path.getsize(path)
+            with open(path, mode='r+b' if size else 'wb') as file:
+                file.write(rng.randbytes(min(max(size, 1), BLOCK_SIZE)))
+            summary['Modified'] += 1
+        else:
+            os.remove(path)
+            summary['Deleted'] += 1
+    for i in range(number_of_changes):
+        _write_random_file(os.path.join(root_dir, 'churn', 's%d' % seed, 'n%06d.bin' % i), rng.randint(0, 4096), rng)
+        summary['Added'] += 1
+    return summary
@@ -0,0 +1,129 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Bloom filters of the paths stored in each version, ruling out absent files without asking the storage.
+"""
+
+import os
+import math
+import struct
+import hashlib
+
+from log import ABUNDANT_LOGGER
+
+__author__ = 'Kevin'
+
+BLOOM_FILTER_MAGIC = b'ABF1'
+BLOOM_FILTER_HEADER = struct.Struct('<4sBQQ')
+
+FALSE_POSITIVE_RATE = 0.01
+MIN_NUMBER_OF_BITS = 64
+
+
+class BloomFilter:
+    """Set of strings that may answer yes for absent items but never no for present ones."""
+
+    def __init__(self, number_of_bits: int, number_of_hashes: int, bits=None, number_of_items: int = 0):
+        """Create an empty filter, or one over existing bits."""
+        self.number_of_bits = number_of_bits
+        self.number_of_hashes = number_of_hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray((number_of_bits + 7) // 8)
+        self.number_of_items = number_of_items
+
+    @classmethod
+    def for_capacity(cls, number_of_items: int, false_positive_rate: float = FALSE_POSITIVE_RATE) -> 'BloomFilter':
+        """Create an empty filter sized for a number of items at a false positive rate."""
+        number_of_bits = max(int(math.ceil(-number_of_items * math.log(false_positive_rate) / math.log(2) ** 2)),
+                             MIN_NUMBER_OF_BITS)
+        number_of_hashes = max(int(round(number_of_bits / max(number_of_items, 1) * math.log(2))), 1)
+        return cls(number_of_bits, min(number_of_hashes, 32))
+
+    def _get_hashes(self, item: str) -> tuple:
+        """Get the two hashes of an item that all its bit positions derive from."""
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+
+    def add(self, item: str):
+        """Add an item."""
+        first_hash, second_hash = self._get_hashes(item)
+        for i in range(self.number_of_hashes):
+            position = (first_hash + i * second_hash) % self.number_of_bits
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.number_of_items += 1
+
+    def __contains__(self, item: str) -> bool:
+        # most absent items miss on the first bit or two, so stop at the first clear one
+        first_hash, second_hash = self._get_hashes(item)
+        bits, number_of_bits = self.bits, self.number_of_bits
+        for i in range(self.number_of_hashes):
+            position = (first_hash + i * second_hash) % number_of_bits
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def to_bytes(self) -> bytes:
+        """Serialise the filter."""
+        return BLOOM_FILTER_HEADER.pack(BLOOM_FILTER_MAGIC, self.number_of_hashes, self.number_of_bits,
+                                        self.number_of_items) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'BloomFilter':
+        """Deserialise a filter, raising ValueError if the data is not one."""
+        if len(data) < BLOOM_FILTER_HEADER.size:
+            raise ValueError('Bloom filter is truncated')
+        magic, number_of_hashes, number_of_bits, number_of_items = BLOOM_FILTER_HEADER.unpack_from(data)
+        bits = data[BLOOM_FILTER_HEADER.size:]
+        if magic != BLOOM_FILTER_MAGIC or len(bits) != (number_of_bits + 7) // 8 or not number_of_hashes:
+            raise ValueError('Invalid bloom filter')
+        return cls(number_of_bits, number_of_hashes, bits, number_of_items)
+
+
+class PathFilterAgent:
+    """Bloom filter of the relative paths stored in a single version.
+    A version without one is asked about every path, so the filter is removed before files are
+    added to a version and built again afterwards."""
+
+    def __init__(self, archive_dir: str, version_uuid: str):
+        """Create the agent for a version."""
+        self.filter_dir = os.path.join(archive_dir, 'meta', 'filters')
+        self.filter_path = os.path.join(self.filter_dir, '%s.bloom' % version_uuid)
+
+    @property
+    def exists(self) -> bool:
+        """Tell if the filter has been written."""
+        return os.path.exists(self.filter_path)
+
+    def load(self):
+        """Load the filter, None if there is no valid one.
+        :rtype: BloomFilter"""
+        try:
+            with open(self.filter_path, mode='rb') as raw_filter:
+                return BloomFilter.from_bytes(raw_filter.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as error:
+            ABUNDANT_LOGGER.warning('Ignored unreadable path filter %s: %s', self.filter_path, error)
+            return None
+
+    def save(self, path_filter: BloomFilter):
+        """Replace the filter."""
+        os.makedirs(self.filter_dir, exist_ok=True)
+        temporary_path = self.filter_path + '.tmp'
+        with open(temporary_path, mode='wb') as raw_filter:
+            raw_filter.write(path_filter.to_bytes())
+        os.replace(temporary_path, self.filter_path)
+        ABUNDANT_LOGGER.debug('Saved path filter of %s path(s): %s', path_filter.number_of_items, self.filter_path)
+
+    def build(self, relative_paths, number_of_paths: int) -> BloomFilter:
+        """Build and save the filter of some slash separated relative paths."""
+        path_filter = BloomFilter.for_capacity(number_of_paths)
+        for relative_path in relative_paths:
+            path_filter.add(relative_path)
+        self.save(path_filter)
+        return path_filter
+
+    def remove(self):
+        """Delete the filter."""
+        if self.exists:
+            os.remove(self.filter_path)
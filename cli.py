@@ -5,11 +5,17 @@
 Command line interface for abundant.
 """
 
-from log import ABUNDANT_LOGGER, ABUNDANT_LOG_STD_OUT_HANDLER
+import sys
+import datetime
 
+from log import ABUNDANT_LOGGER, configure_logging, set_std_out_logging
+
+set_std_out_logging(False)
 ABUNDANT_LOGGER.info('Starting command line interface...')
-ABUNDANT_LOGGER.removeHandler(ABUNDANT_LOG_STD_OUT_HANDLER)
 from abundant import Abundant
+from export import VALID_ARCHIVE_FORMATS
+from progress import CLIProgressBar, CancellationToken, OperationCancelled, cancel_on_interrupt
+from profiling import set_profiling
 
 __author__ = 'Kevin'
 
@@ -53,6 +59,15 @@ Archive UUID: {1}
 Time of creation: {2}
 Base version: {3}'''
 
+SPACE_ARCHIVE_FORMAT = '''Quota: {0} byte(s)
+Latest version: {1} file(s), {2} byte(s)
+Stored in {3} version(s): {4} file(s), {5} byte(s)
+Freed by migrating the oldest version: {6} file(s), {7} byte(s)'''
+
+SPACE_VERSION_FORMAT = '''Files: {0}, {1} byte(s)
+Stored in this version: {2} file(s), {3} byte(s)
+Freed by migrating it: {4} file(s), {5} byte(s)'''
+
 CREATE_ARCHIVE_FORMAT = '''Creating archive:
 
 Source directory: {0}
@@ -147,6 +162,79 @@ exactly to directory:
 
 Proceed? '''
 
+EXPORT_REPORT_FORMAT = '''
+{0} file(s), {1} byte(s) in {2:.2f}s
+{3:.1f} file(s)/s, {4:.1f} byte(s)/s'''
+
+SYNC_FORMAT = '''Syncing version:
+
+UUID {0}
+Time of creation: {1}
+Base version: {2}
+
+into directory:
+
+{3}
+
+Extra files {4} be deleted
+
+Proceed? '''
+
+SYNC_REPORT_FORMAT = '''
+Checked {0} file(s), hashed {1}
+Copied {2} file(s), {3} byte(s)
+Deleted {4} file(s) in {5:.2f}s'''
+
+EXPORT_ARCHIVE_FORMAT = '''Exporting version:
+
+UUID {0}
+Time of creation: {1}
+Base version: {2}
+
+as {3} archive to:
+
+{4}
+
+Proceed? '''
+
+REPLICATE_FORMAT = '''Replicating archive:
+
+UUID: {0}
+Source directory: {1}
+Archive directory: {2}
+
+to replica directory:
+
+{3}
+
+Proceed? '''
+
+VERIFY_FORMAT = '''
+Verified: {0} file(s), {1} byte(s)
+Corrupt: {2}
+Missing: {3}
+Enrolled: {4}
+Remaining: {5}'''
+
+ESTIMATE_FORMAT = '''
+Scanned: {0} file(s), {1} byte(s)
+New: {2}, modified: {3}, uncertain: {4}, unchanged: {5}, deleted: {6}
+To copy: {7} file(s), {8} byte(s)
+Migrations first: {9}
+Predicted duration: {10}'''
+
+POOL_FORMAT = '''
+Object pool: {0}
+Objects: {1}, {2} byte(s)
+References: {3}
+Saved: {4} byte(s)'''
+
+PROFILE_FORMAT = '''
+PROFILE {0}
+Operation: {1}
+Duration: {2:.2f}s
+Peak traced memory: {3} byte(s)'''
+
 
 # noinspection PyMethodMayBeStatic
 class CLI:
@@ -168,7 +256,18 @@ class CLI:
             'remove': self.remove,
             'migrate': self.migrate,
             'export': self.export,
-            'export-exact': self.export_exact
+            'export-exact': self.export_exact,
+            'export-archive': self.export_archive,
+            'replicate': self.replicate,
+            'verify': self.verify,
+            'estimate': self.estimate,
+            'profiling': self.profiling,
+            'profiles': self.profiles,
+            'restore': self.restore,
+            'sync': self.sync,
+            'diff': self.diff,
+            'pool': self.pool,
+            'quota': self.quota
         }
 
     def loop(self):
@@ -212,6 +311,8 @@ class CLI:
             if len(commands) == 1 and verb != 'quit':
                 raise CLICommandError('Missing command parameter')
             self.VERB_TO_FUNCTION[verb](*commands[1:])
+        except OperationCancelled:
+            print('\nCancelled, archive left consistent')
         except Exception as e:
             print('Error: %s' % e)
 
@@ -309,6 +410,7 @@ class CLI:
                    self.archive_selected.archive_dir,
                    self.archive_selected.max_number_of_versions,
                    self.archive_selected.algorithm))
+            self._print_archive_space()
         elif target == 'version':
             if not self.version_selected:
                 raise CLICommandError('No version selected')
@@ -317,6 +419,18 @@ class CLI:
                    self.version_selected.archive_agent.uuid,
                    self.version_selected.time_of_creation,
                    self.version_selected.is_base_version))
+            space = self.version_selected.space
+            print(SPACE_VERSION_FORMAT.format(space['TotalFiles'], space['TotalBytes'], space['UniqueFiles'],
+                                              space['UniqueBytes'], space['ReclaimableFiles'],
+                                              space['ReclaimableBytes']))
+
+    def _print_archive_space(self):
+        """Print the space of the selected archive."""
+        space = self.archive_selected.space
+        print(SPACE_ARCHIVE_FORMAT.format(space['MaxArchiveBytes'] or 'unlimited', space['TotalFiles'],
+                                          space['TotalBytes'], space['Versions'], space['StoredFiles'],
+                                          space['StoredBytes'], space['ReclaimableFiles'],
+                                          space['ReclaimableBytes']))
 
     def create(self, target: str, *args, **kwargs):
         """Create command."""
@@ -341,7 +455,8 @@ class CLI:
             if self.archive_selected is None:
                 raise CLICommandError('No archive selected')
             if input(CREATE_VERSION_FORMAT.format(self.archive_selected)).lower() == 'y':
-                version = self.archive_selected.create_version()
+                with cancel_on_interrupt(CancellationToken()) as cancellation:
+                    version = self.archive_selected.create_version(CLIProgressBar(), cancellation)
                 print('Created version %s' % version.uuid)
 
     def remove(self, target: str, *args):
@@ -398,7 +513,8 @@ class CLI:
                     last_version.is_base_version,
                             len(self.archive_selected.versions) - 1
             )) == 'y':
-                self.archive_selected.migrate_all_versions_to_base()
+                with cancel_on_interrupt(CancellationToken()) as cancellation:
+                    self.archive_selected.migrate_all_versions_to_base(CLIProgressBar(), cancellation)
                 print('Migrated all versions')
         else:
             number_of_archives_to_be_removed_or_all = int(number_of_archives_to_be_removed_or_all)
@@ -420,8 +536,10 @@ class CLI:
                     version.is_base_version,
                     number_of_archives_to_be_removed_or_all
             )) == 'y':
-                for i in range(number_of_archives_to_be_removed_or_all):
-                    self.archive_selected.migrate_oldest_version_to_base()
+                with cancel_on_interrupt(CancellationToken()) as cancellation:
+                    for i in range(number_of_archives_to_be_removed_or_all):
+                        cancellation.check()
+                        self.archive_selected.migrate_oldest_version_to_base(CLIProgressBar())
                 print('Migrated %s version(s)' % number_of_archives_to_be_removed_or_all)
 
     def export(self, destination_dir: str, *args):
@@ -434,8 +552,12 @@ class CLI:
                 self.version_selected.is_base_version,
                 destination_dir
         )) == 'y':
-            self.version_selected.export(destination_dir)
+            with cancel_on_interrupt(CancellationToken()) as cancellation:
+                report = self.version_selected.export(destination_dir, progress=CLIProgressBar(),
+                                                      cancellation=cancellation)
             print('Exported version %s to %s' % (self.version_selected.uuid, destination_dir))
+            print(EXPORT_REPORT_FORMAT.format(report['Files'], report['Bytes'], report['Seconds'],
+                                              report['FilesPerSecond'], report['BytesPerSecond']))
 
     def export_exact(self, destination_dir: str, *args):
         """Export command."""
@@ -447,9 +569,219 @@ class CLI:
                 self.version_selected.is_base_version,
                 destination_dir
         )) == 'y':
-            self.version_selected.export(destination_dir, exact=True)
+            with cancel_on_interrupt(CancellationToken()) as cancellation:
+                report = self.version_selected.export(destination_dir, exact=True, progress=CLIProgressBar(),
+                                                      cancellation=cancellation)
             print('Exported version %s exactly to %s' % (self.version_selected.uuid, destination_dir))
+            print(EXPORT_REPORT_FORMAT.format(report['Files'], report['Bytes'], report['Seconds'],
+                                              report['FilesPerSecond'], report['BytesPerSecond']))
+
+    def export_archive(self, archive_format: str, destination: str, *args):
+        """Export archive command."""
+        if self.version_selected is None:
+            raise CLICommandError('No version selected')
+        if archive_format not in VALID_ARCHIVE_FORMATS:
+            raise CLICommandError('Archive format must be one of %s' % ', '.join(VALID_ARCHIVE_FORMATS))
+        if input(EXPORT_ARCHIVE_FORMAT.format(
+                self.version_selected.uuid,
+                self.version_selected.time_of_creation,
+                self.version_selected.is_base_version,
+                archive_format,
+                destination
+        )) == 'y':
+            with cancel_on_interrupt(CancellationToken()) as cancellation:
+                self.version_selected.export(destination, archive_format=archive_format,
+                                             progress=CLIProgressBar() if destination != '-' else None,
+                                             cancellation=cancellation)
+            print('Exported version %s as %s to %s' % (self.version_selected.uuid, archive_format, destination))
+
+    def replicate(self, replica_dir: str, *args):
+        """Replicate command."""
+        if self.archive_selected is None:
+            raise CLICommandError('No archive selected')
+        if input(REPLICATE_FORMAT.format(
+                self.archive_selected.uuid,
+                self.archive_selected.source_dir,
+                self.archive_selected.archive_dir,
+                replica_dir
+        )) == 'y':
+            self.archive_selected.replicate(replica_dir)
+            print('Replicated archive %s to %s' % (self.archive_selected.uuid, replica_dir))
+
+    def verify(self, seconds_or_full: str, max_bytes=None, *args):
+        """Verify command."""
+        if self.archive_selected is None:
+            raise CLICommandError('No archive selected')
+        max_seconds = None
+        if seconds_or_full != 'full':
+            try:
+                max_seconds = float(seconds_or_full)
+                max_bytes = int(max_bytes) if max_bytes is not None else None
+            except ValueError:
+                raise CLICommandError('Verify only accepts full or a time budget in seconds and a byte budget')
+        report = self.archive_selected.verify(max_seconds, max_bytes)
+        for key in report['Corrupt']:
+            print('Corrupt: %s' % key)
+        for key in report['Missing']:
+            print('Missing: %s' % key)
+        for directory in report['DriftedDirectories']:
+            print('Drifted: %s' % directory)
+        print(VERIFY_FORMAT.format(report['Verified'], report['BytesVerified'], len(report['Corrupt']),
+                                   len(report['Missing']), report['Enrolled'], report['Remaining']))
+
+    def estimate(self, hash_uncertain=None, *args):
+        """Estimate command, a dry run of creating a version.
+        Files whose stat data is inconclusive are hashed when given hash."""
+        if self.archive_selected is None:
+            raise CLICommandError('No archive selected')
+        if hash_uncertain not in (None, 'hash'):
+            raise CLICommandError('Estimate only accepts hash')
+        report = self.archive_selected.estimate(hash_uncertain == 'hash')
+        for directory in report['TopDirectories']:
+            print('%s: %s file(s), %s byte(s)' % (directory['Directory'], directory['Files'], directory['Bytes']))
+        print(ESTIMATE_FORMAT.format(report['FilesScanned'], report['BytesScanned'], report['FilesNew'],
+                                     report['FilesModified'], report['FilesUncertain'], report['FilesUnchanged'],
+                                     report['FilesDeleted'], report['FilesToCopy'], report['BytesToCopy'],
+                                     report['Migrations'],
+                                     '%.1fs' % report['PredictedSeconds'] if report['PredictedSeconds'] is not None
+                                     else 'unknown, no past runs'))
+
+    def profiling(self, on_or_off: str, *args):
+        """Profiling command, turning profiling of operations on or off for this session."""
+        if on_or_off not in ('on', 'off'):
+            raise CLICommandError('Profiling only accepts on or off')
+        set_profiling(on_or_off == 'on')
+        print('Profiling is %s' % on_or_off)
+
+    def profiles(self, number_of_profiles='3', *args):
+        """Profiles command, summarising the latest profiles of the selected archive."""
+        if self.archive_selected is None:
+            raise CLICommandError('No archive selected')
+        try:
+            summaries = self.archive_selected.profiles.summarise(int(number_of_profiles), 10)
+        except ValueError:
+            raise CLICommandError('Invalid number of profiles')
+        if not summaries:
+            print('No profiles, turn profiling on first')
+        for summary in summaries:
+            print(PROFILE_FORMAT.format(summary['Name'], summary['Operation'], summary['Seconds'],
+                                        summary['PeakTracedBytes']))
+            print('Cumulative seconds by function:')
+            for function in summary['TopFunctions']:
+                print('  %8.3f %8s  %s' % (function['CumulativeSeconds'], function['Calls'], function['Function']))
+            print('Allocation sites:')
+            for allocation in summary['TopAllocations']:
+                print('  %10s %8s  %s:%s' % (allocation['Bytes'], allocation['Count'], allocation['File'],
+                                             allocation['Line']))
+
+    def restore(self, pattern: str, destination_dir=None, point_in_time=None, *args):
+        """Restore command.
+        Restores from the selected version, or from the selected archive as it was at a point in time
+        given as a POSIX timestamp or an ISO date."""
+        if destination_dir is None:
+            raise CLICommandError('Missing destination directory')
+        if point_in_time is None:
+            if self.version_selected is None:
+                raise CLICommandError('No version selected')
+            version = self.version_selected
+        else:
+            if self.archive_selected is None:
+                raise CLICommandError('No archive selected')
+            try:
+                timestamp = float(point_in_time)
+            except ValueError:
+                try:
+                    timestamp = datetime.datetime.fromisoformat(point_in_time).timestamp()
+                except ValueError:
+                    raise CLICommandError('Point in time must be a timestamp or an ISO date')
+            version = self.archive_selected.get_version_at(timestamp)
+            if version is None:
+                raise CLICommandError('No version exists at %s' % point_in_time)
+        number_of_file_restored = version.restore(pattern, destination_dir)
+        print('Restored %s file(s) from version %s to %s' % (number_of_file_restored, version.uuid, destination_dir))
+
+    def sync(self, destination_dir: str, delete_extra=None, *args):
+        """Sync command."""
+        if self.version_selected is None:
+            raise CLICommandError('No version selected')
+        if delete_extra not in (None, 'delete'):
+            raise CLICommandError('Sync only accepts delete after the destination directory')
+        if input(SYNC_FORMAT.format(
+                self.version_selected.uuid,
+                self.version_selected.time_of_creation,
+                self.version_selected.is_base_version,
+                destination_dir,
+                'will' if delete_extra else 'will not'
+        )) == 'y':
+            report = self.version_selected.sync(destination_dir, delete_extra=bool(delete_extra))
+            print('Synced version %s to %s' % (self.version_selected.uuid, destination_dir))
+            print(SYNC_REPORT_FORMAT.format(report['Checked'], report['Hashed'], report['Files'], report['Bytes'],
+                                            report['Deleted'], report['Seconds']))
+
+    def diff(self, index: str, *args):
+        """Diff command, showing changes from the selected version to another version of the archive."""
+        if self.version_selected is None:
+            raise CLICommandError('No version selected')
+        try:
+            other_version = self.archive_selected.versions[int(index)]
+        except (ValueError, IndexError):
+            raise CLICommandError('Invalid version index')
+        print('Changes from version %s to %s:\n' % (self.version_selected.uuid, other_version.uuid))
+        counter = {'added': 0, 'removed': 0, 'modified': 0}
+        for change, relative_path, old_size, new_size in self.version_selected.diff(other_version):
+            counter[change] += 1
+            if change == 'added':
+                print('+ %s (%s byte(s))' % (relative_path, new_size))
+            elif change == 'removed':
+                print('- %s (%s byte(s))' % (relative_path, old_size))
+            else:
+                print('M %s (%s -> %s byte(s))' % (relative_path, old_size, new_size))
+        print('\n%s added, %s removed, %s modified' % (counter['added'], counter['removed'], counter['modified']))
+
+    def pool(self, action='status', *args):
+        """Pool command, showing the shared object pool, setting its directory, removing objects nothing
+        refers to or turning it off."""
+        if action not in ('status', 'collect', 'off'):
+            if input('Share identical files of archives through an object pool at %s? ' % action) != 'y':
+                return
+            Abundant.set_object_pool(action)
+        elif action == 'off':
+            Abundant.set_object_pool(None)
+        object_pool = Abundant.get_object_pool()
+        if object_pool is None:
+            print('No object pool, give a directory to set one')
+            return
+        if action == 'collect':
+            print('Removed %s unreferenced object(s)' % object_pool.collect_garbage())
+        summary = object_pool.summarise()
+        print(POOL_FORMAT.format(summary['Directory'], summary['Objects'], summary['Bytes'], summary['References'],
+                                 summary['BytesSaved']))
+
+    def quota(self, max_archive_bytes=None, *args):
+        """Quota command, showing the space of the selected archive or setting the bytes its versions may
+        store, migrating the oldest versions until they fit."""
+        if self.archive_selected is None:
+            raise CLICommandError('No archive selected')
+        if max_archive_bytes is not None:
+            try:
+                max_archive_bytes = int(max_archive_bytes)
+            except ValueError:
+                raise CLICommandError('Quota only accepts a number of bytes, 0 for unlimited')
+            if max_archive_bytes < 0:
+                raise CLICommandError('Quota cannot be negative')
+            if input('Keep archive %s under %s byte(s), migrating old versions if needed? ' % (
+                    self.archive_selected.uuid, max_archive_bytes or 'unlimited')) != 'y':
+                return
+            self.archive_selected.max_archive_bytes = max_archive_bytes
+            with cancel_on_interrupt(CancellationToken()) as cancellation:
+                number_of_migrations = self.archive_selected.enforce_byte_quota(CLIProgressBar(), cancellation)
+            print('Migrated %s version(s)' % number_of_migrations)
+        self._print_archive_space()
 
 
 if __name__ == '__main__':
+    configure_logging()
+    if len(sys.argv) > 1:
+        from command import main
+        sys.exit(main(sys.argv[1:]))
     CLI().loop()
@@ -0,0 +1,407 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Non-interactive command interface for abundant.
+Every command prints a JSON result. Batch mode runs many commands in one process
+and keeps the archives it loaded between them.
+
+    python cli.py create version --archive <uuid> --yes
+    python cli.py batch commands.txt
+    python cli.py batch - < commands.txt
+    python cli.py --profile create version --archive <uuid> --yes
+"""
+
+import sys
+import json
+import shlex
+import datetime
+import argparse
+
+from cli import CLICommandError
+from abundant import Abundant
+from export import VALID_ARCHIVE_FORMATS
+from log import ABUNDANT_LOGGER, configure_logging
+from progress import CLIProgressBar, CancellationToken, cancel_on_interrupt
+from profiling import set_profiling
+
+__author__ = 'Kevin'
+
+
+class CommandArgumentParser(argparse.ArgumentParser):
+    """Argument parser raising command errors instead of exiting."""
+
+    def error(self, message: str):
+        raise CLICommandError(message)
+
+    def exit(self, status=0, message=None):
+        raise CLICommandError(message.strip() if message else 'Printed usage, no command run')
+
+
+def describe_archive(archive) -> dict:
+    """Describe an archive for JSON output.
+    :type archive: ArchiveAgent"""
+    return {
+        'UUID': archive.uuid,
+        'SourceDirectory': archive.source_dir,
+        'ArchiveDirectory': archive.archive_dir,
+        'MaxNumberOfVersions': archive.max_number_of_versions,
+        'MaxArchiveBytes': archive.max_archive_bytes,
+        'HashAlgorithm': archive.algorithm,
+        'Space': archive.space
+    }
+
+
+def describe_version(version) -> dict:
+    """Describe a version for JSON output.
+    :type version: VersionAgent"""
+    return {
+        'UUID': version.uuid,
+        'ArchiveUUID': version.archive_agent.uuid,
+        'TimeOfCreation': version.time_of_creation,
+        'IsBaseVersion': version.is_base_version,
+        'Space': version.space
+    }
+
+
+def create_parser() -> CommandArgumentParser:
+    """Create the parser for a single command."""
+    parser = CommandArgumentParser(prog='cli.py', description='Run abundant commands without prompts.')
+    parser.add_argument('--profile', action='store_true', help='profile the command into meta/profiles')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    def add_command(name: str, help_message: str, archive=False, version=False, confirm=False):
+        command = commands.add_parser(name, help=help_message)
+        if archive:
+            command.add_argument('--archive', required=True, help='archive UUID or index')
+        if version:
+            command.add_argument('--version', required=True, help='version UUID or index, negative from the latest')
+        if confirm:
+            command.add_argument('--yes', action='store_true', help='confirm the change')
+        return command
+
+    def add_progress(command):
+        command.add_argument('--progress', action='store_true', help='draw a progress bar on standard error')
+
+    command = add_command('list', 'list archives, versions or files')
+    command.add_argument('target', choices=['archive', 'version', 'file'])
+    command.add_argument('--archive', help='archive UUID or index')
+    command.add_argument('--version', help='version UUID or index, negative from the latest')
+    command.add_argument('--exact', action='store_true', help='only files stored in the version itself')
+
+    command = add_command('detail', 'describe an archive or a version')
+    command.add_argument('target', choices=['archive', 'version'])
+    command.add_argument('--archive', required=True, help='archive UUID or index')
+    command.add_argument('--version', help='version UUID or index, negative from the latest')
+
+    command = add_command('create', 'create an archive or a version', confirm=True)
+    command.add_argument('target', choices=['archive', 'version'])
+    command.add_argument('parameters', nargs='*', help='source dir, archive dir, algorithm, max versions')
+    command.add_argument('--archive', help='archive UUID or index')
+    add_progress(command)
+
+    command = add_command('remove', 'remove an archive or a version', archive=True, confirm=True)
+    command.add_argument('target', choices=['archive', 'version'])
+    command.add_argument('--version', help='version UUID or index, negative from the latest')
+
+    command = add_command('migrate', 'migrate old versions to the base', archive=True, confirm=True)
+    command.add_argument('count', help='number of versions to migrate, or all')
+    add_progress(command)
+
+    command = add_command('export', 'export a version', archive=True, version=True, confirm=True)
+    command.add_argument('destination', help='destination directory, or archive path with --format')
+    command.add_argument('--exact', action='store_true', help='only files stored in the version itself')
+    command.add_argument('--format', choices=VALID_ARCHIVE_FORMATS, help='stream into an archive file')
+    command.add_argument('--workers', type=int, help='number of parallel copies')
+    add_progress(command)
+
+    command = add_command('sync', 'sync a version into a directory', archive=True, version=True, confirm=True)
+    command.add_argument('destination', help='destination directory')
+    command.add_argument('--delete', action='store_true', help='delete files not in the version')
+
+    command = add_command('restore', 'restore files matching a pattern', archive=True)
+    command.add_argument('pattern', help='relative path or glob')
+    command.add_argument('destination', help='destination directory')
+    command.add_argument('--version', help='version UUID or index, negative from the latest')
+    command.add_argument('--at', help='point in time as a POSIX timestamp or an ISO date')
+
+    command = add_command('replicate', 'replicate an archive', archive=True, confirm=True)
+    command.add_argument('replica', help='replica directory')
+
+    command = add_command('verify', 'verify stored files', archive=True)
+    command.add_argument('--seconds', type=float, help='time budget')
+    command.add_argument('--bytes', type=int, help='byte budget')
+
+    command = add_command('estimate', 'predict what the next version would copy', archive=True)
+    command.add_argument('--hash', action='store_true', help='hash files whose stat data is inconclusive')
+    command.add_argument('--top', type=int, default=10, help='number of changed directories to report')
+
+    command = add_command('profiles', 'summarise the latest profiles', archive=True)
+    command.add_argument('--count', type=int, default=3, help='number of profiles')
+    command.add_argument('--top', type=int, default=15, help='functions and allocation sites per profile')
+
+    command = add_command('pool', 'show, set, collect or turn off the shared object pool')
+    command.add_argument('action', choices=['status', 'set', 'collect', 'off'])
+    command.add_argument('directory', nargs='?', help='pool directory to set')
+    # confirmed apart from archive changes, since status changes nothing
+    command.add_argument('--yes', dest='confirmed', action='store_true', help='confirm the change')
+
+    command = add_command('quota', 'show the space of an archive or set its byte quota', archive=True)
+    command.add_argument('bytes', type=int, nargs='?', help='bytes the archive may store, 0 for unlimited')
+    # confirmed apart from archive changes, since showing the space changes nothing
+    command.add_argument('--yes', dest='confirmed', action='store_true', help='confirm the change')
+    add_progress(command)
+
+    command = add_command('diff', 'compare two versions', archive=True, version=True)
+    command.add_argument('--other', required=True, help='version UUID or index to compare with')
+    return parser
+
+
+class CommandRunner:
+    """Runs parsed commands, caching loaded archives by UUID."""
+
+    def __init__(self, profile=False):
+        """Create the runner, profiling every command if asked to."""
+        self.parser = create_parser()
+        self.profile = profile
+        self.archives = {}
+        self.cancellation = None
+
+    def get_archive(self, uuid_or_index: str):
+        """Get an archive by UUID or by index in the master config.
+        :rtype: ArchiveAgent"""
+        if uuid_or_index is None:
+            raise CLICommandError('No archive given')
+        archive_records = Abundant.get_all_archives()
+        try:
+            archive_uuid = archive_records[int(uuid_or_index)]['UUID']
+        except IndexError:
+            raise CLICommandError('Invalid archive index: %s' % uuid_or_index)
+        except ValueError:
+            archive_uuid = uuid_or_index
+        if archive_uuid not in self.archives:
+            archive = Abundant.get_archive(uuid=archive_uuid)
+            if archive is None:
+                raise CLICommandError('No such archive: %s' % uuid_or_index)
+            self.archives[archive_uuid] = archive
+        return self.archives[archive_uuid]
+
+    def get_version(self, archive, uuid_or_index: str):
+        """Get a version by UUID or by index, negative ones counting from the latest.
+        :type archive: ArchiveAgent
+        :rtype: VersionAgent"""
+        if uuid_or_index is None:
+            raise CLICommandError('No version given')
+        try:
+            return archive.versions[int(uuid_or_index)]
+        except IndexError:
+            raise CLICommandError('Invalid version index: %s' % uuid_or_index)
+        except ValueError:
+            version = archive.get_version(uuid_or_index)
+            if version is None:
+                raise CLICommandError('No such version: %s' % uuid_or_index)
+            return version
+
+    @staticmethod
+    def get_progress(arguments):
+        """Get a progress bar if the command asked for one."""
+        return CLIProgressBar() if getattr(arguments, 'progress', False) else None
+
+    @staticmethod
+    def require_confirmation(arguments):
+        """Refuse changes that were not confirmed with --yes."""
+        if not arguments.yes:
+            raise CLICommandError('Command changes archives, confirm it with --yes')
+
+    def run(self, argv: list) -> dict:
+        """Run a single command, returning its JSON result."""
+        try:
+            arguments = self.parser.parse_args(argv)
+            if hasattr(arguments, 'yes'):
+                self.require_confirmation(arguments)
+            set_profiling(True if self.profile or arguments.profile else None)
+            with cancel_on_interrupt(CancellationToken()) as self.cancellation:
+                result = getattr(self, 'run_' + arguments.command)(arguments)
+        except Exception as e:
+            ABUNDANT_LOGGER.error('Command failed: %s: %s', ' '.join(argv), e)
+            return {'Command': argv, 'Succeeded': False, 'Error': str(e)}
+        return {'Command': argv, 'Succeeded': True, 'Result': result}
+
+    def run_batch(self, lines, output=None, stop_on_error=False) -> bool:
+        """Run one command per line, writing one JSON result per line.
+        Blank lines and lines starting with # are skipped. Returns if all commands succeeded."""
+        output = output or sys.stdout
+        all_succeeded = True
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                result = self.run(shlex.split(line))
+            except ValueError as e:
+                result = {'Command': line, 'Succeeded': False, 'Error': str(e)}
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            all_succeeded = all_succeeded and result['Succeeded']
+            if stop_on_error and not result['Succeeded']:
+                break
+        return all_succeeded
+
+    def run_list(self, arguments) -> list:
+        if arguments.target == 'archive':
+            return Abundant.get_all_archives()
+        archive = self.get_archive(arguments.archive)
+        if arguments.target == 'version':
+            return [describe_version(version) for version in archive.versions]
+        version = self.get_version(archive, arguments.version)
+        files = version.exact_files if arguments.exact else version.files
+        return sorted(relative_path for relative_path, absolute_path in files)
+
+    def run_detail(self, arguments) -> dict:
+        archive = self.get_archive(arguments.archive)
+        if arguments.target == 'archive':
+            return describe_archive(archive)
+        return describe_version(self.get_version(archive, arguments.version))
+
+    def run_create(self, arguments) -> dict:
+        if arguments.target == 'archive':
+            if len(arguments.parameters) != 4:
+                raise CLICommandError('Creating an archive needs source dir, archive dir, algorithm and max versions')
+            source_dir, archive_dir, algorithm, max_number_of_versions = arguments.parameters
+            try:
+                max_number_of_versions = int(max_number_of_versions)
+            except ValueError:
+                raise CLICommandError('Invalid max number of versions')
+            archive = Abundant.create_archive(source_dir, archive_dir, algorithm, max_number_of_versions)
+            self.archives[archive.uuid] = archive
+            return describe_archive(archive)
+        if arguments.parameters:
+            raise CLICommandError('Unknown parameter')
+        return describe_version(
+            self.get_archive(arguments.archive).create_version(self.get_progress(arguments), self.cancellation))
+
+    def run_remove(self, arguments) -> dict:
+        archive = self.get_archive(arguments.archive)
+        if arguments.target == 'archive':
+            Abundant.remove_archive(uuid=archive.uuid)
+            self.archives.pop(archive.uuid, None)
+            return {'UUID': archive.uuid}
+        version = self.get_version(archive, arguments.version)
+        version.remove()
+        return {'UUID': version.uuid}
+
+    def run_migrate(self, arguments) -> dict:
+        archive = self.get_archive(arguments.archive)
+        number_of_versions = len(archive.versions)
+        if arguments.count == 'all':
+            archive.migrate_all_versions_to_base(self.get_progress(arguments), self.cancellation)
+        else:
+            try:
+                count = int(arguments.count)
+            except ValueError:
+                raise CLICommandError('Migrate only accepts a positive integer or all')
+            if count < 0 or count >= number_of_versions:
+                raise CLICommandError('Cannot migrate %s of %s version(s)' % (count, number_of_versions))
+            for _ in range(count):
+                self.cancellation.check()
+                archive.migrate_oldest_version_to_base(self.get_progress(arguments))
+        return {'Migrated': number_of_versions - len(archive.versions),
+                'BaseVersion': archive.base_version.uuid if archive.base_version else None}
+
+    def run_export(self, arguments) -> dict:
+        version = self.get_version(self.get_archive(arguments.archive), arguments.version)
+        report = version.export(arguments.destination, exact=arguments.exact, archive_format=arguments.format,
+                                max_workers=arguments.workers, progress=self.get_progress(arguments),
+                                cancellation=self.cancellation)
+        return report if report is not None else {'Destination': arguments.destination}
+
+    def run_sync(self, arguments) -> dict:
+        version = self.get_version(self.get_archive(arguments.archive), arguments.version)
+        return version.sync(arguments.destination, delete_extra=arguments.delete)
+
+    def run_restore(self, arguments) -> dict:
+        archive = self.get_archive(arguments.archive)
+        if arguments.at is not None:
+            try:
+                timestamp = float(arguments.at)
+            except ValueError:
+                try:
+                    timestamp = datetime.datetime.fromisoformat(arguments.at).timestamp()
+                except ValueError:
+                    raise CLICommandError('Point in time must be a timestamp or an ISO date')
+            version = archive.get_version_at(timestamp)
+            if version is None:
+                raise CLICommandError('No version exists at %s' % arguments.at)
+        else:
+            version = self.get_version(archive, arguments.version if arguments.version is not None else '-1')
+        return {'Version': version.uuid, 'Files': version.restore(arguments.pattern, arguments.destination)}
+
+    def run_replicate(self, arguments) -> dict:
+        archive = self.get_archive(arguments.archive)
+        replica = archive.replicate(arguments.replica)
+        return {'UUID': archive.uuid, 'ReplicaDirectory': replica.archive_dir}
+
+    def run_verify(self, arguments) -> dict:
+        return self.get_archive(arguments.archive).verify(arguments.seconds, arguments.bytes)
+
+    def run_estimate(self, arguments) -> dict:
+        return self.get_archive(arguments.archive).estimate(arguments.hash, arguments.top)
+
+    def run_profiles(self, arguments) -> list:
+        return self.get_archive(arguments.archive).profiles.summarise(arguments.count, arguments.top)
+
+    def run_pool(self, arguments) -> dict:
+        if arguments.action != 'status' and not arguments.confirmed:
+            raise CLICommandError('Command changes the object pool, confirm it with --yes')
+        if arguments.action == 'set':
+            if arguments.directory is None:
+                raise CLICommandError('Missing pool directory')
+            Abundant.set_object_pool(arguments.directory)
+        elif arguments.action == 'off':
+            Abundant.set_object_pool(None)
+        object_pool = Abundant.get_object_pool()
+        if object_pool is None:
+            return {'Directory': ''}
+        if arguments.action == 'collect':
+            return {'Directory': object_pool.pool_dir, 'ObjectsRemoved': object_pool.collect_garbage()}
+        return object_pool.summarise()
+
+    def run_quota(self, arguments) -> dict:
+        archive = self.get_archive(arguments.archive)
+        if arguments.bytes is None:
+            return archive.space
+        if not arguments.confirmed:
+            raise CLICommandError('Command may migrate versions, confirm it with --yes')
+        archive.max_archive_bytes = arguments.bytes
+        number_of_migrations = archive.enforce_byte_quota(self.get_progress(arguments), self.cancellation)
+        return dict(archive.space, Migrations=number_of_migrations)
+
+    def run_diff(self, arguments) -> list:
+        archive = self.get_archive(arguments.archive)
+        version = self.get_version(archive, arguments.version)
+        other_version = self.get_version(archive, arguments.other)
+        return [{'Change': change, 'Path': relative_path, 'OldSize': old_size, 'NewSize': new_size}
+                for change, relative_path, old_size, new_size in version.diff(other_version)]
+
+
+def main(argv: list) -> int:
+    """Run a one-shot command, or a batch with: batch <file or -> [--stop-on-error] [--profile]."""
+    configure_logging()
+    if argv and argv[0] == 'batch':
+        if len(argv) < 2:
+            print(json.dumps({'Command': argv, 'Succeeded': False, 'Error': 'Missing batch file'}))
+            return 2
+        stop_on_error = '--stop-on-error' in argv[2:]
+        runner = CommandRunner('--profile' in argv[2:])
+        if argv[1] == '-':
+            return 0 if runner.run_batch(sys.stdin, stop_on_error=stop_on_error) else 1
+        with open(argv[1], mode='r', encoding='utf-8') as batch_file:
+            return 0 if runner.run_batch(batch_file, stop_on_error=stop_on_error) else 1
+    result = CommandRunner().run(argv)
+    print(json.dumps(result))
+    return 0 if result['Succeeded'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
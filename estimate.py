@@ -0,0 +1,154 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Dry-run estimate of the next version of an archive.
+"""
+
+import os
+import time
+
+from metrics import MetricsHistoryAgent
+from manifest import has_modification_time_of
+from support import get_relative_path
+from log import ABUNDANT_LOGGER
+
+__author__ = 'Kevin'
+
+ESTIMATE_REPORT_TEMPLATE = {
+    'FilesScanned': 0,
+    'BytesScanned': 0,
+    'FilesNew': 0,
+    'FilesModified': 0,
+    'FilesUncertain': 0,
+    'FilesUnchanged': 0,
+    'FilesDeleted': 0,
+    'FilesHashed': 0,
+    'FilesToCopy': 0,
+    'BytesToCopy': 0,
+    'Migrations': 0,
+    'TopDirectories': [],
+    'PredictedSeconds': None,
+    'Seconds': 0
+}
+
+DEFAULT_TOP_DIRECTORIES = 10
+
+
+def _get_effective_records(version) -> dict:
+    """Get the manifest record effective in a version for every file in it, None where none is known.
+    :type version: VersionAgent"""
+    records_by_holder = {}
+    effective_records = {}
+    for relative_path, absolute_path in version.files:
+        holder_uuid = version.storage.key_of(absolute_path).split('/', 1)[0]
+        if holder_uuid not in records_by_holder:
+            holder = version.archive_agent.get_version(holder_uuid)
+            records_by_holder[holder_uuid] = holder.manifest_records if holder else {}
+        effective_records[relative_path] = records_by_holder[holder_uuid].get(relative_path)
+    return effective_records
+
+
+def predict_seconds(runs: list, bytes_to_hash: int, bytes_to_copy: int, files_to_scan: int,
+                    migrations: int = 0):
+    """Predict the duration of a backup from the throughput of past create_base and create_version runs.
+    Returns None without enough history."""
+    hashed_bytes = copied_bytes = scanned_files = 0
+    hash_seconds = copy_seconds = other_seconds = 0
+    migrate_seconds = []
+    for run in runs:
+        if not run['Succeeded']:
+            continue
+        phases = run['Phases']
+        if 'Migrate' in phases:
+            migrate_seconds.append(phases['Migrate'])
+        if run['Operation'] not in ('create_base', 'create_version'):
+            continue
+        # every scanned file is hashed, copied ones are read a second time
+        hashed_bytes += run['BytesRead'] - run['BytesWritten']
+        copied_bytes += run['BytesWritten']
+        scanned_files += run['FilesScanned']
+        hash_seconds += phases.get('Hash', 0)
+        copy_seconds += phases.get('Copy', 0)
+        other_seconds += max(run['Seconds'] - sum(phases.get(phase, 0) for phase in ('Hash', 'Copy', 'Migrate')), 0)
+    if not hash_seconds or not hashed_bytes or not scanned_files:
+        return None
+
+    seconds = bytes_to_hash * hash_seconds / hashed_bytes + files_to_scan * other_seconds / scanned_files
+    if bytes_to_copy:
+        seconds += bytes_to_copy * (copy_seconds / copied_bytes if copied_bytes and copy_seconds
+                                    else hash_seconds / hashed_bytes)
+    if migrations and migrate_seconds:
+        seconds += migrations * sum(migrate_seconds) / len(migrate_seconds)
+    return seconds
+
+
+def estimate_next_version(archive_agent, hash_uncertain=False,
+                          top_directories: int = DEFAULT_TOP_DIRECTORIES) -> dict:
+    """Predict what create_version would copy without copying or writing anything.
+    A file is unchanged when its size and modification time match its record and changed when its size
+    differs. Other files are uncertain: they are hashed against their recorded digest if asked to,
+    otherwise counted as changed.
+    :type archive_agent: ArchiveAgent"""
+    start_time = time.time()
+    report = dict(ESTIMATE_REPORT_TEMPLATE, TopDirectories=[])
+    last_version = archive_agent.versions[-1] if archive_agent.versions else None
+
+    # a single kept version is replaced by a new base, which copies everything
+    full_copy = last_version is None or archive_agent.max_number_of_versions == 1
+    effective_records = {} if full_copy else _get_effective_records(last_version)
+    if not full_copy:
+        report['Migrations'] = max(len(archive_agent.versions) - archive_agent.max_number_of_versions + 1, 0)
+
+    source_dir = archive_agent.source_dir
+    changed_directories = {}
+    for root_dir, dirs, files in os.walk(source_dir):
+        for file in files:
+            source_absolute_path = os.path.join(root_dir, file)
+            try:
+                source_stat = os.stat(source_absolute_path)
+            except OSError:
+                continue
+            relative_path = get_relative_path(source_absolute_path, source_dir)
+            report['FilesScanned'] += 1
+            report['BytesScanned'] += source_stat.st_size
+
+            if full_copy or relative_path not in effective_records:
+                report['FilesNew'] += 1
+            else:
+                record = effective_records.pop(relative_path)
+                if record is not None and record.get('Size') != source_stat.st_size:
+                    report['FilesModified'] += 1
+                elif record is not None and has_modification_time_of(record, source_stat):
+                    report['FilesUnchanged'] += 1
+                    continue
+                elif hash_uncertain and record is not None and record['Digest']:
+                    report['FilesHashed'] += 1
+                    if last_version.hasher.hash(source_absolute_path) == record['Digest']:
+                        report['FilesUnchanged'] += 1
+                        continue
+                    report['FilesModified'] += 1
+                else:
+                    report['FilesUncertain'] += 1
+
+            report['FilesToCopy'] += 1
+            report['BytesToCopy'] += source_stat.st_size
+            directory = os.path.dirname(relative_path) or '.'
+            files_and_bytes = changed_directories.setdefault(directory, [0, 0])
+            files_and_bytes[0] += 1
+            files_and_bytes[1] += source_stat.st_size
+    report['FilesDeleted'] = len(effective_records)
+
+    for directory, (number_of_files, number_of_bytes) in sorted(
+            changed_directories.items(), key=lambda x: (-x[1][1], -x[1][0], x[0]))[:top_directories]:
+        report['TopDirectories'].append({'Directory': directory, 'Files': number_of_files, 'Bytes': number_of_bytes})
+
+    report['PredictedSeconds'] = predict_seconds(MetricsHistoryAgent(archive_agent.archive_dir).get_runs(),
+                                                 report['BytesScanned'], report['BytesToCopy'],
+                                                 report['FilesScanned'], report['Migrations'])
+    report['Seconds'] = time.time() - start_time
+    ABUNDANT_LOGGER.info('Estimated next version of archive %s: %s of %s file(s) to copy, %s byte(s), '
+                         '%s deleted, predicted %s second(s)', archive_agent.uuid, report['FilesToCopy'],
+                         report['FilesScanned'], report['BytesToCopy'], report['FilesDeleted'],
+                         '%.1f' % report['PredictedSeconds'] if report['PredictedSeconds'] is not None else 'unknown')
+    return report
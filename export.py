@@ -0,0 +1,445 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Export engines for versions.
+"""
+
+import io
+import os
+import sys
+import stat
+import time
+import shutil
+import contextlib
+import concurrent.futures
+
+from support import COPY_CHUNK_SIZE, is_rotational_device
+from storage import LocalStorageBackend
+from manifest import has_modification_time_of, set_modification_time_of
+from hash import HashAgent
+from progress import OperationCancelled, check_cancellation
+from log import ABUNDANT_LOGGER, FileEventLog, redirect_std_out_logging
+
+__author__ = 'Kevin'
+
+ARCHIVE_FORMAT_TO_TAR_MODE = {
+    'tar': 'w|',
+    'tar.gz': 'w|gz',
+    'tar.bz2': 'w|bz2',
+    'tar.xz': 'w|xz'
+}
+
+VALID_ARCHIVE_FORMATS = tuple(ARCHIVE_FORMAT_TO_TAR_MODE) + ('zip',)
+
+# permission bits of archive members whose stored file does not keep them
+DEFAULT_MEMBER_MODE = 0o644
+DEFAULT_DIRECTORY_MODE = 0o755
+
+EXPORT_WORKERS_FOR_DEVICE = {
+    True: 2,
+    False: 16,
+    None: 8
+}
+
+EXPORT_REPORT_TEMPLATE = {
+    'Files': 0,
+    'Bytes': 0,
+    'Seconds': 0,
+    'FilesPerSecond': 0,
+    'BytesPerSecond': 0
+}
+
+SYNC_REPORT_TEMPLATE = dict(EXPORT_REPORT_TEMPLATE, Checked=0, Hashed=0, Deleted=0)
+
+
+class _ThrottledReader(io.RawIOBase):
+    """Binary reader paying every read to a throttle."""
+
+    def __init__(self, file, throttle):
+        super(_ThrottledReader, self).__init__()
+        self.file, self.throttle = file, throttle
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = self.file.readinto(buffer)
+        self.throttle.consume(number_of_bytes=size)
+        return size
+
+    def close(self):
+        self.file.close()
+        super(_ThrottledReader, self).close()
+
+
+def _open_stored_file(storage, key: str, throttle=None):
+    """Open a stored file for streaming, through the throttle if there is one.
+    :type storage: StorageBackend"""
+    file = storage.open(key)
+    if throttle is None:
+        return file
+    throttle.consume(number_of_files=1)
+    return io.BufferedReader(_ThrottledReader(file, throttle), buffer_size=COPY_CHUNK_SIZE)
+
+
+def _get_archive_path(relative_path: str) -> str:
+    """Get the member name of a relative path inside tar and zip archives."""
+    return relative_path.replace(os.sep, '/')
+
+
+def _get_zip_date_time(timestamp: float) -> tuple:
+    """Get the zip date time tuple of a timestamp, clamped to what zip can store."""
+    date_time = time.localtime(max(timestamp, 315532800))[:6]
+    return (max(date_time[0], 1980),) + date_time[1:]
+
+
+def _get_record_of_key(version, key: str, relative_path: str, manifest_records: dict) -> dict:
+    """Get the manifest record of a stored file, None if there is none, caching manifests by version.
+    :type version: VersionAgent"""
+    version_uuid = key.split('/', 1)[0]
+    if version_uuid not in manifest_records:
+        holder = version.archive_agent.get_version(version_uuid)
+        manifest_records[version_uuid] = holder.manifest_records if holder else {}
+    return manifest_records[version_uuid].get(relative_path)
+
+
+def _get_member_modification_time(record: dict, default: float) -> float:
+    """Get the modification time of an archive member from its record, a default if it is unknown."""
+    if record and record.get('MTimeNs'):
+        return record['MTimeNs'] / 1e9
+    return record['MTime'] if record and record.get('MTime') else default
+
+
+def _get_member_mode(storage, key: str) -> int:
+    """Get the permission bits of an archive member, those of a regular file if the storage does not keep them.
+    :type storage: StorageBackend"""
+    mode = storage.mode(key)
+    return mode if mode is not None else DEFAULT_MEMBER_MODE
+
+
+def stream_export(version, output, archive_format: str = 'tar', exact=False, progress=None,
+                  cancellation=None) -> int:
+    """Stream the files of a version into a tar or zip archive without staging them.
+    Output is a path, '-' for standard output, or a writable binary file object.
+    A cancelled export into a path removes the partial archive.
+    Returns the number of files written.
+    :type version: VersionAgent
+    :type progress: ProgressReporter
+    :type cancellation: CancellationToken"""
+    import tarfile
+    import zipfile
+    archive_format = archive_format.lower()
+    if archive_format not in VALID_ARCHIVE_FORMATS:
+        ABUNDANT_LOGGER.error('Invalid archive format: %s', archive_format)
+        raise NotImplementedError('Requested archive format is either invalid or has not been implemented yet: %s'
+                                  % archive_format)
+
+    log_redirect = contextlib.ExitStack()
+    if output == '-':
+        # keep log records out of the archive
+        output_file, close_output = sys.stdout.buffer, False
+        log_redirect.enter_context(redirect_std_out_logging(sys.stderr))
+    elif isinstance(output, str):
+        output_file, close_output = open(output, mode='wb'), True
+    else:
+        output_file, close_output = output, False
+
+    file_source = version.files if not exact else version.exact_files
+    storage, throttle, metrics = version.storage, version.archive_agent.throttle, version.archive_agent.metrics
+    if progress is not None:
+        file_source = list(file_source)
+        progress.start('export_archive', len(file_source),
+                       sum(storage.size(storage.key_of(absolute_path)) for _, absolute_path in file_source))
+    manifest_records = {}
+    number_of_file_exported = 0
+    file_events = FileEventLog()
+    try:
+        with version.archive_agent.record_run('export_archive', version.uuid):
+            if archive_format == 'zip':
+                with zipfile.ZipFile(output_file, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) \
+                        as zip_archive:
+                    for relative_dir in version.directories:
+                        member = zipfile.ZipInfo(_get_archive_path(relative_dir) + '/', date_time=_get_zip_date_time(
+                            version.time_of_creation))
+                        # the low byte holds the MS-DOS directory flag
+                        member.external_attr = (stat.S_IFDIR | DEFAULT_DIRECTORY_MODE) << 16 | 0x10
+                        zip_archive.writestr(member, b'')
+                    for relative_path, absolute_path in file_source:
+                        check_cancellation(cancellation)
+                        key = storage.key_of(absolute_path)
+                        record = _get_record_of_key(version, key, relative_path, manifest_records)
+                        member = zipfile.ZipInfo(_get_archive_path(relative_path), date_time=_get_zip_date_time(
+                            _get_member_modification_time(record, version.time_of_creation)))
+                        member.compress_type = zipfile.ZIP_DEFLATED
+                        member.external_attr = (stat.S_IFREG | _get_member_mode(storage, key)) << 16
+                        with _open_stored_file(storage, key, throttle) as stored_file, \
+                                zip_archive.open(member, mode='w', force_zip64=True) as member_file:
+                            shutil.copyfileobj(stored_file, member_file, COPY_CHUNK_SIZE)
+                        metrics.count(FilesCopied=1, BytesRead=member.file_size)
+                        if progress is not None:
+                            progress.advance(1, member.file_size)
+                        number_of_file_exported += 1
+                        file_events.debug('Streamed %s', relative_path)
+            else:
+                with tarfile.open(fileobj=output_file, mode=ARCHIVE_FORMAT_TO_TAR_MODE[archive_format],
+                                  bufsize=COPY_CHUNK_SIZE, format=tarfile.PAX_FORMAT) as tar_archive:
+                    for relative_dir in version.directories:
+                        member = tarfile.TarInfo(_get_archive_path(relative_dir))
+                        member.type, member.mode = tarfile.DIRTYPE, DEFAULT_DIRECTORY_MODE
+                        member.mtime = version.time_of_creation
+                        tar_archive.addfile(member)
+                    for relative_path, absolute_path in file_source:
+                        check_cancellation(cancellation)
+                        member = tarfile.TarInfo(_get_archive_path(relative_path))
+                        key = storage.key_of(absolute_path)
+                        member.size = storage.size(key)
+                        member.mtime = _get_member_modification_time(
+                            _get_record_of_key(version, key, relative_path, manifest_records), version.time_of_creation)
+                        member.mode = _get_member_mode(storage, key)
+                        with _open_stored_file(storage, key, throttle) as stored_file:
+                            tar_archive.addfile(member, stored_file)
+                        metrics.count(FilesCopied=1, BytesRead=member.size)
+                        if progress is not None:
+                            progress.advance(1, member.size)
+                        number_of_file_exported += 1
+                        file_events.debug('Streamed %s', relative_path)
+            output_file.flush()
+            file_events.summarise()
+            ABUNDANT_LOGGER.info('Streamed %s file(s) of version %s as %s', number_of_file_exported, version.uuid,
+                                 archive_format)
+            if progress is not None:
+                progress.finish()
+    except OperationCancelled:
+        if close_output:
+            output_file.close()
+            os.remove(output)
+            close_output = False
+        raise
+    finally:
+        if close_output:
+            output_file.close()
+        log_redirect.close()
+    return number_of_file_exported
+
+
+def get_default_export_workers(destination_dir: str) -> int:
+    """Get a worker count suited to the device of a destination directory.
+    Spinning disks get few workers to avoid seeking, solid state ones get many to fill their queues."""
+    return EXPORT_WORKERS_FOR_DEVICE[is_rotational_device(destination_dir)]
+
+
+class ExportEngine:
+    """Export engine copies the files of a version with a worker pool.
+    The directory skeleton is created once up front and copies are ordered by physical location."""
+
+    def __init__(self, version, destination_dir: str, exact=False, max_workers=None, progress=None,
+                 cancellation=None):
+        """Create the engine for a version.
+        :type version: VersionAgent
+        :type progress: ProgressReporter
+        :type cancellation: CancellationToken"""
+        self.version, self.destination_dir, self.exact = version, destination_dir, exact
+        self.progress, self.cancellation = progress, cancellation
+        self.max_workers = max_workers or get_default_export_workers(destination_dir)
+        self.storage = version.storage
+        self.throttle = version.archive_agent.throttle
+        self.metrics = version.archive_agent.metrics
+        self.file_events = FileEventLog()
+        self._manifest_records = {}
+
+    def _plan(self) -> list:
+        """Get (sort key, storage key, relative path, destination path) of every file, in read order."""
+        file_source = self.version.files if not self.exact else self.version.exact_files
+        is_local = isinstance(self.storage, LocalStorageBackend)
+        work = []
+        for relative_path, absolute_path in file_source:
+            key = self.storage.key_of(absolute_path)
+            # inode numbers roughly follow on-disk placement on local file systems
+            sort_key = os.stat(absolute_path).st_ino if is_local else 0
+            work.append((sort_key, key, relative_path, os.path.join(self.destination_dir, relative_path)))
+        work.sort()
+        return work
+
+    def _get_record(self, key: str, relative_path: str) -> dict:
+        """Get the manifest record of a stored file, None if there is none."""
+        return _get_record_of_key(self.version, key, relative_path, self._manifest_records)
+
+    def _estimate_bytes(self, work: list) -> int:
+        """Estimate the bytes to copy from the manifests."""
+        total_bytes = 0
+        for sort_key, key, relative_path, destination_path in work:
+            record = self._get_record(key, relative_path)
+            total_bytes += record['Size'] if record else 0
+        return total_bytes
+
+    def _plan_directories(self, work: list) -> list:
+        """Get every destination directory, those of files and the empty ones kept by the version, sorted."""
+        directories = {os.path.dirname(item[3]) for item in work}
+        directories.update(os.path.join(self.destination_dir, relative_dir)
+                           for relative_dir in self.version.directories)
+        return sorted(directories)
+
+    def _create_directories(self, directories: list):
+        """Create every destination directory once."""
+        for directory in directories:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+        ABUNDANT_LOGGER.debug('Created %s director(ies)', len(directories))
+
+    def _copy(self, key: str, relative_path: str, destination_path: str) -> int:
+        """Copy one file, give it back its source modification time and return its size."""
+        check_cancellation(self.cancellation)
+        self.storage.get(key, destination_path, self.throttle)
+        record = self._get_record(key, relative_path)
+        if record:
+            set_modification_time_of(destination_path, record)
+        self.file_events.debug('Copied %s', destination_path)
+        size = os.path.getsize(destination_path)
+        self.metrics.count(FilesCopied=1, BytesRead=size, BytesWritten=size)
+        if self.progress is not None:
+            self.progress.advance(1, size)
+        return size
+
+    def _check_destination(self, destination_dir: str):
+        """Make sure the destination exists."""
+        if not os.path.exists(destination_dir):
+            ABUNDANT_LOGGER.error('Cannot find destination directory: %s', destination_dir)
+            raise FileNotFoundError('Cannot find destination directory: %s' % destination_dir)
+
+    @staticmethod
+    def _finish_report(report: dict, start_time: float):
+        """Fill in duration and rates of a report."""
+        report['Seconds'] = time.time() - start_time
+        if report['Seconds'] > 0:
+            report['FilesPerSecond'] = report['Files'] / report['Seconds']
+            report['BytesPerSecond'] = report['Bytes'] / report['Seconds']
+
+    def run(self) -> dict:
+        """Export the version and report throughput."""
+        self._check_destination(self.destination_dir)
+        ABUNDANT_LOGGER.debug('Exporting version %s to %s with %s worker(s)', self.version.uuid, self.destination_dir,
+                              self.max_workers)
+
+        start_time = time.time()
+        with self.metrics.phase('Plan'):
+            work = self._plan()
+            self._create_directories(self._plan_directories(work))
+        self.metrics.count(FilesScanned=len(work))
+        if self.progress is not None:
+            self.progress.start('export', len(work), self._estimate_bytes(work))
+        report = dict(EXPORT_REPORT_TEMPLATE)
+        with self.metrics.phase('Export'), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for size in executor.map(lambda item: self._copy(*item[1:]), work):
+                report['Files'] += 1
+                report['Bytes'] += size
+        if self.progress is not None:
+            self.progress.finish()
+
+        self.file_events.summarise()
+        self._finish_report(report, start_time)
+        ABUNDANT_LOGGER.info('Exported %s file(s), %s byte(s) in %.2fs (%.1f file(s)/s, %.1f byte(s)/s)',
+                             report['Files'], report['Bytes'], report['Seconds'], report['FilesPerSecond'],
+                             report['BytesPerSecond'])
+        return report
+
+
+class SyncEngine(ExportEngine):
+    """Sync engine restores a version into an existing directory, copying only files that differ.
+    Size and modification time decide first, digests only when they cannot."""
+
+    def __init__(self, version, destination_dir: str, delete_extra=False, max_workers=None):
+        """Create the engine for a version.
+        :type version: VersionAgent"""
+        super(SyncEngine, self).__init__(version, destination_dir, False, max_workers)
+        self.delete_extra = delete_extra
+        self.hasher = HashAgent(version.archive_agent.algorithm, throttle=self.throttle, metrics=self.metrics)
+
+    def _is_identical(self, key: str, relative_path: str, destination_path: str) -> tuple:
+        """Tell if a destination file already matches the stored file.
+        Returns (identical, whether hashing was needed)."""
+        try:
+            destination_stat = os.stat(destination_path)
+        except FileNotFoundError:
+            return False, False
+        record = self._get_record(key, relative_path)
+        size = record['Size'] if record else self.storage.size(key)
+        if destination_stat.st_size != size:
+            return False, False
+        if record and has_modification_time_of(record, destination_stat):
+            return True, False
+
+        # same size but unsure about content
+        digest = record['Digest'] if record and record['Digest'] else None
+        if digest is None:
+            with self.storage.open(key) as stored_file:
+                digest = self.hasher.hash_file(stored_file)
+        identical = self.hasher.hash(destination_path) == digest
+        if identical and record:
+            # remember the match so the next sync only needs a stat
+            set_modification_time_of(destination_path, record)
+        return identical, True
+
+    def _sync(self, key: str, relative_path: str, destination_path: str) -> tuple:
+        """Copy one file unless identical.
+        Returns (bytes copied, whether it was copied, whether hashing was needed)."""
+        identical, hashed = self._is_identical(key, relative_path, destination_path)
+        if identical:
+            return 0, False, hashed
+        if os.path.isdir(destination_path):
+            shutil.rmtree(destination_path)
+        return self._copy(key, relative_path, destination_path), True, hashed
+
+    def _delete_extra_files(self, wanted_paths: set) -> int:
+        """Delete files and directories in destination that are not in the version."""
+        number_of_file_deleted = 0
+        for root_dir, dirs, files in os.walk(self.destination_dir, topdown=False):
+            for file in files:
+                path = os.path.join(root_dir, file)
+                if path not in wanted_paths:
+                    os.remove(path)
+                    number_of_file_deleted += 1
+                    self.file_events.debug('Deleted %s', path)
+            if root_dir != self.destination_dir and not os.listdir(root_dir):
+                os.rmdir(root_dir)
+        return number_of_file_deleted
+
+    def run(self) -> dict:
+        """Sync the version into destination and report what was done."""
+        self._check_destination(self.destination_dir)
+        ABUNDANT_LOGGER.debug('Syncing version %s to %s with %s worker(s)', self.version.uuid, self.destination_dir,
+                              self.max_workers)
+
+        start_time = time.time()
+        with self.metrics.phase('Plan'):
+            work = self._plan()
+            directories = self._plan_directories(work)
+            for directory in directories:
+                # a file may stand where the version has a directory
+                if os.path.isfile(directory):
+                    os.remove(directory)
+            self._create_directories(directories)
+        self.metrics.count(FilesScanned=len(work))
+        report = dict(SYNC_REPORT_TEMPLATE)
+        with self.metrics.phase('Sync'), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for size, copied, hashed in executor.map(lambda item: self._sync(*item[1:]), work):
+                report['Checked'] += 1
+                report['Hashed'] += hashed
+                if copied:
+                    report['Files'] += 1
+                    report['Bytes'] += size
+                else:
+                    self.metrics.count(FilesSkipped=1)
+        if self.delete_extra:
+            with self.metrics.phase('DeleteExtra'):
+                report['Deleted'] = self._delete_extra_files({item[3] for item in work})
+            self.metrics.count(FilesDeleted=report['Deleted'])
+
+        self.file_events.summarise()
+        self._finish_report(report, start_time)
+        ABUNDANT_LOGGER.info('Synced version %s to %s: checked %s, hashed %s, copied %s (%s byte(s)), deleted %s '
+                             'in %.2fs', self.version.uuid, self.destination_dir, report['Checked'], report['Hashed'],
+                             report['Files'], report['Bytes'], report['Deleted'], report['Seconds'])
+        return report
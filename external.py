@@ -0,0 +1,140 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Bounded-memory sorting and joining of streams too large to hold in memory.
+The memory ceiling comes from MemoryCeilingBytes in the initialisation config, zero meaning unbounded.
+"""
+
+import os
+import sys
+import json
+import heapq
+import tempfile
+
+from log import ABUNDANT_LOGGER, get_init_config
+
+__author__ = 'Kevin'
+
+MAX_MERGE_WIDTH = 64
+MIN_ITEMS_PER_RUN = 1024
+
+_memory_ceiling = None
+
+
+def set_memory_ceiling(memory_ceiling):
+    """Set the memory ceiling for this process in bytes, zero for unbounded, None going back to the
+    initialisation config."""
+    global _memory_ceiling
+    _memory_ceiling = memory_ceiling
+
+
+def get_memory_ceiling() -> int:
+    """Get the memory ceiling in bytes, zero if memory is unbounded."""
+    if _memory_ceiling is not None:
+        return _memory_ceiling
+    return int(get_init_config().get('MemoryCeilingBytes', 0))
+
+
+def is_memory_bounded() -> bool:
+    """Tell if large operations have to work in bounded memory."""
+    return get_memory_ceiling() > 0
+
+
+def _estimate_size(item) -> int:
+    """Roughly estimate the memory taken by a list or dict of scalars."""
+    values = item.values() if isinstance(item, dict) else item
+    return sys.getsizeof(item) + sum(sys.getsizeof(value) for value in values)
+
+
+def _read_run(run_path: str):
+    """Generator for the items of a sorted run."""
+    with open(run_path, mode='r', encoding='utf-8') as run_file:
+        for line in run_file:
+            yield json.loads(line)
+
+
+class ExternalSorter:
+    """Sorts items in memory until they outgrow the ceiling, then in sorted runs on disk merged at the end.
+    Items are JSON lists or dicts and come back as lists or dicts. Iterating consumes the sorter."""
+
+    def __init__(self, key=None, memory_ceiling=None, temporary_dir=None):
+        """Create the sorter; the ceiling defaults to the configured one."""
+        self.key = key
+        self.memory_ceiling = memory_ceiling if memory_ceiling is not None else get_memory_ceiling()
+        self.temporary_dir = temporary_dir
+        self.items = []
+        self.items_size = 0
+        self.run_paths = []
+
+    def add(self, item):
+        """Add an item."""
+        self.items.append(item)
+        if self.memory_ceiling > 0:
+            self.items_size += _estimate_size(item)
+            if self.items_size > self.memory_ceiling and len(self.items) >= MIN_ITEMS_PER_RUN:
+                self._spill()
+
+    def extend(self, items):
+        """Add many items."""
+        for item in items:
+            self.add(item)
+
+    def _write_run(self, items) -> str:
+        """Write sorted items into a new run file."""
+        if self.temporary_dir is not None:
+            os.makedirs(self.temporary_dir, exist_ok=True)
+        file_descriptor, run_path = tempfile.mkstemp(prefix='run-', suffix='.jsonl', dir=self.temporary_dir)
+        with open(file_descriptor, mode='w', encoding='utf-8') as run_file:
+            for item in items:
+                run_file.write(json.dumps(item) + '\n')
+        return run_path
+
+    def _spill(self):
+        """Write the items in memory as a sorted run, merging runs once there are too many to open at once."""
+        self.items.sort(key=self.key)
+        self.run_paths.append(self._write_run(self.items))
+        self.items, self.items_size = [], 0
+        if len(self.run_paths) >= MAX_MERGE_WIDTH:
+            merged_path = self._write_run(heapq.merge(*map(_read_run, self.run_paths), key=self.key))
+            self._remove_runs()
+            self.run_paths = [merged_path]
+            ABUNDANT_LOGGER.debug('Merged %s sorted runs', MAX_MERGE_WIDTH)
+
+    def _remove_runs(self):
+        """Delete run files."""
+        for run_path in self.run_paths:
+            if os.path.exists(run_path):
+                os.remove(run_path)
+        self.run_paths = []
+
+    def __iter__(self):
+        self.items.sort(key=self.key)
+        items, self.items = self.items, []
+        try:
+            if not self.run_paths:
+                yield from items
+            else:
+                yield from heapq.merge(items, *map(_read_run, self.run_paths), key=self.key)
+        finally:
+            self._remove_runs()
+
+
+def merge_join(left, right, key):
+    """Generator for (key, left item, right item) over two streams sorted by a unique key,
+    the missing side being None."""
+    sentinel = object()
+    left, right = iter(left), iter(right)
+    left_item, right_item = next(left, sentinel), next(right, sentinel)
+    while left_item is not sentinel or right_item is not sentinel:
+        left_key = key(left_item) if left_item is not sentinel else None
+        right_key = key(right_item) if right_item is not sentinel else None
+        if right_item is sentinel or (left_item is not sentinel and left_key < right_key):
+            yield left_key, left_item, None
+            left_item = next(left, sentinel)
+        elif left_item is sentinel or right_key < left_key:
+            yield right_key, None, right_item
+            right_item = next(right, sentinel)
+        else:
+            yield left_key, left_item, right_item
+            left_item, right_item = next(left, sentinel), next(right, sentinel)
@@ -5,14 +5,23 @@
 Hash helper.
 """
 
+import io
+import os
+import stat
 import hashlib
 
 import binascii
 
+from support import is_sparse, read_sparse_chunks
+
 __author__ = 'Nb'
 
 VALID_ALGORITHMS = ('md5', 'sha1', 'sha256', 'sha512', 'crc32')
 
+HASH_CHUNK_SIZE = 64 * 1024
+
+ZERO_CHUNK = bytes(HASH_CHUNK_SIZE)
+
 
 def get_hashlib_instance(algorithm: str):
     """Get the hashlib instance for an algorithm.
@@ -39,16 +48,26 @@ class CRC32HashlibWrapper:
 class HashAgent:
     """Hash agent provides a common interface for hash algorithms."""
 
-    def __init__(self, algorithm: str):
-        """Create the agent from an algorithm name."""
+    def __init__(self, algorithm: str, throttle=None, metrics=None):
+        """Create the agent from an algorithm name.
+        :type throttle: ThrottleAgent
+        :type metrics: MetricsAgent"""
         algorithm = algorithm.lower()
         if algorithm not in VALID_ALGORITHMS:
             raise NotImplementedError('Requested algorithm is either invalid or has not been implemented yet: %s'
                                       % algorithm)
         self.algorithm = algorithm
+        self.throttle = throttle
+        self.metrics = metrics
 
     def hash(self, path: str) -> str:
         """Hash a file."""
+        with open(path, mode='rb') as file:
+            return self.hash_file(file)
+
+    def hash_file(self, file) -> str:
+        """Hash a binary file-like object from its current position.
+        Holes of sparse files are hashed as the zeros they read as, without reading them."""
         if self.algorithm == 'crc32':
             hasher = CRC32HashlibWrapper()
         else:
@@ -56,12 +75,50 @@ class HashAgent:
 
         # feed the data to hasher chuck by chuck
         # and digest the hash
-        with open(path, mode='rb') as file:
-            chuck = file.read(2048)
+        if self.throttle:
+            self.throttle.consume(number_of_files=1)
+        sparse_stat = self._get_sparse_stat(file)
+        if sparse_stat is not None:
+            number_of_bytes = self._feed_sparse_file(hasher, file, sparse_stat.st_size)
+        else:
+            number_of_bytes = 0
+            chuck = file.read(HASH_CHUNK_SIZE)
             while chuck:
+                if self.throttle:
+                    self.throttle.consume(number_of_bytes=len(chuck))
                 hasher.update(chuck)
-                chuck = file.read(2048)
-            return hasher.hexdigest()
+                number_of_bytes += len(chuck)
+                chuck = file.read(HASH_CHUNK_SIZE)
+        if self.metrics:
+            self.metrics.count(FilesHashed=1, BytesRead=number_of_bytes)
+        return hasher.hexdigest()
+
+    @staticmethod
+    def _get_sparse_stat(file):
+        """Get the status of the regular file behind a file object if it may have holes, None otherwise."""
+        try:
+            file_stat = os.fstat(file.fileno())
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None
+        return file_stat if stat.S_ISREG(file_stat.st_mode) and is_sparse(file_stat) else None
+
+    def _feed_sparse_file(self, hasher, file, size: int) -> int:
+        """Feed a sparse file from its current position to the hasher, holes as zeros, and
+        return the number of bytes actually read."""
+        number_of_bytes = 0
+        start = file.tell()
+        for offset, length, chuck in read_sparse_chunks(file.fileno(), start, size, HASH_CHUNK_SIZE):
+            if chuck is None:
+                zeros = memoryview(ZERO_CHUNK)
+                for hole_offset in range(0, length, HASH_CHUNK_SIZE):
+                    hasher.update(zeros[:min(HASH_CHUNK_SIZE, length - hole_offset)])
+                continue
+            if self.throttle:
+                self.throttle.consume(number_of_bytes=length)
+            hasher.update(chuck)
+            number_of_bytes += length
+        file.seek(max(size, start))
+        return number_of_bytes
 
     def __str__(self):
         return '%s HashAgent' % self.algorithm.upper()
@@ -3,44 +3,205 @@
 
 """
 Logging support for abundant.
+Entry points configure logging when they start. Otherwise the initialisation config is read and the log file
+is opened when the first record reaches the handler, records below warning being dropped until then.
+Records are queued and written by a listener thread so logging never waits for the disk or the terminal.
 """
 
 import logging
 import os
 import sys
 import json
+import queue
+import atexit
+import itertools
+import threading
+import contextlib
 import logging.handlers
 
 __author__ = 'Kevin'
 
-with open('init_config.json', mode='r', encoding='utf-8') as raw_init_config:
-    INIT_CONFIG = json.load(raw_init_config)
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+INIT_CONFIG_PATH = os.path.join(PACKAGE_DIR, 'init_config.json')
 
-ABUNDANT_LOG_PATH = os.path.join(
-    INIT_CONFIG['MasterConfigDirectory'], 'abundant.log'
-)
-ABUNDANT_LOG_FILE_HANDLER = logging.handlers.RotatingFileHandler(
-    ABUNDANT_LOG_PATH, mode='a', encoding='utf-8', maxBytes=5 * 1024 * 1024,
-    backupCount=1, delay=False
-)
+LOGGING_LEVELS = {
+    'Debug': logging.DEBUG,
+    'Info': logging.INFO,
+    'Warning': logging.WARNING,
+    'Error': logging.ERROR
+}
 
+_init_config = None
+_logging_lock = threading.RLock()
+_logging_configured = False
+
+
+def get_init_config() -> dict:
+    """Get the initialisation config, loading it from the package directory on first use."""
+    global _init_config
+    if _init_config is None:
+        with open(INIT_CONFIG_PATH, mode='r', encoding='utf-8') as raw_init_config:
+            _init_config = json.load(raw_init_config)
+    return _init_config
+
+
+def get_master_config_dir() -> str:
+    """Get the master config directory, relative ones being relative to the package directory."""
+    return os.path.join(PACKAGE_DIR, get_init_config()['MasterConfigDirectory'])
+
+
+ABUNDANT_LOG_FILE_HANDLER = None
 ABUNDANT_LOG_STD_OUT_HANDLER = logging.StreamHandler(sys.stdout)
 
 LOG_FORMAT = logging.Formatter('%(asctime)s | %(name)8s | %(module)10s | %(levelname)8s | %(message)s')
 LOG_FORMAT.datefmt = '%d %b %Y %H:%M:%S'
 
-ABUNDANT_LOG_FILE_HANDLER.setFormatter(LOG_FORMAT)
 ABUNDANT_LOG_STD_OUT_HANDLER.setFormatter(LOG_FORMAT)
 
+FILE_EVENT_SAMPLE_FIRST = 16
+FILE_EVENT_SAMPLE_EVERY = 1024
+
+_log_queue = queue.Queue()
+_log_listener = None
+_std_out_logging = True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler leaving message formatting to the listener thread, configuring logging for the first
+    record if no entry point did."""
+
+    def emit(self, record: logging.LogRecord):
+        if not _logging_configured:
+            configure_logging()
+        super(DeferredQueueHandler, self).emit(record)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            # tracebacks hold frames alive, so render them now
+            record.exc_text = LOG_FORMAT.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+ABUNDANT_LOG_QUEUE_HANDLER = DeferredQueueHandler(_log_queue)
+
+
+def _get_listener_handlers() -> tuple:
+    """Get the handlers records are written to by the listener."""
+    handlers = [ABUNDANT_LOG_STD_OUT_HANDLER] if _std_out_logging else []
+    if ABUNDANT_LOG_FILE_HANDLER is not None:
+        handlers.append(ABUNDANT_LOG_FILE_HANDLER)
+    return tuple(handlers)
+
+
+def _start_listener():
+    """Start the thread writing queued records."""
+    global _log_listener
+    _log_listener = logging.handlers.QueueListener(_log_queue, *_get_listener_handlers(),
+                                                   respect_handler_level=True)
+    _log_listener.start()
+
+
+def _restart_listener_in_child():
+    """Give a forked process its own queue and listener, the parent's thread does not exist there."""
+    global _log_queue, _logging_lock
+    _logging_lock = threading.RLock()
+    _log_queue = queue.Queue()
+    ABUNDANT_LOG_QUEUE_HANDLER.queue = _log_queue
+    if _log_listener is not None:
+        _start_listener()
+
+
+def stop_logging():
+    """Write every queued record and stop the listener."""
+    global _log_listener
+    with _logging_lock:
+        if _log_listener is not None:
+            _log_listener.stop()
+            _log_listener = None
+
+
+def flush_logging():
+    """Wait until every queued record has been written."""
+    if _log_listener is not None:
+        _log_queue.join()
+        for handler in _get_listener_handlers():
+            handler.flush()
+
+
+def configure_logging(logging_level=None, log_path=None):
+    """Set the logging level, open the log file and start the listener.
+    Level and log path default to the initialisation config."""
+    global ABUNDANT_LOG_FILE_HANDLER, _logging_configured
+    with _logging_lock:
+        if _logging_configured:
+            return
+        _logging_configured = True
+        ABUNDANT_LOGGER.setLevel(logging_level or LOGGING_LEVELS[get_init_config()['LoggingLevel']])
+        ABUNDANT_LOG_FILE_HANDLER = logging.handlers.RotatingFileHandler(
+            log_path or os.path.join(get_master_config_dir(), 'abundant.log'), mode='a', encoding='utf-8',
+            maxBytes=5 * 1024 * 1024, backupCount=1, delay=True
+        )
+        ABUNDANT_LOG_FILE_HANDLER.setFormatter(LOG_FORMAT)
+        _start_listener()
+        atexit.register(stop_logging)
+        ABUNDANT_LOGGER.debug('Logger is ready')
+
+
+def set_std_out_logging(enabled: bool):
+    """Turn writing records to standard output on or off."""
+    global _std_out_logging
+    flush_logging()
+    _std_out_logging = enabled
+    if _log_listener is not None:
+        _log_listener.handlers = _get_listener_handlers()
+
+
+@contextlib.contextmanager
+def redirect_std_out_logging(stream):
+    """Write records meant for standard output to another stream in the enclosed block."""
+    flush_logging()
+    previous_stream = ABUNDANT_LOG_STD_OUT_HANDLER.setStream(stream)
+    try:
+        yield
+    finally:
+        flush_logging()
+        ABUNDANT_LOG_STD_OUT_HANDLER.setStream(previous_stream)
+
+
+class FileEventLog:
+    """Debug log of per-file events of one operation.
+    Only the first few and then every n-th event of each kind are logged, all of them are counted.
+    Setting LogEveryFileEvent in the initialisation config logs every event."""
+
+    def __init__(self, first: int = FILE_EVENT_SAMPLE_FIRST, every: int = FILE_EVENT_SAMPLE_EVERY):
+        """Create the log."""
+        self.first, self.every = first, every
+        self.counters = {}
+        self.enabled = ABUNDANT_LOGGER.isEnabledFor(logging.DEBUG)
+        self.log_every_event = self.enabled and get_init_config().get('LogEveryFileEvent', False)
+
+    def debug(self, message: str, *args):
+        """Count an event and log it if it is sampled; the message is the kind of the event."""
+        if not self.enabled:
+            return
+        counter = self.counters.get(message)
+        if counter is None:
+            counter = self.counters.setdefault(message, itertools.count(1))
+        number = next(counter)
+        if self.log_every_event or number <= self.first or number % self.every == 0:
+            ABUNDANT_LOGGER.debug(message, *args, stacklevel=2)
+
+    def summarise(self):
+        """Log how many events of each kind happened."""
+        for message, counter in self.counters.items():
+            number_of_events = next(counter) - 1
+            if number_of_events > self.first and not self.log_every_event:
+                ABUNDANT_LOGGER.debug('%s event(s) like "%s", %s of them logged', number_of_events, message,
+                                      self.first + number_of_events // self.every - self.first // self.every,
+                                      stacklevel=2)
+
+
 ABUNDANT_LOGGER = logging.getLogger('ABUNDANT')
-ABUNDANT_LOGGER.setLevel(
-    {'Debug': logging.DEBUG,
-     'Info': logging.INFO,
-     'Warning': logging.WARNING,
-     'Error': logging.ERROR}[INIT_CONFIG['LoggingLevel']]
-)
-ABUNDANT_LOGGER.addHandler(ABUNDANT_LOG_STD_OUT_HANDLER)
-ABUNDANT_LOGGER.addHandler(ABUNDANT_LOG_FILE_HANDLER)
-
-ABUNDANT_LOGGER.debug('Loading abundant...')
-ABUNDANT_LOGGER.debug('Logger is ready')
+ABUNDANT_LOGGER.addHandler(ABUNDANT_LOG_QUEUE_HANDLER)
+os.register_at_fork(after_in_child=_restart_listener_in_child)
@@ -0,0 +1,146 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Manifests recording what was stored in each version.
+"""
+
+import os
+import json
+
+from external import merge_join
+from log import ABUNDANT_LOGGER
+
+__author__ = 'Kevin'
+
+MANIFEST_RECORD_TEMPLATE = {
+    'Path': '',
+    'Size': 0,
+    'MTime': 0,
+    'MTimeNs': 0,
+    'Digest': '',
+    'Deleted': False
+}
+
+
+class ManifestAgent:
+    """Manifest of a single version, one JSON record per stored file, sorted by path.
+    Files deleted from the source since the previous version are kept as deletion records."""
+
+    def __init__(self, archive_dir: str, version_uuid: str):
+        """Create the agent for a version."""
+        self.manifest_dir = os.path.join(archive_dir, 'meta', 'manifests')
+        self.manifest_path = os.path.join(self.manifest_dir, '%s.jsonl' % version_uuid)
+
+    @property
+    def exists(self) -> bool:
+        """Tell if the manifest has been written."""
+        return os.path.exists(self.manifest_path)
+
+    @property
+    def records(self):
+        """Generator for all records in path order."""
+        if not self.exists:
+            return
+        with open(self.manifest_path, mode='r', encoding='utf-8') as raw_manifest:
+            for line in raw_manifest:
+                yield json.loads(line)
+
+    def load(self) -> dict:
+        """Load all records keyed by relative path."""
+        return {record['Path']: record for record in self.records}
+
+    def save(self, records: dict):
+        """Replace the manifest with records keyed by relative path."""
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        temporary_path = self.manifest_path + '.tmp'
+        with open(temporary_path, mode='w', encoding='utf-8') as raw_manifest:
+            for path in sorted(records):
+                raw_manifest.write(json.dumps(records[path]) + '\n')
+        os.replace(temporary_path, self.manifest_path)
+        ABUNDANT_LOGGER.debug('Saved manifest with %s record(s): %s', len(records), self.manifest_path)
+
+    def merge(self, records, drop_deleted=False):
+        """Add or replace records given in path order, streaming the manifest instead of loading it.
+        Deletion records are left out if asked to."""
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        temporary_path = self.manifest_path + '.tmp'
+        number_of_records = 0
+        with open(temporary_path, mode='w', encoding='utf-8') as raw_manifest:
+            for path, old_record, new_record in merge_join(self.records, records, key=lambda record: record['Path']):
+                record = new_record or old_record
+                if drop_deleted and record.get('Deleted'):
+                    continue
+                raw_manifest.write(json.dumps(record) + '\n')
+                number_of_records += 1
+        os.replace(temporary_path, self.manifest_path)
+        ABUNDANT_LOGGER.debug('Merged manifest with %s record(s): %s', number_of_records, self.manifest_path)
+
+    def update(self, records: dict):
+        """Add or replace some records."""
+        if not records:
+            return
+        self.merge(records[path] for path in sorted(records))
+
+    def remove(self):
+        """Delete the manifest."""
+        if self.exists:
+            os.remove(self.manifest_path)
+
+
+class ManifestCursor:
+    """Looks up records of a manifest for paths asked for in increasing order, reading it only once."""
+
+    def __init__(self, manifest: ManifestAgent):
+        """Create the cursor at the start of a manifest."""
+        self.records = manifest.records
+        self.record = next(self.records, None)
+
+    def get(self, relative_path: str) -> dict:
+        """Get the record of a path, None if there is none.
+        Paths must not be smaller than the one asked for before."""
+        while self.record is not None and self.record['Path'] < relative_path:
+            self.record = next(self.records, None)
+        if self.record is not None and self.record['Path'] == relative_path:
+            return self.record
+        return None
+
+
+def create_manifest_record(relative_path: str, size: int, digest: str, modification_time_ns: int = 0) -> dict:
+    """Create a manifest record.
+    Modification time is the one the source file had in nanoseconds, zero if unknown."""
+    record = dict(MANIFEST_RECORD_TEMPLATE)
+    record.update({
+        'Path': relative_path,
+        'Size': size,
+        'MTime': modification_time_ns / 1e9,
+        'MTimeNs': modification_time_ns,
+        'Digest': digest
+    })
+    return record
+
+
+def has_modification_time_of(record: dict, file_stat: os.stat_result) -> bool:
+    """Tell if a file was last modified when the file of a record was.
+    Records from before nanoseconds were kept only hold a float, so they match to the microsecond."""
+    if record.get('MTimeNs'):
+        return file_stat.st_mtime_ns == record['MTimeNs']
+    return bool(record.get('MTime')) and abs(file_stat.st_mtime - record['MTime']) < 1e-6
+
+
+def set_modification_time_of(path: str, record: dict):
+    """Give a file the modification time of a record, if it is known."""
+    if record.get('MTimeNs'):
+        os.utime(path, ns=(record['MTimeNs'], record['MTimeNs']))
+    elif record.get('MTime'):
+        os.utime(path, (record['MTime'], record['MTime']))
+
+
+def create_deletion_record(relative_path: str) -> dict:
+    """Create a manifest record marking a file as deleted in a version."""
+    record = dict(MANIFEST_RECORD_TEMPLATE)
+    record.update({
+        'Path': relative_path,
+        'Deleted': True
+    })
+    return record
@@ -10,12 +10,15 @@ import os
 import uuid
 
 from support import SingletonMeta
-from log import ABUNDANT_LOGGER
+from log import ABUNDANT_LOGGER, get_init_config, get_master_config_dir
 
 __author__ = 'Kevin'
 
 MASTER_CONFIG_TEMPLATE = {
     'MasterConfigVersion': 0.1,
+    'SchedulerMaxWorkers': 4,
+    'SchedulerMaxJobsPerDevice': 1,
+    'SharedObjectPool': '',
     'ArchiveRecords': []
 }
 
@@ -27,27 +30,37 @@ ARCHIVE_RECORD_TEMPLATE = {
 
 
 class MasterConfigAgent(metaclass=SingletonMeta):
-    """Agent for master configurations."""
+    """Agent for master configurations, loaded on first use."""
 
     def __init__(self):
         """Create the agent."""
-        self.load_config()
+        self._master_config = None
 
-    def load_config(self):
-        """Load the config."""
-        with open('init_config.json', mode='r', encoding='utf-8') as raw_init_config:
-            self.init_config = json.load(raw_init_config)
-        ABUNDANT_LOGGER.info('Loaded initialisation config')
+    @property
+    def init_config(self) -> dict:
+        """Get the initialisation config."""
+        return get_init_config()
 
-        master_config_dir = self.init_config['MasterConfigDirectory']
-        self.master_config_path = os.path.join(master_config_dir, 'master_config.json')
+    @property
+    def master_config_path(self) -> str:
+        """Get the path of the master config."""
+        return os.path.join(get_master_config_dir(), 'master_config.json')
+
+    @property
+    def master_config(self) -> dict:
+        """Get the master config, loading it if needed."""
+        if self._master_config is None:
+            self.load_config()
+        return self._master_config
 
+    def load_config(self):
+        """Load the config."""
         if not os.path.exists(self.master_config_path):
             ABUNDANT_LOGGER.warning('No master config found')
             self.save_config(use_default_template=True)
 
         with open(self.master_config_path, mode='r', encoding='utf-8') as raw_master_config:
-            self.master_config = json.load(raw_master_config)
+            self._master_config = json.load(raw_master_config)
         ABUNDANT_LOGGER.info('Loaded master config')
 
     def save_config(self, use_default_template=False):
@@ -61,11 +74,20 @@ class MasterConfigAgent(metaclass=SingletonMeta):
         """Get an master config item."""
         return self.master_config[item]
 
+    def get(self, item: str, default=None):
+        """Get an master config item, falling back to the template and then to a default."""
+        return self.master_config.get(item, MASTER_CONFIG_TEMPLATE.get(item, default))
+
+    @property
+    def master_config_dir(self) -> str:
+        """Get the directory holding the master config."""
+        return os.path.dirname(self.master_config_path)
+
     def __setitem__(self, key, value):
         """Update a master config item."""
         self.master_config[key] = value
         self.save_config()
-        ABUNDANT_LOGGER.info('Updated master config [%s] to [%s]' % (key, value))
+        ABUNDANT_LOGGER.info('Updated master config [%s] to [%s]', key, value)
 
     @property
     def archive_records(self) -> list:
@@ -87,8 +109,8 @@ class MasterConfigAgent(metaclass=SingletonMeta):
         self.archive_records.append(archive_record)
         self.save_config()
 
-        ABUNDANT_LOGGER.info('Added archive record: %s' % archive_uuid)
-        ABUNDANT_LOGGER.debug('From %s to %s' % (source_dir, archive_dir))
+        ABUNDANT_LOGGER.info('Added archive record: %s', archive_uuid)
+        ABUNDANT_LOGGER.debug('From %s to %s', source_dir, archive_dir)
         return archive_record
 
     def get_archive_record(self, uuid=None, source_dir=None, archive_dir=None) -> dict:
@@ -110,4 +132,4 @@ class MasterConfigAgent(metaclass=SingletonMeta):
         archive = self.get_archive_record(uuid, source_dir, archive_dir)
         if archive_dir is not None:
             self.archive_records.remove(archive)
-            ABUNDANT_LOGGER.info('Deleted archive record: %s' % archive['UUID'])
+            ABUNDANT_LOGGER.info('Deleted archive record: %s', archive['UUID'])
@@ -0,0 +1,178 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Merkle digests of the directories of each version, so equal subtrees can be told apart without looking at
+their files.
+"""
+
+import os
+import json
+import hashlib
+
+from log import ABUNDANT_LOGGER
+
+__author__ = 'Kevin'
+
+MERKLE_TREE_TEMPLATE = {
+    'MerkleTreeVersion': 0.1,
+    'View': {},
+    'Stored': {}
+}
+
+ROOT_DIRECTORY = ''
+
+
+def get_directory_of_path(relative_path: str) -> str:
+    """Get the slash separated directory of a relative path, the root being an empty string."""
+    return relative_path.replace(os.sep, '/').rpartition('/')[0]
+
+
+def _get_digest_of_children(children: list) -> str:
+    """Get the digest of a directory from the (name, kind, digest) of its children."""
+    return hashlib.blake2b(json.dumps(sorted(children)).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def build_directory_digests(leaves) -> dict:
+    """Build the digests of all directories from (relative path, leaf digest) of files in path order,
+    keyed by slash separated directory. Each directory has a tree digest covering the names and digests
+    of all its children, so equal tree digests mean equal subtrees, and a digest of its own files alone.
+    Only the directories being walked are held in memory."""
+    digests = {}
+    # open directories from the root down, each with the files and subdirectories seen so far
+    stack = [(ROOT_DIRECTORY, [], [])]
+
+    def close_directory():
+        directory, files, subdirectories = stack.pop()
+        digests[directory] = [_get_digest_of_children(files + subdirectories), _get_digest_of_children(files)]
+        if directory:
+            stack[-1][2].append([directory.rpartition('/')[2], 'D', digests[directory][0]])
+
+    for relative_path, leaf in leaves:
+        parts = relative_path.replace(os.sep, '/').split('/')
+        directory = '/'.join(parts[:-1])
+        # paths sharing a directory are contiguous in path order, so a closed directory never comes back
+        while len(stack) > 1 and directory != stack[-1][0] and not directory.startswith(stack[-1][0] + '/'):
+            close_directory()
+        while stack[-1][0] != directory:
+            stack.append(('/'.join(parts[:len(stack)]), [], []))
+        stack[-1][1].append([parts[-1], 'F', leaf])
+    while stack:
+        close_directory()
+    return digests
+
+
+def _get_children_of_directories(*trees) -> dict:
+    """Get the subdirectories of every directory in some trees."""
+    children_of = {}
+    for tree in trees:
+        for directory in tree:
+            if directory:
+                children_of.setdefault(directory.rpartition('/')[0], set()).add(directory)
+    return children_of
+
+
+def get_equal_directories(digests: dict, other_digests: dict) -> set:
+    """Get the directories whose tree digests are equal in two trees, which covers their whole subtrees.
+    Only the directories under differing ones are compared."""
+    equal_directories = set()
+    children_of = _get_children_of_directories(digests)
+    pending = [ROOT_DIRECTORY]
+    while pending:
+        directory = pending.pop()
+        if directory not in digests or directory not in other_digests:
+            continue
+        if digests[directory][0] == other_digests[directory][0]:
+            equal_directories.add(directory)
+        else:
+            pending.extend(children_of.get(directory, ()))
+    return equal_directories
+
+
+def get_differing_directories(digests: dict, other_digests: dict) -> list:
+    """Get the directories whose own files differ between two trees and the topmost ones found in only one
+    of them, descending only into subtrees that differ."""
+    differing_directories = []
+    children_of = _get_children_of_directories(digests, other_digests)
+    pending = [ROOT_DIRECTORY]
+    while pending:
+        directory = pending.pop()
+        digest, other_digest = digests.get(directory), other_digests.get(directory)
+        if digest == other_digest:
+            continue
+        if digest is None or other_digest is None or digest[1] != other_digest[1]:
+            differing_directories.append(directory)
+        if digest is not None and other_digest is not None:
+            pending.extend(children_of.get(directory, ()))
+    return sorted(differing_directories)
+
+
+class DirectoryCover:
+    """Tells if a path lies in one of a set of directories or below them."""
+
+    def __init__(self, directories: set):
+        """Create the cover of some slash separated directories."""
+        self.directories = directories
+        self.covered = {}
+
+    def covers_directory(self, directory: str) -> bool:
+        """Tell if a slash separated directory is covered."""
+        if directory not in self.covered:
+            self.covered[directory] = directory in self.directories or (
+                directory != ROOT_DIRECTORY and self.covers_directory(directory.rpartition('/')[0]))
+        return self.covered[directory]
+
+    def covers(self, relative_path: str) -> bool:
+        """Tell if a file is covered."""
+        return bool(self.directories) and self.covers_directory(get_directory_of_path(relative_path))
+
+
+def get_common_directories(directories: set, other_directories: set) -> set:
+    """Get the directories lying in both of two sets of directories or below them."""
+    cover, other_cover = DirectoryCover(directories), DirectoryCover(other_directories)
+    return {directory for directory in directories | other_directories
+            if cover.covers_directory(directory) and other_cover.covers_directory(directory)}
+
+
+class MerkleTreeAgent:
+    """Directory digests of a single version: those of its view, with every file effective in it,
+    which never change, and those of the files stored in it, which change when files move into it."""
+
+    def __init__(self, archive_dir: str, version_uuid: str):
+        """Create the agent for a version."""
+        self.tree_dir = os.path.join(archive_dir, 'meta', 'trees')
+        self.tree_path = os.path.join(self.tree_dir, '%s.json' % version_uuid)
+
+    @property
+    def exists(self) -> bool:
+        """Tell if the tree has been written."""
+        return os.path.exists(self.tree_path)
+
+    def load(self) -> dict:
+        """Load the tree, with empty digests where there are none."""
+        if not self.exists:
+            return dict(MERKLE_TREE_TEMPLATE, View={}, Stored={})
+        with open(self.tree_path, mode='r', encoding='utf-8') as raw_tree:
+            return dict(MERKLE_TREE_TEMPLATE, **json.load(raw_tree))
+
+    def save(self, tree: dict):
+        """Replace the tree."""
+        os.makedirs(self.tree_dir, exist_ok=True)
+        temporary_path = self.tree_path + '.tmp'
+        with open(temporary_path, mode='w', encoding='utf-8') as raw_tree:
+            json.dump(tree, raw_tree)
+        os.replace(temporary_path, self.tree_path)
+        ABUNDANT_LOGGER.debug('Saved tree of %s and %s director(ies): %s', len(tree['View']), len(tree['Stored']),
+                              self.tree_path)
+
+    def update(self, **digests):
+        """Replace the View or Stored digests, dropping them if None."""
+        tree = self.load()
+        for name, directory_digests in digests.items():
+            tree[name] = directory_digests or {}
+        self.save(tree)
+
+    def remove(self):
+        """Delete the tree."""
+        if self.exists:
+            os.remove(self.tree_path)
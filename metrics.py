@@ -0,0 +1,159 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Run metrics of archive operations.
+"""
+
+import os
+import time
+import threading
+import contextlib
+
+from config import get_config, create_config
+from log import ABUNDANT_LOGGER
+
+__author__ = 'Kevin'
+
+RUN_METRICS_TEMPLATE = {
+    'Operation': '',
+    'ArchiveUUID': '',
+    'VersionUUID': '',
+    'StartTime': 0,
+    'EndTime': 0,
+    'Seconds': 0,
+    'Succeeded': False,
+    'FilesScanned': 0,
+    'FilesHashed': 0,
+    'FilesSkipped': 0,
+    'FilesCopied': 0,
+    'FilesLinked': 0,
+    'FilesDeleted': 0,
+    'BytesRead': 0,
+    'BytesWritten': 0,
+    'Phases': {}
+}
+
+METRICS_HISTORY_TEMPLATE = {
+    'MetricsHistoryVersion': 0.1,
+    'Runs': []
+}
+
+MAX_RUN_METRICS = 32
+
+PROMETHEUS_METRICS = {
+    'Seconds': ('abundant_run_seconds', 'Duration of the last run.'),
+    'FilesScanned': ('abundant_run_files_scanned', 'Files scanned by the last run.'),
+    'FilesHashed': ('abundant_run_files_hashed', 'Files hashed by the last run.'),
+    'FilesSkipped': ('abundant_run_files_skipped', 'Unchanged files skipped by the last run.'),
+    'FilesCopied': ('abundant_run_files_copied', 'Files copied or moved by the last run.'),
+    'FilesLinked': ('abundant_run_files_linked', 'Files linked to shared objects instead of copied by the last run.'),
+    'FilesDeleted': ('abundant_run_files_deleted', 'Files dropped or recorded as deleted by the last run.'),
+    'BytesRead': ('abundant_run_bytes_read', 'Bytes read by the last run.'),
+    'BytesWritten': ('abundant_run_bytes_written', 'Bytes written by the last run.'),
+    'EndTime': ('abundant_run_end_timestamp_seconds', 'End time of the last run.'),
+    'Succeeded': ('abundant_run_succeeded', 'Whether the last run succeeded.')
+}
+
+
+class MetricsAgent:
+    """Collects counters and phase durations of the running operation of an archive.
+    Shared by all threads working on the archive; counting does nothing while no run is active."""
+
+    def __init__(self, archive_uuid: str):
+        """Create the agent for an archive."""
+        self.archive_uuid = archive_uuid
+        self.lock = threading.Lock()
+        self.run = None
+
+    @property
+    def is_active(self) -> bool:
+        """Tell if a run is being recorded."""
+        return self.run is not None
+
+    def start(self, operation: str, version_uuid: str = ''):
+        """Start recording a run."""
+        self.run = dict(RUN_METRICS_TEMPLATE, Phases={}, Operation=operation, ArchiveUUID=self.archive_uuid,
+                        VersionUUID=version_uuid, StartTime=time.time())
+
+    def finish(self, succeeded: bool) -> dict:
+        """Stop recording and return the run summary."""
+        run, self.run = self.run, None
+        run['EndTime'] = time.time()
+        run['Seconds'] = run['EndTime'] - run['StartTime']
+        run['Succeeded'] = succeeded
+        return run
+
+    def set_version(self, version_uuid: str):
+        """Set the version the running operation works on."""
+        if self.run is not None:
+            self.run['VersionUUID'] = version_uuid
+
+    def count(self, **counters):
+        """Add to counters of the running operation."""
+        if self.run is None:
+            return
+        with self.lock:
+            for name, value in counters.items():
+                self.run[name] += value
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Add the time spent in the enclosed block to a phase of the running operation."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.run is not None:
+                with self.lock:
+                    phases = self.run['Phases']
+                    phases[name] = phases.get(name, 0) + time.perf_counter() - start_time
+
+
+class MetricsHistoryAgent:
+    """Agent for the persisted summaries of recent runs of an archive."""
+
+    def __init__(self, archive_dir: str):
+        """Create the agent for an archive."""
+        self.metrics_history_path = os.path.join(archive_dir, 'meta', 'run_metrics.json')
+
+    def get_runs(self, operation=None) -> list:
+        """Get recent runs, from oldest to latest, optionally of a single operation."""
+        if not os.path.exists(self.metrics_history_path):
+            return []
+        with get_config(self.metrics_history_path) as metrics_history:
+            return [run for run in metrics_history['Runs'] if operation is None or run['Operation'] == operation]
+
+    def add_run(self, run: dict):
+        """Append a run summary and drop the oldest ones."""
+        if not os.path.exists(self.metrics_history_path):
+            create_config(METRICS_HISTORY_TEMPLATE, self.metrics_history_path)
+        with get_config(self.metrics_history_path, save_change=True) as metrics_history:
+            runs = metrics_history['Runs']
+            runs.append(run)
+            del runs[:-MAX_RUN_METRICS]
+
+    def write_prometheus_textfile(self, textfile_path: str):
+        """Write the latest run of every operation in Prometheus text format, atomically."""
+        latest_runs = {}
+        for run in self.get_runs():
+            latest_runs[run['Operation']] = run
+        lines = []
+        for field, (metric_name, help_message) in PROMETHEUS_METRICS.items():
+            lines.append('# HELP %s %s' % (metric_name, help_message))
+            lines.append('# TYPE %s gauge' % metric_name)
+            for operation, run in sorted(latest_runs.items()):
+                lines.append('%s{archive="%s",operation="%s"} %s'
+                             % (metric_name, run['ArchiveUUID'], operation, float(run.get(field, 0))))
+        lines.append('# HELP abundant_run_phase_seconds Duration of a phase of the last run.')
+        lines.append('# TYPE abundant_run_phase_seconds gauge')
+        for operation, run in sorted(latest_runs.items()):
+            for phase, seconds in sorted(run['Phases'].items()):
+                lines.append('abundant_run_phase_seconds{archive="%s",operation="%s",phase="%s"} %s'
+                             % (run['ArchiveUUID'], operation, phase, float(seconds)))
+
+        temporary_path = textfile_path + '.tmp'
+        with open(temporary_path, mode='w', encoding='utf-8') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.replace(temporary_path, textfile_path)
+        ABUNDANT_LOGGER.debug('Wrote Prometheus textfile %s', textfile_path)
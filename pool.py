@@ -0,0 +1,166 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Shared object pool deduplicating identical files across archives on one file system.
+Opted into by SharedObjectPool in the master config, the directory of the pool.
+"""
+
+import os
+import stat
+import contextlib
+
+from storage import LocalStorageBackend
+from log import ABUNDANT_LOGGER
+
+__author__ = 'Kevin'
+
+OBJECT_POOL_SUMMARY_TEMPLATE = {
+    'Directory': '',
+    'Objects': 0,
+    'Bytes': 0,
+    'References': 0,
+    'BytesSaved': 0
+}
+
+# digests that collide by accident cannot name shared content
+POOL_ALGORITHMS = ('md5', 'sha1', 'sha256', 'sha512')
+
+
+def get_object_pool_dir():
+    """Get the directory of the shared object pool from the master config, None if there is none.
+    A missing master config is not created."""
+    from master_config import MasterConfigAgent
+    master_config = MasterConfigAgent()
+    if not os.path.exists(master_config.master_config_path):
+        return None
+    return master_config.get('SharedObjectPool') or None
+
+
+def open_object_pool(archive_agent):
+    """Open the shared object pool for an archive, None if the archive cannot use it: it has to be
+    registered in the master config, keep its files locally on the file system of the pool and hash them
+    with an algorithm fit for naming content.
+    :type archive_agent: ArchiveAgent
+    :rtype: ObjectPoolAgent"""
+    pool_dir = get_object_pool_dir()
+    if pool_dir is None or archive_agent.algorithm not in POOL_ALGORITHMS \
+            or not isinstance(archive_agent.storage, LocalStorageBackend):
+        return None
+    from master_config import MasterConfigAgent
+    archive_record = MasterConfigAgent().get_archive_record(uuid=archive_agent.uuid)
+    if archive_record is None or \
+            os.path.abspath(archive_record['ArchiveDirectory']) != os.path.abspath(archive_agent.archive_dir):
+        return None
+    pool = ObjectPoolAgent(pool_dir)
+    if not pool.is_on_file_system_of(archive_agent.storage.root_dir):
+        ABUNDANT_LOGGER.warning('Archive %s is not on the file system of the object pool %s', archive_agent.uuid,
+                                pool_dir)
+        return None
+    return pool
+
+
+class ObjectPoolAgent:
+    """Agent for a pool of objects named by algorithm and digest.
+    Archive files sharing an object are hard links to it, so its link count less one is the number of
+    references, and removing a reference never touches the others.
+    Objects nothing refers to any more are removed when references are released."""
+
+    def __init__(self, pool_dir: str):
+        """Create the agent for a pool directory."""
+        self.pool_dir = pool_dir
+        self.objects_dir = os.path.join(pool_dir, 'objects')
+
+    def is_on_file_system_of(self, directory: str) -> bool:
+        """Tell if a directory is on the file system of the pool, so files can be linked between them."""
+        try:
+            os.makedirs(self.objects_dir, exist_ok=True)
+            return os.stat(self.objects_dir).st_dev == os.stat(directory).st_dev
+        except OSError:
+            return False
+
+    def _get_object_path(self, algorithm: str, digest: str) -> str:
+        """Get the path of an object."""
+        digest = digest.lower()
+        return os.path.join(self.objects_dir, algorithm, digest[:2], digest)
+
+    def get_reference_count(self, algorithm: str, digest: str) -> int:
+        """Get the number of files linked to an object, zero if there is no such object."""
+        try:
+            return os.stat(self._get_object_path(algorithm, digest)).st_nlink - 1
+        except FileNotFoundError:
+            return 0
+
+    def link(self, algorithm: str, digest: str, size: int, mode: int, destination_path: str) -> bool:
+        """Link a new file to the object of a digest, telling if there was such an object of that size.
+        Links share permission bits, so only an object with the permission bits of the new file is linked."""
+        object_path = self._get_object_path(algorithm, digest)
+        try:
+            object_stat = os.stat(object_path)
+            if object_stat.st_size != size:
+                ABUNDANT_LOGGER.warning('Object %s does not have the size of its content, not linking it', object_path)
+                return False
+            if stat.S_IMODE(object_stat.st_mode) != stat.S_IMODE(mode):
+                return False
+            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+            os.link(object_path, destination_path)
+        except FileNotFoundError:
+            # an object can be released while being linked
+            return False
+        return True
+
+    def add(self, algorithm: str, digest: str, path: str):
+        """Make a stored file the object of its digest unless there already is one."""
+        object_path = self._get_object_path(algorithm, digest)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        with contextlib.suppress(FileExistsError):
+            os.link(path, object_path)
+
+    def release(self, algorithm: str, digests) -> int:
+        """Remove the objects of digests whose files are gone and return how many were removed.
+        Digests may come as a stream and repeat."""
+        number_of_objects_removed = 0
+        for digest in digests:
+            if digest and self._remove_if_unreferenced(self._get_object_path(algorithm, digest)):
+                number_of_objects_removed += 1
+        if number_of_objects_removed:
+            ABUNDANT_LOGGER.info('Removed %s unreferenced object(s) from pool %s', number_of_objects_removed,
+                                 self.pool_dir)
+        return number_of_objects_removed
+
+    @staticmethod
+    def _remove_if_unreferenced(object_path: str) -> bool:
+        """Remove an object nothing links to."""
+        try:
+            if os.stat(object_path).st_nlink > 1:
+                return False
+            os.remove(object_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _iterate_object_paths(self):
+        """Generator for the paths of all objects."""
+        for root_dir, dirs, files in os.walk(self.objects_dir):
+            for file in files:
+                yield os.path.join(root_dir, file)
+
+    def collect_garbage(self) -> int:
+        """Remove every object nothing links to and return how many were removed."""
+        number_of_objects_removed = sum(self._remove_if_unreferenced(object_path)
+                                        for object_path in list(self._iterate_object_paths()))
+        ABUNDANT_LOGGER.info('Removed %s unreferenced object(s) from pool %s', number_of_objects_removed,
+                             self.pool_dir)
+        return number_of_objects_removed
+
+    def summarise(self) -> dict:
+        """Summarise the objects, their references and the bytes not stored again thanks to them."""
+        summary = dict(OBJECT_POOL_SUMMARY_TEMPLATE, Directory=self.pool_dir)
+        for object_path in self._iterate_object_paths():
+            with contextlib.suppress(FileNotFoundError):
+                object_stat = os.stat(object_path)
+                summary['Objects'] += 1
+                summary['Bytes'] += object_stat.st_size
+                summary['References'] += object_stat.st_nlink - 1
+                summary['BytesSaved'] += max(object_stat.st_nlink - 2, 0) * object_stat.st_size
+        return summary
@@ -0,0 +1,141 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Opt-in CPU and memory profiling of archive operations.
+Turned on by Profiling in the initialisation config or by set_profiling.
+"""
+
+import os
+import json
+import time
+import pstats
+import cProfile
+import tracemalloc
+import contextlib
+
+from log import ABUNDANT_LOGGER, get_init_config
+
+__author__ = 'Kevin'
+
+PROFILE_TEMPLATE = {
+    'Operation': '',
+    'ArchiveUUID': '',
+    'StartTime': 0,
+    'Seconds': 0,
+    'PeakTracedBytes': 0,
+    'TopAllocations': []
+}
+
+MAX_PROFILES = 32
+TOP_ALLOCATIONS = 25
+
+_profiling_enabled = None
+
+
+def set_profiling(enabled):
+    """Turn profiling on or off for this process, None going back to the initialisation config."""
+    global _profiling_enabled
+    _profiling_enabled = enabled
+
+
+def is_profiling_enabled() -> bool:
+    """Tell if operations are profiled."""
+    if _profiling_enabled is not None:
+        return _profiling_enabled
+    return bool(get_init_config().get('Profiling', False))
+
+
+class ProfileAgent:
+    """Agent for the profiles of an archive, kept as pstats files with a JSON summary of allocations."""
+
+    def __init__(self, archive_dir: str):
+        """Create the agent for an archive."""
+        self.profiles_dir = os.path.join(archive_dir, 'meta', 'profiles')
+        self.active = False
+
+    @contextlib.contextmanager
+    def profile(self, operation: str, archive_uuid: str = ''):
+        """Profile the enclosed block if profiling is on.
+        Nested blocks belong to the outer profile."""
+        if self.active or not is_profiling_enabled():
+            yield
+            return
+        self.active = True
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        profiler = cProfile.Profile()
+        start_time = time.time()
+        try:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            if not was_tracing:
+                tracemalloc.stop()
+            self.active = False
+
+        profile = dict(PROFILE_TEMPLATE, Operation=operation, ArchiveUUID=archive_uuid, StartTime=start_time,
+                       Seconds=time.time() - start_time, PeakTracedBytes=peak, TopAllocations=[])
+        for statistic in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+            frame = statistic.traceback[0]
+            profile['TopAllocations'].append({'File': frame.filename, 'Line': frame.lineno,
+                                              'Bytes': statistic.size, 'Count': statistic.count})
+        self.save(profile, profiler)
+
+    def save(self, profile: dict, profiler: cProfile.Profile):
+        """Save a profile under a timestamped name and drop the oldest ones."""
+        os.makedirs(self.profiles_dir, exist_ok=True)
+        name = '%s_%s' % (time.strftime('%Y%m%d-%H%M%S', time.localtime(profile['StartTime'])), profile['Operation'])
+        base_path = os.path.join(self.profiles_dir, name)
+        suffix = 1
+        while os.path.exists(base_path + '.pstats'):
+            suffix += 1
+            base_path = os.path.join(self.profiles_dir, '%s-%s' % (name, suffix))
+        profiler.dump_stats(base_path + '.pstats')
+        with open(base_path + '.json', mode='w', encoding='utf-8') as raw_profile:
+            json.dump(profile, raw_profile, indent=2)
+        for old_name in self.get_profile_names()[:-MAX_PROFILES]:
+            for extension in ('.pstats', '.json'):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.profiles_dir, old_name + extension))
+        ABUNDANT_LOGGER.info('Saved profile of %s to %s', profile['Operation'], base_path)
+
+    def get_profile_names(self) -> list:
+        """Get the names of saved profiles, from oldest to latest."""
+        if not os.path.isdir(self.profiles_dir):
+            return []
+        names = [file[:-len('.json')] for file in os.listdir(self.profiles_dir) if file.endswith('.json')]
+        return sorted(names, key=lambda name: (os.path.getmtime(os.path.join(self.profiles_dir, name + '.json')),
+                                               name))
+
+    def summarise(self, number_of_profiles: int = 3, top: int = 15) -> list:
+        """Summarise the latest profiles, latest first: duration, peak memory, the functions with
+        the highest cumulative time and the largest allocation sites. A count of zero or less summarises none."""
+        summaries = []
+        if number_of_profiles <= 0:
+            return summaries
+        for name in reversed(self.get_profile_names()[-number_of_profiles:]):
+            with open(os.path.join(self.profiles_dir, name + '.json'), mode='r', encoding='utf-8') as raw_profile:
+                profile = json.load(raw_profile)
+            stats = pstats.Stats(os.path.join(self.profiles_dir, name + '.pstats'))
+            functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+            summaries.append({
+                'Name': name,
+                'Operation': profile['Operation'],
+                'StartTime': profile['StartTime'],
+                'Seconds': profile['Seconds'],
+                'PeakTracedBytes': profile['PeakTracedBytes'],
+                'TopFunctions': [{'Function': pstats.func_std_string(function), 'Calls': number_of_calls,
+                                  'TotalSeconds': total_seconds, 'CumulativeSeconds': cumulative_seconds}
+                                 for function, (primitive_calls, number_of_calls, total_seconds, cumulative_seconds,
+                                                callers) in functions],
+                'TopAllocations': profile['TopAllocations'][:top]
+            })
+        return summaries
@@ -0,0 +1,181 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Progress reporting and cancellation of long operations.
+"""
+
+import sys
+import time
+import signal
+import threading
+import contextlib
+
+__author__ = 'Kevin'
+
+PROGRESS_SNAPSHOT_TEMPLATE = {
+    'Operation': '',
+    'FilesDone': 0,
+    'TotalFiles': 0,
+    'BytesDone': 0,
+    'TotalBytes': 0,
+    'Seconds': 0,
+    'FilesPerSecond': 0,
+    'BytesPerSecond': 0,
+    'ETA': None
+}
+
+
+class OperationCancelled(Exception):
+    """Raised at a safe point once an operation has been cancelled."""
+    pass
+
+
+class CancellationToken:
+    """Token another thread or a signal handler sets to stop an operation at its next safe point."""
+
+    def __init__(self):
+        """Create the token."""
+        self.event = threading.Event()
+
+    def cancel(self):
+        """Ask the operation to stop."""
+        self.event.set()
+
+    @property
+    def is_cancelled(self) -> bool:
+        """Tell if cancellation has been asked for."""
+        return self.event.is_set()
+
+    def check(self):
+        """Raise if cancellation has been asked for."""
+        if self.event.is_set():
+            raise OperationCancelled('Operation cancelled')
+
+
+def check_cancellation(cancellation):
+    """Raise if a token, which may be None, has been cancelled.
+    :type cancellation: CancellationToken"""
+    if cancellation is not None:
+        cancellation.check()
+
+
+@contextlib.contextmanager
+def cancel_on_interrupt(cancellation: CancellationToken):
+    """Turn Ctrl-C in the enclosed block into a cancellation instead of an exception at an arbitrary point.
+    Does nothing outside the main thread, where signal handlers cannot be installed."""
+    if threading.current_thread() is not threading.main_thread():
+        yield cancellation
+        return
+    previous_handler = signal.signal(signal.SIGINT, lambda signal_number, frame: cancellation.cancel())
+    try:
+        yield cancellation
+    finally:
+        signal.signal(signal.SIGINT, previous_handler)
+
+
+class ProgressReporter:
+    """Thread-safe progress of an operation in files and bytes out of an estimated total.
+    Subclasses present it by overriding on_update and on_finish."""
+
+    def __init__(self):
+        """Create the reporter."""
+        self.lock = threading.Lock()
+        self.operation = ''
+        self.total_files = self.total_bytes = self.files_done = self.bytes_done = 0
+        self.start_time = time.time()
+
+    def start(self, operation: str, total_files: int = 0, total_bytes: int = 0):
+        """Start reporting an operation with its estimated total."""
+        with self.lock:
+            self.operation = operation
+            self.total_files, self.total_bytes = total_files, total_bytes
+            self.files_done = self.bytes_done = 0
+            self.start_time = time.time()
+        self.on_update(self.snapshot())
+
+    def advance(self, files: int = 0, number_of_bytes: int = 0):
+        """Record some work as done."""
+        with self.lock:
+            self.files_done += files
+            self.bytes_done += number_of_bytes
+        self.on_update(self.snapshot())
+
+    def finish(self):
+        """Tell that the operation is over."""
+        self.on_finish(self.snapshot())
+
+    def snapshot(self) -> dict:
+        """Get the progress with rates and the estimated seconds left, None if unknown."""
+        with self.lock:
+            snapshot = dict(PROGRESS_SNAPSHOT_TEMPLATE, Operation=self.operation, FilesDone=self.files_done,
+                            TotalFiles=max(self.total_files, self.files_done), BytesDone=self.bytes_done,
+                            TotalBytes=max(self.total_bytes, self.bytes_done), Seconds=time.time() - self.start_time)
+        if snapshot['Seconds'] > 0:
+            snapshot['FilesPerSecond'] = snapshot['FilesDone'] / snapshot['Seconds']
+            snapshot['BytesPerSecond'] = snapshot['BytesDone'] / snapshot['Seconds']
+        if snapshot['TotalBytes'] and snapshot['BytesPerSecond']:
+            snapshot['ETA'] = (snapshot['TotalBytes'] - snapshot['BytesDone']) / snapshot['BytesPerSecond']
+        elif snapshot['TotalFiles'] and snapshot['FilesPerSecond']:
+            snapshot['ETA'] = (snapshot['TotalFiles'] - snapshot['FilesDone']) / snapshot['FilesPerSecond']
+        return snapshot
+
+    def on_update(self, snapshot: dict):
+        """Called after every change of progress."""
+        pass
+
+    def on_finish(self, snapshot: dict):
+        """Called once the operation is over."""
+        pass
+
+
+def _format_bytes(number_of_bytes: float) -> str:
+    """Format a byte count with a binary unit."""
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if number_of_bytes < 1024 or unit == 'TiB':
+            return '%.1f %s' % (number_of_bytes, unit)
+        number_of_bytes /= 1024
+
+
+def _format_seconds(seconds) -> str:
+    """Format a duration as h:mm:ss, -:--:-- if unknown."""
+    if seconds is None:
+        return '-:--:--'
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class CLIProgressBar(ProgressReporter):
+    """Progress bar redrawn on a terminal line at most once per interval."""
+
+    def __init__(self, stream=None, interval: float = 0.2, width: int = 30):
+        """Create the bar, drawn on standard error by default."""
+        super(CLIProgressBar, self).__init__()
+        self.stream = stream or sys.stderr
+        self.interval, self.width = interval, width
+        self.last_draw_time = 0
+
+    def draw(self, snapshot: dict):
+        """Draw the bar."""
+        if snapshot['TotalBytes']:
+            fraction = snapshot['BytesDone'] / snapshot['TotalBytes']
+        else:
+            fraction = snapshot['FilesDone'] / snapshot['TotalFiles'] if snapshot['TotalFiles'] else 0
+        filled = int(self.width * fraction)
+        self.stream.write('\r%s [%s%s] %3d%% %s/%s file(s) %s/%s %s/s ETA %s ' % (
+            snapshot['Operation'], '#' * filled, '.' * (self.width - filled), fraction * 100,
+            snapshot['FilesDone'], snapshot['TotalFiles'], _format_bytes(snapshot['BytesDone']),
+            _format_bytes(snapshot['TotalBytes']), _format_bytes(snapshot['BytesPerSecond']),
+            _format_seconds(snapshot['ETA'])))
+        self.stream.flush()
+
+    def on_update(self, snapshot: dict):
+        now = time.time()
+        if now - self.last_draw_time >= self.interval:
+            self.last_draw_time = now
+            self.draw(snapshot)
+
+    def on_finish(self, snapshot: dict):
+        self.draw(snapshot)
+        self.stream.write('\n')
+        self.stream.flush()
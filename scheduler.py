@@ -0,0 +1,207 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Scheduler running due backups of many archives in a worker pool.
+"""
+
+import os
+import time
+import argparse
+import concurrent.futures
+
+from master_config import MasterConfigAgent
+from config import get_config, create_config
+from log import ABUNDANT_LOGGER, configure_logging, flush_logging
+
+__author__ = 'Kevin'
+
+SCHEDULE_HISTORY_TEMPLATE = {
+    'ScheduleHistoryVersion': 0.1,
+    'Runs': {}
+}
+
+RUN_RECORD_TEMPLATE = {
+    'StartTime': 0,
+    'EndTime': 0,
+    'Succeeded': False,
+    'Version': '',
+    'Error': ''
+}
+
+MAX_RUN_RECORDS_PER_ARCHIVE = 32
+
+
+def run_backup_job(archive_dir: str) -> str:
+    """Create a new version for the archive in a worker process.
+    Returns the UUID of the new version."""
+    from archive import ArchiveAgent
+    configure_logging()
+    try:
+        archive = ArchiveAgent(archive_dir)
+        return archive.create_version().uuid
+    finally:
+        # worker processes exit without running atexit hooks
+        flush_logging()
+
+
+class ScheduleHistoryAgent:
+    """Agent for the persisted history of scheduled runs."""
+
+    def __init__(self, history_path: str):
+        """Create the agent from the path of the history file."""
+        self.history_path = history_path
+        if not os.path.exists(self.history_path):
+            create_config(SCHEDULE_HISTORY_TEMPLATE, self.history_path)
+            ABUNDANT_LOGGER.debug('Created schedule history')
+
+    def get_runs(self, archive_uuid: str) -> list:
+        """Get all runs of an archive, from oldest to latest."""
+        with get_config(self.history_path) as history:
+            return history['Runs'].get(archive_uuid, [])
+
+    def get_last_successful_run(self, archive_uuid: str) -> dict:
+        """Get the latest successful run of an archive."""
+        for run in reversed(self.get_runs(archive_uuid)):
+            if run['Succeeded']:
+                return run
+        return None
+
+    def add_run(self, archive_uuid: str, run: dict):
+        """Append a run of an archive and drop the oldest ones."""
+        with get_config(self.history_path, save_change=True) as history:
+            runs = history['Runs'].setdefault(archive_uuid, [])
+            runs.append(run)
+            del runs[:-MAX_RUN_RECORDS_PER_ARCHIVE]
+
+    def forget(self, archive_uuid: str):
+        """Remove all runs of an archive."""
+        with get_config(self.history_path, save_change=True) as history:
+            history['Runs'].pop(archive_uuid, None)
+
+
+class SchedulerAgent:
+    """Scheduler runs due versions of all archives in the master config."""
+
+    def __init__(self, max_workers=None, max_jobs_per_device=None):
+        """Create the scheduler."""
+        self.master_config = MasterConfigAgent()
+        self.max_workers = max_workers or self.master_config.get('SchedulerMaxWorkers')
+        self.max_jobs_per_device = max_jobs_per_device or self.master_config.get('SchedulerMaxJobsPerDevice')
+        if self.max_workers < 1 or self.max_jobs_per_device < 1:
+            ABUNDANT_LOGGER.error('Scheduler needs at least one worker and one job per device')
+            raise ValueError('Scheduler needs at least one worker and one job per device')
+        self.history = ScheduleHistoryAgent(
+            os.path.join(self.master_config.master_config_dir, 'schedule_history.json'))
+
+    def _get_last_backup_time(self, archive_record: dict) -> float:
+        """Get the time of the last backup of an archive, from history or from its versions."""
+        last_run = self.history.get_last_successful_run(archive_record['UUID'])
+        if last_run is not None:
+            return last_run['StartTime']
+
+        # no history yet, fall back to the latest version in the archive
+        from archive import ArchiveAgent
+        archive = ArchiveAgent(archive_record['ArchiveDirectory'])
+        return archive.last_version.time_of_creation if archive.versions else 0
+
+    def _get_backup_interval(self, archive_record: dict) -> float:
+        """Get the backup interval of an archive from its config."""
+        from archive import ARCHIVE_CONFIG_TEMPLATE
+        archive_config_path = os.path.join(archive_record['ArchiveDirectory'], 'meta', 'archive_config.json')
+        with get_config(archive_config_path) as archive_config:
+            return archive_config.get('BackupInterval', ARCHIVE_CONFIG_TEMPLATE['BackupInterval'])
+
+    def get_due_archives(self, now=None) -> list:
+        """Get records of archives whose backup interval has elapsed, most overdue first."""
+        now = now or time.time()
+        due_archives = []
+        for archive_record in self.master_config.archive_records:
+            try:
+                overdue = now - self._get_last_backup_time(archive_record) - self._get_backup_interval(archive_record)
+            except (OSError, ValueError) as e:
+                ABUNDANT_LOGGER.error('Cannot schedule archive %s: %s', archive_record['UUID'], e)
+                continue
+            if overdue >= 0:
+                due_archives.append((overdue, archive_record))
+        due_archives.sort(key=lambda x: x[0], reverse=True)
+        ABUNDANT_LOGGER.debug('Found %s due archive(s)', len(due_archives))
+        return [archive_record for overdue, archive_record in due_archives]
+
+    @staticmethod
+    def _get_device(archive_record: dict):
+        """Get the device the source directory of an archive lives on."""
+        try:
+            return os.stat(archive_record['SourceDirectory']).st_dev
+        except OSError:
+            # unknown devices do not share a cap with anything else
+            return 'unknown-%s' % archive_record['UUID']
+
+    def run_due_jobs(self, now=None) -> dict:
+        """Run all due jobs in a process pool, honouring the per-device cap.
+        Returns run records keyed by archive UUID."""
+        pending = self.get_due_archives(now)
+        if not pending:
+            return {}
+        ABUNDANT_LOGGER.info('Running %s scheduled backup(s) with %s worker(s)', len(pending), self.max_workers)
+
+        runs, running, jobs_per_device = {}, {}, {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                # submit every pending job whose device still has a free slot
+                for archive_record in list(pending):
+                    if len(running) >= self.max_workers:
+                        break
+                    device = self._get_device(archive_record)
+                    if jobs_per_device.get(device, 0) >= self.max_jobs_per_device:
+                        continue
+                    pending.remove(archive_record)
+                    jobs_per_device[device] = jobs_per_device.get(device, 0) + 1
+                    future = executor.submit(run_backup_job, archive_record['ArchiveDirectory'])
+                    running[future] = (archive_record, device, time.time())
+                    ABUNDANT_LOGGER.debug('Scheduled backup of archive %s', archive_record['UUID'])
+
+                # wait for at least one job to finish to free its slot
+                done, not_done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    archive_record, device, start_time = running.pop(future)
+                    jobs_per_device[device] -= 1
+                    runs[archive_record['UUID']] = self._record_run(archive_record, future, start_time)
+        return runs
+
+    def _record_run(self, archive_record: dict, future: concurrent.futures.Future, start_time: float) -> dict:
+        """Persist the outcome of a finished job."""
+        run = dict(RUN_RECORD_TEMPLATE)
+        run.update({'StartTime': start_time, 'EndTime': time.time()})
+        try:
+            run.update({'Succeeded': True, 'Version': future.result()})
+            ABUNDANT_LOGGER.info('Scheduled backup of archive %s created version %s', archive_record['UUID'],
+                                 run['Version'])
+        except Exception as e:
+            run['Error'] = '%s: %s' % (type(e).__name__, e)
+            ABUNDANT_LOGGER.error('Scheduled backup of archive %s failed: %s', archive_record['UUID'], run['Error'])
+        self.history.add_run(archive_record['UUID'], run)
+        return run
+
+    def run_forever(self, poll_interval: float = 60):
+        """Keep running due jobs, checking every poll interval."""
+        ABUNDANT_LOGGER.info('Scheduler started')
+        while True:
+            self.run_due_jobs()
+            time.sleep(poll_interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run due backups of all archives.')
+    parser.add_argument('--once', action='store_true', help='run due backups once and exit')
+    parser.add_argument('--workers', type=int, default=None, help='size of the worker pool')
+    parser.add_argument('--jobs-per-device', type=int, default=None, help='concurrent jobs per source device')
+    parser.add_argument('--poll-interval', type=float, default=60, help='seconds between two checks')
+    arguments = parser.parse_args()
+
+    configure_logging()
+    scheduler = SchedulerAgent(arguments.workers, arguments.jobs_per_device)
+    if arguments.once:
+        scheduler.run_due_jobs()
+    else:
+        scheduler.run_forever(arguments.poll_interval)
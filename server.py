@@ -0,0 +1,291 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Read-only HTTP service for browsing and downloading archived files.
+"""
+
+import os
+import re
+import json
+import argparse
+import threading
+import collections
+import http.server
+import urllib.parse
+
+from abundant import Abundant
+from support import COPY_CHUNK_SIZE
+from log import ABUNDANT_LOGGER, configure_logging
+
+__author__ = 'Kevin'
+
+DEFAULT_VIEW_CACHE_SIZE = 16
+
+
+class VersionView:
+    """Resolved view of a version: every effective file and a directory index."""
+
+    def __init__(self, version):
+        """Resolve a version.
+        :type version: VersionAgent"""
+        self.version = version
+        self.files = {}
+        self.directories = collections.defaultdict(lambda: (set(), []))
+        records = {}
+        for relative_path, absolute_path in version.files:
+            key = version.storage.key_of(absolute_path)
+            holder_uuid = key.split('/', 1)[0]
+            if holder_uuid not in records:
+                holder = version.archive_agent.get_version(holder_uuid)
+                records[holder_uuid] = holder.manifest_records if holder else {}
+            record = records[holder_uuid].get(relative_path)
+            relative_path = relative_path.replace(os.sep, '/')
+            self.files[relative_path] = (key, record['Size'] if record else None,
+                                         record['Digest'] if record else '', record['MTime'] if record else 0)
+
+            # register the file in its directory and the directory in all its parents
+            parent, name = relative_path.rpartition('/')[::2]
+            self.directories[parent][1].append(name)
+            while parent:
+                grandparent, directory_name = parent.rpartition('/')[::2]
+                if directory_name in self.directories[grandparent][0]:
+                    break
+                self.directories[grandparent][0].add(directory_name)
+                parent = grandparent
+        self.directories = dict(self.directories)
+
+    def get_size(self, relative_path: str) -> int:
+        """Get the size of a file, asking storage only when the manifest does not know it."""
+        key, size, digest, modification_time = self.files[relative_path]
+        return size if size is not None else self.version.storage.size(key)
+
+
+class VersionViewCache:
+    """Thread-safe LRU cache of version views.
+    Entries are keyed by the modification time of the version config so migrations invalidate them."""
+
+    def __init__(self, capacity: int = DEFAULT_VIEW_CACHE_SIZE):
+        """Create the cache."""
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.views = collections.OrderedDict()
+        self.archives = {}
+
+    def get_archive(self, archive_uuid: str):
+        """Get an up to date archive agent, None if there is no such archive.
+        :rtype: ArchiveAgent"""
+        archive_record = Abundant.master_config.get_archive_record(uuid=archive_uuid)
+        if archive_record is None:
+            return None
+        version_config_path = os.path.join(archive_record['ArchiveDirectory'], 'meta', 'version_config.json')
+        generation = os.stat(version_config_path).st_mtime_ns if os.path.exists(version_config_path) else 0
+        with self.lock:
+            cached = self.archives.get(archive_uuid)
+            if cached is None or cached[0] != generation:
+                cached = self.archives[archive_uuid] = (generation, Abundant.get_archive(uuid=archive_uuid))
+        return cached[1]
+
+    def get_view(self, archive_uuid: str, version_uuid: str) -> VersionView:
+        """Get the view of a version, resolving it on a miss. None if there is no such version."""
+        archive = self.get_archive(archive_uuid)
+        if archive is None:
+            return None
+        generation = self.archives[archive_uuid][0]
+        cache_key = (archive_uuid, version_uuid, generation)
+        with self.lock:
+            if cache_key in self.views:
+                self.views.move_to_end(cache_key)
+                return self.views[cache_key]
+        version = archive.get_version(version_uuid)
+        if version is None:
+            return None
+        view = VersionView(version)
+        with self.lock:
+            self.views[cache_key] = view
+            while len(self.views) > self.capacity:
+                self.views.popitem(last=False)
+        ABUNDANT_LOGGER.debug('Resolved view of version %s', version_uuid)
+        return view
+
+
+class BrowseRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handler for the read-only browse API.
+
+    GET /archives
+    GET /archives/<archive uuid>/versions
+    GET /archives/<archive uuid>/versions/<version uuid>/tree/<directory>
+    GET /archives/<archive uuid>/versions/<version uuid>/files/<path>"""
+
+    server_version = 'Abundant'
+    protocol_version = 'HTTP/1.1'
+    view_cache = None
+    """:type view_cache: VersionViewCache"""
+    headers_sent = False
+
+    def log_message(self, format, *args):
+        ABUNDANT_LOGGER.debug('%s %s', self.address_string(), format % args)
+
+    def end_headers(self):
+        super(BrowseRequestHandler, self).end_headers()
+        self.headers_sent = True
+
+    def send_json(self, content, status: int = 200):
+        """Send a JSON response."""
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_error_json(self, status: int, message: str):
+        """Send an error as JSON."""
+        self.send_json({'Error': message}, status)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        parts = [urllib.parse.unquote(part) for part in urllib.parse.urlsplit(self.path).path.split('/') if part]
+        # the handler serves every request of a kept alive connection
+        self.headers_sent = False
+        try:
+            if parts == ['archives']:
+                return self.send_json(Abundant.get_all_archives())
+            if len(parts) >= 3 and parts[0] == 'archives' and parts[2] == 'versions':
+                if len(parts) == 3:
+                    return self.list_versions(parts[1])
+                if len(parts) >= 5 and parts[4] in ('tree', 'files'):
+                    view = self.view_cache.get_view(parts[1], parts[3])
+                    if view is None:
+                        return self.send_error_json(404, 'No such archive or version')
+                    relative_path = '/'.join(parts[5:])
+                    if parts[4] == 'tree':
+                        return self.list_directory(view, relative_path)
+                    return self.send_file(view, relative_path)
+            self.send_error_json(404, 'Unknown resource')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            ABUNDANT_LOGGER.error('Failed to serve %s: %s', self.path, e)
+            if self.headers_sent:
+                # a started response cannot turn into an error, so the client sees it cut short instead
+                self.close_connection = True
+            else:
+                self.send_error_json(500, str(e))
+
+    def do_POST(self):
+        self.send_error_json(405, 'Service is read-only')
+
+    do_PUT = do_DELETE = do_PATCH = do_POST
+
+    def list_versions(self, archive_uuid: str):
+        """List versions of an archive."""
+        archive = self.view_cache.get_archive(archive_uuid)
+        if archive is None:
+            return self.send_error_json(404, 'No such archive')
+        self.send_json([version.version_config for version in archive.versions])
+
+    def list_directory(self, view: VersionView, relative_path: str):
+        """List a directory of a version."""
+        if relative_path not in view.directories:
+            return self.send_error_json(404, 'No such directory')
+        directories, files = view.directories[relative_path]
+        prefix = relative_path + '/' if relative_path else ''
+        self.send_json({
+            'Directories': sorted(directories),
+            'Files': [{'Name': name, 'Size': view.get_size(prefix + name), 'Digest': view.files[prefix + name][2]}
+                      for name in sorted(files)]
+        })
+
+    def _parse_range(self, size: int):
+        """Parse a single byte range header into (start, end), inclusive.
+        Returns None for the whole file and False when unsatisfiable."""
+        header = self.headers.get('Range')
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip()) if header else None
+        if match is None or match.groups() == ('', ''):
+            return None
+        start, end = match.groups()
+        if start == '':
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+        if start > end or start >= size:
+            return False
+        return start, end
+
+    def send_file(self, view: VersionView, relative_path: str):
+        """Send a file, honouring Range, If-None-Match and If-Range."""
+        if relative_path not in view.files:
+            return self.send_error_json(404, 'No such file')
+        key, size, digest, modification_time = view.files[relative_path]
+        size = view.get_size(relative_path)
+        etag = '"%s"' % digest if digest else 'W/"%s-%s"' % (key.split('/', 1)[0], size)
+
+        if self.headers.get('If-None-Match') in (etag, '*'):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        byte_range = self._parse_range(size)
+        if byte_range and self.headers.get('If-Range') not in (None, etag):
+            byte_range = None
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%s' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start, end = byte_range or (0, size - 1)
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        if modification_time:
+            self.send_header('Last-Modified', self.date_time_string(modification_time))
+        if byte_range:
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, size))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+
+        storage = view.version.storage
+        if not byte_range:
+            with storage.open(key) as stored_file:
+                chunk = stored_file.read(COPY_CHUNK_SIZE)
+                while chunk:
+                    self.wfile.write(chunk)
+                    chunk = stored_file.read(COPY_CHUNK_SIZE)
+            return
+        offset = start
+        while offset <= end:
+            chunk = storage.range_read(key, offset, min(COPY_CHUNK_SIZE, end - offset + 1))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            offset += len(chunk)
+
+
+def create_server(host: str = '127.0.0.1', port: int = 8080,
+                  view_cache_size: int = DEFAULT_VIEW_CACHE_SIZE) -> http.server.ThreadingHTTPServer:
+    """Create the browse server, which still has to be started with serve_forever."""
+    handler = type('BrowseRequestHandler', (BrowseRequestHandler,), {'view_cache': VersionViewCache(view_cache_size)})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    ABUNDANT_LOGGER.info('Browse service listening on %s:%s', *server.server_address[:2])
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve archives read-only over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_VIEW_CACHE_SIZE,
+                        help='number of resolved versions kept in memory')
+    arguments = parser.parse_args()
+    configure_logging()
+    create_server(arguments.host, arguments.port, arguments.cache_size).serve_forever()
@@ -0,0 +1,74 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Space taken by each version and by a whole archive, counted as files move instead of walking the versions.
+Files shared through the object pool are counted in every version storing them.
+"""
+
+__author__ = 'Kevin'
+
+VERSION_SPACE_TEMPLATE = {
+    'TotalFiles': 0,
+    'TotalBytes': 0,
+    'UniqueFiles': 0,
+    'UniqueBytes': 0,
+    'ReclaimableFiles': 0,
+    'ReclaimableBytes': 0
+}
+
+ARCHIVE_SPACE_TEMPLATE = {
+    'Versions': 0,
+    'TotalFiles': 0,
+    'TotalBytes': 0,
+    'StoredFiles': 0,
+    'StoredBytes': 0,
+    'ReclaimableFiles': 0,
+    'ReclaimableBytes': 0,
+    'MaxArchiveBytes': 0
+}
+
+
+class SpaceCounter:
+    """Counts the space of the latest version from the files it stores and deletes, starting from the view
+    of the previous version, and what merging the previous version into it would then free."""
+
+    def __init__(self, previous_version_uuid=None, previous_space=None):
+        """Create the counter for a version following another one, or for a base version."""
+        self.previous_version_uuid = previous_version_uuid
+        self.space = dict(VERSION_SPACE_TEMPLATE)
+        if previous_space is not None:
+            self.space.update(TotalFiles=previous_space['TotalFiles'], TotalBytes=previous_space['TotalBytes'])
+        self.overridden_files = self.overridden_bytes = 0
+
+    def replace(self, holder_uuid: str, size: int):
+        """Count a file of the previous view that is stored again or deleted, held by some version."""
+        self.space['TotalFiles'] -= 1
+        self.space['TotalBytes'] -= size
+        # only the copies held by the previous version itself go when it is merged into this one
+        if holder_uuid == self.previous_version_uuid:
+            self.overridden_files += 1
+            self.overridden_bytes += size
+
+    def store(self, size: int):
+        """Count a file stored in the version, which nothing follows to keep it yet."""
+        for name in ('Total', 'Unique', 'Reclaimable'):
+            self.space[name + 'Files'] += 1
+            self.space[name + 'Bytes'] += size
+
+
+def summarise_space(version_spaces: list, max_archive_bytes: int = 0) -> dict:
+    """Summarise the spaces of all versions of an archive, oldest first: the view of the latest, the files
+    stored in all of them and what migrating the oldest would free."""
+    summary = dict(ARCHIVE_SPACE_TEMPLATE, Versions=len(version_spaces), MaxArchiveBytes=max_archive_bytes)
+    if not version_spaces:
+        return summary
+    summary.update(TotalFiles=version_spaces[-1]['TotalFiles'], TotalBytes=version_spaces[-1]['TotalBytes'])
+    for space in version_spaces:
+        summary['StoredFiles'] += space['UniqueFiles']
+        summary['StoredBytes'] += space['UniqueBytes']
+    # the only version cannot be migrated anywhere
+    if len(version_spaces) > 1:
+        summary.update(ReclaimableFiles=version_spaces[0]['ReclaimableFiles'],
+                       ReclaimableBytes=version_spaces[0]['ReclaimableBytes'])
+    return summary
@@ -0,0 +1,544 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Storage backends holding version data.
+"""
+
+import os
+import io
+import stat
+import hmac
+import time
+import queue
+import shutil
+import hashlib
+import datetime
+import tempfile
+import threading
+import urllib.parse
+import concurrent.futures
+from typing import TYPE_CHECKING
+
+from log import ABUNDANT_LOGGER
+from support import copy_file, COPY_CHUNK_SIZE
+
+if TYPE_CHECKING:
+    import http.client
+
+__author__ = 'Kevin'
+
+STORAGE_CONFIG_TEMPLATE = {
+    'Type': 'local'
+}
+
+S3_STORAGE_CONFIG_TEMPLATE = {
+    'Type': 's3',
+    'Endpoint': 'https://s3.amazonaws.com',
+    'Region': 'us-east-1',
+    'Bucket': '',
+    'Prefix': '',
+    'AccessKey': '',
+    'SecretKey': '',
+    'MaxConnections': 8,
+    'MultipartThreshold': 64 * 1024 * 1024,
+    'PartSize': 16 * 1024 * 1024,
+    'MaxRetries': 5
+}
+
+
+class StorageError(OSError):
+    """Storage error, raised when a backend cannot complete an operation."""
+
+
+class StorageBackend:
+    """Interface of storage backends.
+    Keys are relative, slash separated paths such as <version uuid>/<relative path>."""
+
+    def put(self, key: str, source_path: str, throttle=None):
+        """Store a local file under a key."""
+        raise NotImplementedError
+
+    def get(self, key: str, destination_path: str, throttle=None):
+        """Fetch the object under a key into a local file."""
+        raise NotImplementedError
+
+    def open(self, key: str):
+        """Open the object under a key as a binary file-like object."""
+        raise NotImplementedError
+
+    def range_read(self, key: str, offset: int, length: int) -> bytes:
+        """Read at most length bytes starting at offset."""
+        raise NotImplementedError
+
+    def list(self, prefix: str = ''):
+        """Generator for all keys starting with a prefix."""
+        raise NotImplementedError
+
+    def list_sizes(self, prefix: str = ''):
+        """Generator for (key, size) of all objects whose key starts with a prefix."""
+        for key in self.list(prefix):
+            yield key, self.size(key)
+
+    def exists(self, key: str) -> bool:
+        """Tell if an object exists under a key."""
+        raise NotImplementedError
+
+    def mode(self, key: str):
+        """Get the permission bits of the object under a key, None if the backend does not keep them."""
+        return None
+
+    def size(self, key: str) -> int:
+        """Get the size of the object under a key."""
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        """Delete the object under a key."""
+        raise NotImplementedError
+
+    def move(self, key: str, new_key: str):
+        """Move an object to another key."""
+        raise NotImplementedError
+
+    def delete_prefix(self, prefix: str):
+        """Delete every object whose key starts with a prefix."""
+        for key in list(self.list(prefix)):
+            self.delete(key)
+
+    def create_prefix(self, prefix: str):
+        """Prepare a prefix before objects are put under it, keeping it even while it holds none."""
+
+    def list_prefixes(self, prefix: str):
+        """Iterate over the kept prefixes, each ending with a slash, under a prefix ending with a slash.
+        Backends not keeping prefixes have none."""
+        return iter(())
+
+    def locate(self, key: str) -> str:
+        """Get the location of a key, as shown to users and accepted by key_of."""
+        raise NotImplementedError
+
+    def key_of(self, location: str) -> str:
+        """Get the key of a location returned by locate."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release resources held by the backend."""
+
+
+class LocalStorageBackend(StorageBackend):
+    """Backend storing objects as files under a local directory."""
+
+    def __init__(self, root_dir: str):
+        """Create the backend from its root directory."""
+        self.root_dir = root_dir
+
+    def locate(self, key: str) -> str:
+        return os.path.join(self.root_dir, *key.split('/'))
+
+    def key_of(self, location: str) -> str:
+        return os.path.relpath(location, self.root_dir).replace(os.sep, '/')
+
+    def put(self, key: str, source_path: str, throttle=None):
+        destination_path = self.locate(key)
+        os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+        # replace rather than overwrite, as the file may be a hard link shared with other archives
+        if os.path.lexists(destination_path):
+            os.remove(destination_path)
+        copy_file(source_path, destination_path, throttle)
+
+    def get(self, key: str, destination_path: str, throttle=None):
+        copy_file(self.locate(key), destination_path, throttle)
+
+    def open(self, key: str):
+        return open(self.locate(key), mode='rb')
+
+    def range_read(self, key: str, offset: int, length: int) -> bytes:
+        with open(self.locate(key), mode='rb') as file:
+            file.seek(offset)
+            return file.read(length)
+
+    def list(self, prefix: str = ''):
+        # walk the deepest directory covered by the prefix
+        # and filter the rest of the prefix on keys
+        prefix_dir = prefix[:prefix.rfind('/') + 1]
+        for root_dir, dirs, files in os.walk(self.locate(prefix_dir.rstrip('/')) if prefix_dir else self.root_dir):
+            for file in files:
+                key = self.key_of(os.path.join(root_dir, file))
+                if key.startswith(prefix):
+                    yield key
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.locate(key))
+
+    def size(self, key: str) -> int:
+        return os.path.getsize(self.locate(key))
+
+    def mode(self, key: str) -> int:
+        return stat.S_IMODE(os.stat(self.locate(key)).st_mode)
+
+    def delete(self, key: str):
+        os.remove(self.locate(key))
+
+    def move(self, key: str, new_key: str):
+        new_location = self.locate(new_key)
+        os.makedirs(os.path.dirname(new_location), exist_ok=True)
+        shutil.move(self.locate(key), new_location)
+
+    def delete_prefix(self, prefix: str):
+        if prefix.endswith('/') and os.path.isdir(self.locate(prefix.rstrip('/'))):
+            shutil.rmtree(self.locate(prefix.rstrip('/')))
+        else:
+            super(LocalStorageBackend, self).delete_prefix(prefix)
+
+    def create_prefix(self, prefix: str):
+        os.makedirs(self.locate(prefix.rstrip('/')), exist_ok=True)
+
+    def list_prefixes(self, prefix: str):
+        for root_dir, dirs, files in os.walk(self.locate(prefix.rstrip('/'))):
+            for directory in dirs:
+                yield self.key_of(os.path.join(root_dir, directory)) + '/'
+
+    def __str__(self):
+        return 'LocalStorageBackend at %s' % self.root_dir
+
+
+class _S3Response(io.RawIOBase):
+    """Readable body of an S3 response which gives its connection back to the pool when closed."""
+
+    def __init__(self, response: 'http.client.HTTPResponse', connection, backend: 'S3StorageBackend'):
+        super(_S3Response, self).__init__()
+        self.response, self.connection, self.backend = response, connection, backend
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        return self.response.readinto(buffer)
+
+    def close(self):
+        if not self.closed and self.connection is not None:
+            # only a fully consumed response leaves the connection reusable
+            self.backend._release_connection(self.connection, reusable=self.response.isclosed())
+            self.connection = None
+        super(_S3Response, self).close()
+
+
+class S3StorageBackend(StorageBackend):
+    """Backend storing objects in an S3-compatible object store.
+    Connections are pooled, large objects are uploaded in concurrent parts
+    and failed requests are retried with exponential back-off."""
+
+    def __init__(self, storage_config: dict):
+        """Create the backend from the storage section of an archive config."""
+        storage_config = dict(S3_STORAGE_CONFIG_TEMPLATE, **storage_config)
+        endpoint = urllib.parse.urlsplit(storage_config['Endpoint'])
+        if endpoint.scheme not in ('http', 'https') or not endpoint.netloc:
+            raise ValueError('Invalid S3 endpoint: %s' % storage_config['Endpoint'])
+        if not storage_config['Bucket']:
+            raise ValueError('S3 bucket must be provided')
+        self.scheme, self.host = endpoint.scheme, endpoint.netloc
+        self.region, self.bucket = storage_config['Region'], storage_config['Bucket']
+        self.prefix = storage_config['Prefix'].strip('/')
+        self.access_key = storage_config['AccessKey'] or os.environ.get('AWS_ACCESS_KEY_ID', '')
+        self.secret_key = storage_config['SecretKey'] or os.environ.get('AWS_SECRET_ACCESS_KEY', '')
+        self.multipart_threshold = storage_config['MultipartThreshold']
+        self.part_size = max(storage_config['PartSize'], 5 * 1024 * 1024)
+        self.max_retries = storage_config['MaxRetries']
+        self.max_connections = storage_config['MaxConnections']
+        self.connection_pool = queue.LifoQueue()
+        self.connection_semaphore = threading.BoundedSemaphore(self.max_connections)
+
+    def __str__(self):
+        return 'S3StorageBackend at %s://%s/%s/%s' % (self.scheme, self.host, self.bucket, self.prefix)
+
+    # connection pool
+
+    def _acquire_connection(self):
+        """Take an idle connection or open a new one, at most MaxConnections at a time."""
+        import http.client
+        self.connection_semaphore.acquire()
+        try:
+            return self.connection_pool.get_nowait()
+        except queue.Empty:
+            connection_class = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+            return connection_class(self.host, timeout=60)
+
+    def _release_connection(self, connection, reusable=True):
+        """Give a connection back to the pool."""
+        if reusable:
+            self.connection_pool.put(connection)
+        else:
+            connection.close()
+        self.connection_semaphore.release()
+
+    def close(self):
+        while True:
+            try:
+                self.connection_pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    # request signing
+
+    def _get_object_path(self, key: str) -> str:
+        """Get the path-style request path of a key."""
+        object_name = '/'.join(part for part in (self.prefix, key) if part)
+        return '/%s/%s' % (self.bucket, urllib.parse.quote(object_name, safe='/~'))
+
+    def _sign(self, method: str, path: str, query: dict, headers: dict):
+        """Add AWS signature version 4 headers to a request."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date, date_stamp = now.strftime('%Y%m%dT%H%M%SZ'), now.strftime('%Y%m%d')
+        headers.update({'host': self.host, 'x-amz-date': amz_date})
+        headers.setdefault('x-amz-content-sha256', 'UNSIGNED-PAYLOAD')
+
+        canonical_query = '&'.join('%s=%s' % (urllib.parse.quote(str(name), safe='-_.~'),
+                                              urllib.parse.quote(str(value), safe='-_.~'))
+                                   for name, value in sorted(query.items()))
+        signed_headers = sorted(name.lower() for name in headers)
+        lowered_headers = {name.lower(): str(value).strip() for name, value in headers.items()}
+        canonical_request = '\n'.join([
+            method, path, canonical_query,
+            ''.join('%s:%s\n' % (name, lowered_headers[name]) for name in signed_headers),
+            ';'.join(signed_headers), lowered_headers['x-amz-content-sha256']
+        ])
+        scope = '%s/%s/s3/aws4_request' % (date_stamp, self.region)
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                    hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+
+        signing_key = ('AWS4' + self.secret_key).encode('utf-8')
+        for part in (date_stamp, self.region, 's3', 'aws4_request'):
+            signing_key = hmac.new(signing_key, part.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        headers['Authorization'] = 'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s' % (
+            self.access_key, scope, ';'.join(signed_headers), signature)
+
+    def _request(self, method: str, key=None, query=None, headers=None, body=None, stream=False,
+                 expected_statuses=(200, 204, 206)):
+        """Send a request with retries.
+        Returns (status, headers, body), where body is a readable stream if asked to."""
+        import http.client
+        path = self._get_object_path(key) if key is not None else '/%s' % self.bucket
+        query = query or {}
+        url = path + ('?' + urllib.parse.urlencode(sorted(query.items())) if query else '')
+
+        for attempt in range(self.max_retries + 1):
+            request_headers = dict(headers or {})
+            self._sign(method, path, query, request_headers)
+            if isinstance(body, io.IOBase):
+                body.seek(0)
+            connection = self._acquire_connection()
+            try:
+                connection.request(method, url, body=body, headers=request_headers)
+                response = connection.getresponse()
+            except (OSError, http.client.HTTPException) as e:
+                self._release_connection(connection, reusable=False)
+                error = e
+            else:
+                if response.status in expected_statuses or response.status in (404, 416):
+                    if stream and response.status in expected_statuses:
+                        return response.status, response.headers, _S3Response(response, connection, self)
+                    response_body = response.read()
+                    self._release_connection(connection)
+                    return response.status, response.headers, response_body
+                response_body = response.read()
+                self._release_connection(connection)
+                error = StorageError('S3 %s %s returned %s: %s' % (method, url, response.status,
+                                                                   response_body[:256].decode('utf-8', 'replace')))
+                # client errors other than throttling will not go away by retrying
+                if response.status < 500 and response.status != 429:
+                    raise error
+
+            if attempt < self.max_retries:
+                delay = min(0.2 * 2 ** attempt, 10)
+                ABUNDANT_LOGGER.warning('S3 %s %s failed (%s), retrying in %.1fs', method, url, error, delay)
+                time.sleep(delay)
+        ABUNDANT_LOGGER.error('S3 %s %s failed after %s attempt(s)', method, url, self.max_retries + 1)
+        raise StorageError('S3 %s %s failed: %s' % (method, url, error))
+
+    @staticmethod
+    def _raise_if_missing(status: int, key: str):
+        """Turn a 404 into FileNotFoundError."""
+        if status == 404:
+            raise FileNotFoundError('Object not found: %s' % key)
+
+    # objects
+
+    def locate(self, key: str) -> str:
+        return 's3://%s/%s' % (self.bucket, '/'.join(part for part in (self.prefix, key) if part))
+
+    def key_of(self, location: str) -> str:
+        object_name = location.replace('s3://%s/' % self.bucket, '', 1)
+        return object_name[len(self.prefix) + 1:] if self.prefix else object_name
+
+    def put(self, key: str, source_path: str, throttle=None):
+        size = os.path.getsize(source_path)
+        if throttle:
+            throttle.consume(number_of_files=1)
+        if size < self.multipart_threshold:
+            with open(source_path, mode='rb') as source_file:
+                body = source_file.read()
+            if throttle:
+                throttle.consume(number_of_bytes=len(body))
+            status, headers, response_body = self._request('PUT', key, body=body)
+        else:
+            self._put_multipart(key, source_path, size, throttle)
+
+    def _put_multipart(self, key: str, source_path: str, size: int, throttle=None):
+        """Upload a large file in concurrent parts."""
+        status, headers, response_body = self._request('POST', key, query={'uploads': ''})
+        upload_id = self._find_xml_text(response_body, 'UploadId')[0]
+        ABUNDANT_LOGGER.debug('Started multipart upload of %s: %s', key, upload_id)
+
+        def upload_part(part_number: int) -> str:
+            offset = (part_number - 1) * self.part_size
+            with open(source_path, mode='rb') as source_file:
+                source_file.seek(offset)
+                part = source_file.read(self.part_size)
+            if throttle:
+                throttle.consume(number_of_bytes=len(part))
+            part_status, part_headers, part_body = self._request(
+                'PUT', key, query={'partNumber': part_number, 'uploadId': upload_id}, body=part)
+            return part_headers['ETag']
+
+        number_of_parts = (size + self.part_size - 1) // self.part_size
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+                etags = list(executor.map(upload_part, range(1, number_of_parts + 1)))
+            completion = ''.join('<Part><PartNumber>%s</PartNumber><ETag>%s</ETag></Part>' % (number, etag)
+                                 for number, etag in enumerate(etags, 1))
+            self._request('POST', key, query={'uploadId': upload_id},
+                          body=('<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % completion).encode('utf-8'))
+        except Exception:
+            self._request('DELETE', key, query={'uploadId': upload_id})
+            ABUNDANT_LOGGER.error('Aborted multipart upload of %s', key)
+            raise
+        ABUNDANT_LOGGER.debug('Uploaded %s in %s part(s)', key, number_of_parts)
+
+    def get(self, key: str, destination_path: str, throttle=None):
+        if throttle:
+            throttle.consume(number_of_files=1)
+        with self.open(key) as source_file, open(destination_path, mode='wb') as destination_file:
+            chunk = source_file.read(COPY_CHUNK_SIZE)
+            while chunk:
+                if throttle:
+                    throttle.consume(number_of_bytes=len(chunk))
+                destination_file.write(chunk)
+                chunk = source_file.read(COPY_CHUNK_SIZE)
+
+    def open(self, key: str):
+        status, headers, body = self._request('GET', key, stream=True)
+        self._raise_if_missing(status, key)
+        return io.BufferedReader(body, buffer_size=COPY_CHUNK_SIZE)
+
+    def range_read(self, key: str, offset: int, length: int) -> bytes:
+        if length <= 0:
+            return b''
+        status, headers, body = self._request('GET', key, headers={'Range': 'bytes=%s-%s' % (
+            offset, offset + length - 1)})
+        self._raise_if_missing(status, key)
+        return body if status != 416 else b''
+
+    def list(self, prefix: str = ''):
+        # keys ending with a slash are markers of kept prefixes
+        for key, size in self._list_objects(prefix):
+            if not key.endswith('/'):
+                yield key
+
+    def list_sizes(self, prefix: str = ''):
+        # listings carry the sizes already
+        for key, size in self._list_objects(prefix):
+            if not key.endswith('/'):
+                yield key, size
+
+    def _list_objects(self, prefix: str):
+        """Generator for (key, size) of all objects whose key starts with a prefix, markers of kept prefixes
+        included."""
+        full_prefix = '/'.join(part for part in (self.prefix, prefix) if part)
+        if prefix == '' and self.prefix:
+            full_prefix += '/'
+        continuation_token = None
+        while True:
+            query = {'list-type': 2, 'prefix': full_prefix}
+            if continuation_token:
+                query['continuation-token'] = continuation_token
+            status, headers, body = self._request('GET', query=query)
+            for contents in self._find_xml_elements(body, 'Contents'):
+                fields = {field.tag.rsplit('}', 1)[-1]: field.text for field in contents}
+                object_name = fields['Key']
+                yield object_name[len(self.prefix) + 1:] if self.prefix else object_name, int(fields['Size'])
+            continuation_token = self._find_xml_text(body, 'NextContinuationToken')
+            if not continuation_token:
+                break
+            continuation_token = continuation_token[0]
+
+    def exists(self, key: str) -> bool:
+        status, headers, body = self._request('HEAD', key)
+        return status != 404
+
+    def size(self, key: str) -> int:
+        status, headers, body = self._request('HEAD', key)
+        self._raise_if_missing(status, key)
+        return int(headers['Content-Length'])
+
+    def delete(self, key: str):
+        self._request('DELETE', key)
+
+    def move(self, key: str, new_key: str):
+        status, headers, body = self._request('PUT', new_key, headers={
+            'x-amz-copy-source': self._get_object_path(key)})
+        self._raise_if_missing(status, key)
+        self.delete(key)
+
+    def delete_prefix(self, prefix: str):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            for _ in executor.map(self.delete, [key for key, size in self._list_objects(prefix)]):
+                pass
+
+    def create_prefix(self, prefix: str):
+        self._request('PUT', prefix.rstrip('/') + '/', body=b'')
+
+    def list_prefixes(self, prefix: str):
+        for key, size in self._list_objects(prefix):
+            if key.endswith('/') and key != prefix:
+                yield key
+
+    @staticmethod
+    def _find_xml_elements(body: bytes, tag: str) -> list:
+        """Find all elements with a tag, ignoring namespaces."""
+        import xml.etree.ElementTree
+        root = xml.etree.ElementTree.fromstring(body)
+        return [element for element in root.iter() if element.tag.rsplit('}', 1)[-1] == tag]
+
+    @classmethod
+    def _find_xml_text(cls, body: bytes, tag: str) -> list:
+        """Find the text of all elements with a tag, ignoring namespaces."""
+        return [element.text for element in cls._find_xml_elements(body, tag)]
+
+
+def transfer_object(source: StorageBackend, key: str, destination: StorageBackend, new_key=None, throttle=None):
+    """Copy an object from one backend to another, staging through a temporary file
+    only when the source is not local."""
+    new_key = new_key or key
+    if isinstance(source, LocalStorageBackend):
+        destination.put(new_key, source.locate(key), throttle)
+        return
+    staging_file = tempfile.NamedTemporaryFile(delete=False)
+    staging_file.close()
+    try:
+        source.get(key, staging_file.name, throttle)
+        destination.put(new_key, staging_file.name)
+    finally:
+        os.remove(staging_file.name)
+
+
+def create_storage_backend(storage_config: dict, archive_dir: str) -> StorageBackend:
+    """Create the storage backend described by the storage section of an archive config."""
+    storage_type = (storage_config or STORAGE_CONFIG_TEMPLATE)['Type'].lower()
+    if storage_type == 'local':
+        return LocalStorageBackend(os.path.join(archive_dir, 'archive'))
+    if storage_type == 's3':
+        return S3StorageBackend(storage_config)
+    ABUNDANT_LOGGER.error('Unknown storage backend: %s', storage_type)
+    raise NotImplementedError('Requested storage backend is either invalid or has not been implemented yet: %s'
+                              % storage_type)
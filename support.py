@@ -5,8 +5,15 @@
 Supportive matters.
 """
 
+import os
+import errno
+import shutil
+import fnmatch
+
 __author__ = 'Kevin'
 
+COPY_CHUNK_SIZE = 1024 * 1024
+
 
 class SingletonMeta(type):
     """Meta class for creating singleton class."""
@@ -21,3 +28,118 @@ class SingletonMeta(type):
 def get_relative_path(absolute_path: str, root_dir: str) -> str:
     """Get the relative path of an absolute path to a root directory."""
     return absolute_path.replace(root_dir, '', 1).lstrip('/').lstrip('\\')
+
+
+def is_sparse(stat_result: os.stat_result) -> bool:
+    """Tell if a file takes fewer blocks than its size, so it may have holes."""
+    blocks = getattr(stat_result, 'st_blocks', None)
+    return blocks is not None and blocks * 512 < stat_result.st_size
+
+
+def get_data_extents(file_descriptor: int, start: int, end: int):
+    """Generator for the (offset, length) of the data between start and end of a file, skipping its holes.
+    All of it is data where the platform or the file system cannot find holes."""
+    offset = start
+    while offset < end:
+        try:
+            data_start = os.lseek(file_descriptor, offset, os.SEEK_DATA)
+            data_end = min(os.lseek(file_descriptor, data_start, os.SEEK_HOLE), end)
+        except AttributeError:
+            yield offset, end - offset
+            return
+        except OSError as error:
+            # nothing but a hole up to the end of the file
+            if error.errno == errno.ENXIO:
+                return
+            yield offset, end - offset
+            return
+        if data_start >= end:
+            return
+        yield data_start, data_end - data_start
+        offset = data_end
+
+
+def read_sparse_chunks(file_descriptor: int, start: int, end: int, chunk_size: int):
+    """Generator for (offset, length, chunk) covering a file from start to end, chunk being None for holes,
+    which are never read. Reads by position, leaving the file position undefined."""
+    offset = start
+    for data_start, data_length in get_data_extents(file_descriptor, start, end):
+        if data_start > offset:
+            yield offset, data_start - offset, None
+        data_end = data_start + data_length
+        offset = data_start
+        while offset < data_end:
+            chunk = os.pread(file_descriptor, min(chunk_size, data_end - offset), offset)
+            if not chunk:
+                # the file shrank while being read
+                return
+            yield offset, len(chunk), chunk
+            offset += len(chunk)
+    if end > offset:
+        yield offset, end - offset, None
+
+
+def copy_file(source_path: str, destination_path: str, throttle=None):
+    """Copy a file and its permission bits like shutil.copy,
+    paying every chunk to a throttle if there is one.
+    Holes of sparse files are skipped and left as holes in the copy.
+    :type throttle: ThrottleAgent"""
+    source_stat = os.stat(source_path)
+    sparse = is_sparse(source_stat)
+    if throttle is None and not sparse:
+        shutil.copy(source_path, destination_path)
+        return
+    if throttle is not None:
+        throttle.consume(number_of_files=1)
+    with open(source_path, mode='rb') as source_file, open(destination_path, mode='wb') as destination_file:
+        if sparse:
+            for offset, length, chunk in read_sparse_chunks(source_file.fileno(), 0, source_stat.st_size,
+                                                            COPY_CHUNK_SIZE):
+                if chunk is None:
+                    continue
+                if throttle is not None:
+                    throttle.consume(number_of_bytes=2 * length)
+                destination_file.seek(offset)
+                destination_file.write(chunk)
+            # a trailing hole only exists once the size is set
+            destination_file.truncate(source_stat.st_size)
+        else:
+            chunk = source_file.read(COPY_CHUNK_SIZE)
+            while chunk:
+                # both the read and the write count against the limit
+                throttle.consume(number_of_bytes=2 * len(chunk))
+                destination_file.write(chunk)
+                chunk = source_file.read(COPY_CHUNK_SIZE)
+    shutil.copymode(source_path, destination_path)
+
+
+def match_path(pattern: str, path: str) -> bool:
+    """Tell if a slash separated path matches a glob where * stays within a directory
+    and ** matches any number of directories."""
+    return _match_parts(pattern.split('/'), path.split('/'))
+
+
+def _match_parts(pattern_parts: list, path_parts: list) -> bool:
+    """Match path components against glob components."""
+    if not pattern_parts:
+        return not path_parts
+    if pattern_parts[0] == '**':
+        return any(_match_parts(pattern_parts[1:], path_parts[i:]) for i in range(len(path_parts) + 1))
+    return bool(path_parts) and fnmatch.fnmatchcase(path_parts[0], pattern_parts[0]) \
+        and _match_parts(pattern_parts[1:], path_parts[1:])
+
+
+def is_rotational_device(path: str):
+    """Tell if a path lives on a spinning disk, None if it cannot be told."""
+    try:
+        device = os.stat(path).st_dev
+        device_dir = os.path.realpath('/sys/dev/block/%s:%s' % (os.major(device), os.minor(device)))
+        # partitions keep their queue settings in the parent device
+        for queue_dir in (os.path.join(device_dir, 'queue'), os.path.join(os.path.dirname(device_dir), 'queue')):
+            rotational_path = os.path.join(queue_dir, 'rotational')
+            if os.path.exists(rotational_path):
+                with open(rotational_path, mode='r') as rotational:
+                    return rotational.read().strip() == '1'
+    except (OSError, AttributeError):
+        pass
+    return None
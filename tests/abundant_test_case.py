@@ -0,0 +1,89 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Base test case running archives in temporary directories, with a master config of their own.
+"""
+
+import os
+import sys
+import uuid
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PACKAGE_DIR not in sys.path:
+    sys.path.insert(0, PACKAGE_DIR)
+
+from log import configure_logging, get_init_config, set_std_out_logging  # noqa: E402
+from master_config import MasterConfigAgent  # noqa: E402
+from archive import create_archive  # noqa: E402
+
+__author__ = 'Kevin'
+
+TEST_LOG_PATH = os.path.join(tempfile.gettempdir(), 'abundant-tests.log')
+
+# keep records of the tests out of the package directory and off the console
+set_std_out_logging(False)
+configure_logging(log_path=TEST_LOG_PATH)
+
+
+class AbundantTestCase(unittest.TestCase):
+    """Test case with a source directory, an archive directory and a master config directory,
+    all removed afterwards."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='abundant-test-')
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        self.source_dir = os.path.join(self.temp_dir, 'source')
+        self.archive_dir = os.path.join(self.temp_dir, 'archive')
+        self.master_config_dir = os.path.join(self.temp_dir, 'master')
+        for directory in (self.source_dir, self.archive_dir, self.master_config_dir):
+            os.mkdir(directory)
+
+        # point the master config at the temporary directory and forget the one loaded before
+        init_config_patch = mock.patch.dict(get_init_config(), MasterConfigDirectory=self.master_config_dir)
+        init_config_patch.start()
+        self.addCleanup(init_config_patch.stop)
+        self.addCleanup(setattr, MasterConfigAgent(), '_master_config', None)
+        MasterConfigAgent().load_config()
+
+    def write_source_file(self, relative_path: str, content: bytes = b'', modification_time_ns=None) -> str:
+        """Write a file into the source directory, making its directories, and return its path."""
+        path = os.path.join(self.source_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, mode='wb') as file:
+            file.write(content)
+        if modification_time_ns is not None:
+            os.utime(path, ns=(modification_time_ns, modification_time_ns))
+        return path
+
+    def create_archive(self, max_number_of_versions: int = 3, algorithm: str = 'md5', storage_config=None,
+                       archive_dir=None, register=False):
+        """Create an archive of the source directory, registered in the master config if asked to.
+        :rtype: ArchiveAgent"""
+        archive_dir = archive_dir or self.archive_dir
+        os.makedirs(archive_dir, exist_ok=True)
+        if register:
+            archive_record = MasterConfigAgent().add_archive_record(self.source_dir, archive_dir)
+        else:
+            archive_record = {'SourceDirectory': self.source_dir, 'ArchiveDirectory': archive_dir,
+                              'UUID': str(uuid.uuid4())}
+        return create_archive(archive_record, algorithm, max_number_of_versions, storage_config)
+
+    @staticmethod
+    def read_tree(root_dir: str) -> dict:
+        """Read a directory tree into the contents of its files keyed by slash separated relative path,
+        with None for its directories."""
+        tree = {}
+        for directory, dirs, files in os.walk(root_dir):
+            relative_dir = os.path.relpath(directory, root_dir).replace(os.sep, '/')
+            prefix = '' if relative_dir == '.' else relative_dir + '/'
+            for name in dirs:
+                tree[prefix + name] = None
+            for name in files:
+                with open(os.path.join(directory, name), mode='rb') as file:
+                    tree[prefix + name] = file.read()
+        return tree
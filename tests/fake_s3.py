@@ -0,0 +1,230 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+In-process stand-in for an S3-compatible object store, just enough of it for S3StorageBackend:
+path-style objects of one bucket, signature version 4 checks, multipart uploads, paginated listings
+and server errors injected on demand.
+"""
+
+import hmac
+import hashlib
+import threading
+import http.server
+import urllib.parse
+import xml.sax.saxutils
+
+__author__ = 'Kevin'
+
+FAKE_S3_BUCKET = 'bucket'
+FAKE_S3_REGION = 'us-east-1'
+FAKE_S3_ACCESS_KEY = 'AKIDEXAMPLE'
+FAKE_S3_SECRET_KEY = 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY'
+
+LIST_XML_NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class FakeS3Server(http.server.ThreadingHTTPServer):
+    """Fake object store listening on a free local port.
+    Objects are kept in memory by object name, counters tell how clients used it."""
+
+    daemon_threads = True
+
+    def __init__(self, page_size: int = 2):
+        """Create the server, listing at most page_size keys per page."""
+        super(FakeS3Server, self).__init__(('127.0.0.1', 0), FakeS3RequestHandler)
+        self.page_size = page_size
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.failures_to_inject = 0
+        self.connections = 0
+        self.requests = []
+        self._thread = None
+
+    @property
+    def endpoint(self) -> str:
+        """Get the endpoint clients connect to."""
+        return 'http://%s:%s' % self.server_address[:2]
+
+    def get_storage_config(self, **overrides) -> dict:
+        """Get the storage section of an archive config using this server."""
+        storage_config = {
+            'Type': 's3',
+            'Endpoint': self.endpoint,
+            'Region': FAKE_S3_REGION,
+            'Bucket': FAKE_S3_BUCKET,
+            'AccessKey': FAKE_S3_ACCESS_KEY,
+            'SecretKey': FAKE_S3_SECRET_KEY,
+            'MaxRetries': 2
+        }
+        storage_config.update(overrides)
+        return storage_config
+
+    def count_requests(self, method: str, query_name=None) -> int:
+        """Count the requests received with a method, and a query parameter if given."""
+        return sum(1 for request_method, query in self.requests
+                   if request_method == method and (query_name is None or query_name in query))
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+class FakeS3RequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handler of one client connection to the fake object store."""
+
+    protocol_version = 'HTTP/1.1'
+    server: FakeS3Server
+
+    def setup(self):
+        super(FakeS3RequestHandler, self).setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        """Keep the test output clean."""
+
+    def _parse(self):
+        """Get the object name, None for the bucket itself, and the query of the request."""
+        split_path = urllib.parse.urlsplit(self.path)
+        bucket, _, object_name = split_path.path.lstrip('/').partition('/')
+        query = dict(urllib.parse.parse_qsl(split_path.query, keep_blank_values=True))
+        return bucket, urllib.parse.unquote(object_name) or None, query
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _send(self, status: int, body: bytes = b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _is_signed(self, query: dict) -> bool:
+        """Check the signature version 4 of the request against the secret key of the fake store."""
+        authorization = self.headers.get('Authorization', '')
+        if not authorization.startswith('AWS4-HMAC-SHA256 '):
+            return False
+        fields = dict(field.strip().split('=', 1) for field in authorization[len('AWS4-HMAC-SHA256 '):].split(','))
+        access_key, date_stamp, region, service, terminator = fields['Credential'].split('/')
+        if access_key != FAKE_S3_ACCESS_KEY:
+            return False
+        signed_headers = fields['SignedHeaders'].split(';')
+        canonical_query = '&'.join('%s=%s' % (urllib.parse.quote(name, safe='-_.~'),
+                                              urllib.parse.quote(value, safe='-_.~'))
+                                   for name, value in sorted(query.items()))
+        canonical_request = '\n'.join([
+            self.command, urllib.parse.urlsplit(self.path).path, canonical_query,
+            ''.join('%s:%s\n' % (name, self.headers.get(name, '').strip()) for name in signed_headers),
+            ';'.join(signed_headers), self.headers.get('x-amz-content-sha256', '')
+        ])
+        scope = '/'.join([date_stamp, region, service, terminator])
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', self.headers.get('x-amz-date', ''), scope,
+                                    hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+        signing_key = ('AWS4' + FAKE_S3_SECRET_KEY).encode('utf-8')
+        for part in (date_stamp, region, service, terminator):
+            signing_key = hmac.new(signing_key, part.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        return hmac.compare_digest(signature, fields['Signature'])
+
+    def _handle(self):
+        """Check, count and dispatch a request."""
+        bucket, object_name, query = self._parse()
+        body = self._read_body()
+        with self.server.lock:
+            self.server.requests.append((self.command, query))
+            inject_failure = self.server.failures_to_inject > 0
+            if inject_failure:
+                self.server.failures_to_inject -= 1
+        if inject_failure:
+            return self._send(503, b'<Error><Code>SlowDown</Code></Error>')
+        if bucket != FAKE_S3_BUCKET:
+            return self._send(404, b'<Error><Code>NoSuchBucket</Code></Error>')
+        if not self._is_signed(query):
+            return self._send(403, b'<Error><Code>SignatureDoesNotMatch</Code></Error>')
+        if object_name is None:
+            return self._list(query)
+        getattr(self, '_%s_object' % self.command.lower())(object_name, query, body)
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = _handle
+
+    def _list(self, query: dict):
+        with self.server.lock:
+            objects = sorted((name, len(content)) for name, content in self.server.objects.items()
+                             if name.startswith(query.get('prefix', '')))
+        start_after = query.get('continuation-token')
+        if start_after is not None:
+            objects = [(name, size) for name, size in objects if name > start_after]
+        page = objects[:self.server.page_size]
+        contents = ''.join('<Contents><Key>%s</Key><Size>%s</Size></Contents>' % (xml.sax.saxutils.escape(name), size)
+                           for name, size in page)
+        if len(objects) > len(page):
+            contents += '<NextContinuationToken>%s</NextContinuationToken>' % xml.sax.saxutils.escape(page[-1][0])
+        self._send(200, ('<ListBucketResult xmlns="%s">%s</ListBucketResult>' % (
+            LIST_XML_NAMESPACE, contents)).encode('utf-8'))
+
+    def _get_object(self, object_name: str, query: dict, body: bytes):
+        with self.server.lock:
+            content = self.server.objects.get(object_name)
+        if content is None:
+            return self._send(404, b'<Error><Code>NoSuchKey</Code></Error>')
+        byte_range = self.headers.get('Range')
+        if byte_range is None:
+            return self._send(200, content)
+        first, last = (int(position) for position in byte_range[len('bytes='):].split('-'))
+        if first >= len(content):
+            return self._send(416)
+        self._send(206, content[first:last + 1])
+
+    def _head_object(self, object_name: str, query: dict, body: bytes):
+        with self.server.lock:
+            content = self.server.objects.get(object_name)
+        if content is None:
+            return self._send(404)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+
+    def _put_object(self, object_name: str, query: dict, body: bytes):
+        with self.server.lock:
+            if 'uploadId' in query:
+                self.server.uploads[query['uploadId']][int(query['partNumber'])] = body
+                return self._send(200, headers={'ETag': '"%s"' % hashlib.md5(body).hexdigest()})
+            copy_source = self.headers.get('x-amz-copy-source')
+            if copy_source is not None:
+                source_name = urllib.parse.unquote(copy_source.lstrip('/').partition('/')[2])
+                if source_name not in self.server.objects:
+                    return self._send(404, b'<Error><Code>NoSuchKey</Code></Error>')
+                body = self.server.objects[source_name]
+            self.server.objects[object_name] = body
+        self._send(200)
+
+    def _post_object(self, object_name: str, query: dict, body: bytes):
+        with self.server.lock:
+            if 'uploads' in query:
+                upload_id = 'upload-%s' % len(self.server.uploads)
+                self.server.uploads[upload_id] = {}
+                return self._send(200, ('<InitiateMultipartUploadResult><UploadId>%s</UploadId>'
+                                        '</InitiateMultipartUploadResult>' % upload_id).encode('utf-8'))
+            parts = self.server.uploads.pop(query['uploadId'])
+            self.server.objects[object_name] = b''.join(parts[number] for number in sorted(parts))
+        self._send(200, b'<CompleteMultipartUploadResult/>')
+
+    def _delete_object(self, object_name: str, query: dict, body: bytes):
+        with self.server.lock:
+            if 'uploadId' in query:
+                self.server.uploads.pop(query['uploadId'], None)
+            else:
+                self.server.objects.pop(object_name, None)
+        self._send(204)
@@ -0,0 +1,72 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Tests of listing the changes between two versions, in memory and in bounded memory.
+"""
+
+import os
+
+from abundant_test_case import AbundantTestCase
+from external import set_memory_ceiling
+
+__author__ = 'Kevin'
+
+
+class DiffTest(AbundantTestCase):
+
+    def setUp(self):
+        super(DiffTest, self).setUp()
+        self.write_source_file('x.txt', b'hello')
+        self.write_source_file('a/y.txt', b'one')
+        self.write_source_file('a/b/z.txt', b'deep')
+        self.write_source_file('c/w.txt', b'untouched')
+        self.archive = self.create_archive(max_number_of_versions=5)
+        self.base_version = self.archive.create_base()
+
+        self.write_source_file('x.txt', b'hello world')
+        os.remove(os.path.join(self.source_dir, 'a', 'y.txt'))
+        self.write_source_file('a/new.txt', b'added')
+        # rewritten with the same content, stored again without changing
+        self.write_source_file('a/b/z.txt', b'deep', 10 ** 18)
+        self.second_version = self.archive.create_version()
+
+        # back to what the base held
+        self.write_source_file('x.txt', b'hello', 10 ** 18)
+        self.write_source_file('a/y.txt', b'one')
+        self.third_version = self.archive.create_version()
+
+    def get_changes(self, version, other_version) -> list:
+        return sorted(version.diff(other_version), key=lambda change: change[1])
+
+    def test_diff(self):
+        self.assertEqual(self.get_changes(self.base_version, self.second_version), [
+            ('added', os.path.join('a', 'new.txt'), None, 5),
+            ('removed', os.path.join('a', 'y.txt'), 3, None),
+            ('modified', 'x.txt', 5, 11),
+        ])
+        # content equal to the base is no change, however many versions stored it since
+        self.assertEqual(self.get_changes(self.base_version, self.third_version), [
+            ('added', os.path.join('a', 'new.txt'), None, 5),
+        ])
+        self.assertEqual(self.get_changes(self.second_version, self.third_version), [
+            ('added', os.path.join('a', 'y.txt'), None, 3),
+            ('modified', 'x.txt', 11, 5),
+        ])
+        self.assertEqual(self.get_changes(self.third_version, self.third_version), [])
+
+    def test_diff_backwards(self):
+        self.assertEqual(self.get_changes(self.second_version, self.base_version), [
+            ('removed', os.path.join('a', 'new.txt'), 5, None),
+            ('added', os.path.join('a', 'y.txt'), None, 3),
+            ('modified', 'x.txt', 11, 5),
+        ])
+
+    def test_bounded_diff_matches(self):
+        versions = self.archive.versions
+        pairs = [(version, other_version) for version in versions for other_version in versions]
+        unbounded_changes = [self.get_changes(*pair) for pair in pairs]
+        set_memory_ceiling(4096)
+        self.addCleanup(set_memory_ceiling, None)
+
+        self.assertEqual([self.get_changes(*pair) for pair in pairs], unbounded_changes)
@@ -0,0 +1,69 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Tests of migrating the oldest version into the next one, in memory and in bounded memory.
+"""
+
+import os
+import shutil
+
+from abundant_test_case import AbundantTestCase
+from external import set_memory_ceiling
+
+__author__ = 'Kevin'
+
+
+class MigrationTest(AbundantTestCase):
+
+    def run_versions(self, memory_ceiling: int) -> list:
+        """Back up a changing source into an archive keeping two versions and describe what is left after
+        every migration: per version, whether it is the base, its manifest, stored files and space."""
+        set_memory_ceiling(memory_ceiling)
+        self.addCleanup(set_memory_ceiling, None)
+        shutil.rmtree(self.source_dir)
+        for number in range(60):
+            self.write_source_file('d%s/f%s.txt' % (number % 4, number), b'x' * number, 10 ** 18)
+        archive = self.create_archive(max_number_of_versions=2,
+                                      archive_dir=os.path.join(self.temp_dir, 'archive-%s' % memory_ceiling))
+        archive.create_base()
+
+        states = []
+        for step in range(4):
+            for number in range(step, 60, 7):
+                os.remove(os.path.join(self.source_dir, 'd%s/f%s.txt' % (number % 4, number)))
+            for number in range(step + 1, 60, 5):
+                path = os.path.join(self.source_dir, 'd%s/f%s.txt' % (number % 4, number))
+                if os.path.exists(path):
+                    self.write_source_file(path, b'y' * (step + number), 10 ** 18 + step)
+            self.write_source_file('new/n%s.txt' % step, b'z' * step, 10 ** 18)
+            archive.create_version()
+            states.append([(version.is_base_version, list(version.manifest.records),
+                            sorted(version._get_relative_path_of_key(key)
+                                   for key in archive.storage.list(version.uuid + '/')),
+                            version.space) for version in archive.versions])
+        return states
+
+    def test_bounded_migration_matches(self):
+        unbounded_states = self.run_versions(0)
+        # every version and step has migrated the base version
+        self.assertEqual([len(state) for state in unbounded_states], [2] * 4)
+        self.assertEqual(self.run_versions(4096), unbounded_states)
+
+    def test_migration_keeps_the_view(self):
+        self.write_source_file('x.txt', b'hello')
+        self.write_source_file('a/y.txt', b'one')
+        archive = self.create_archive(max_number_of_versions=2)
+        archive.create_base()
+        os.remove(os.path.join(self.source_dir, 'x.txt'))
+        archive.create_version()
+        self.write_source_file('a/z.txt', b'two')
+        latest_version = archive.create_version()
+
+        self.assertEqual(len(archive.versions), 2)
+        self.assertTrue(archive.base_version.is_base_version)
+        self.assertEqual(sorted(relative_path for relative_path, _ in latest_version.files),
+                         [os.path.join('a', 'y.txt'), os.path.join('a', 'z.txt')])
+        # the deletion of x.txt means nothing once its version is the base
+        self.assertEqual([record['Path'] for record in archive.base_version.manifest.records],
+                         [os.path.join('a', 'y.txt')])
@@ -0,0 +1,116 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Tests of the shared object pool linking identical files across archives.
+"""
+
+import os
+import stat
+import hashlib
+
+from abundant_test_case import AbundantTestCase
+from abundant import Abundant
+
+__author__ = 'Kevin'
+
+
+class ObjectPoolTest(AbundantTestCase):
+
+    def setUp(self):
+        super(ObjectPoolTest, self).setUp()
+        self.pool_dir = os.path.join(self.temp_dir, 'pool')
+        os.mkdir(self.pool_dir)
+        Abundant.set_object_pool(self.pool_dir)
+        self.pool = Abundant.get_object_pool()
+        self.write_source_file('x.txt', b'shared')
+        self.write_source_file('a/y.txt', b'also shared')
+
+    def create_pooled_archive(self, name: str, max_number_of_versions: int = 3):
+        archive = self.create_archive(max_number_of_versions, archive_dir=os.path.join(self.temp_dir, name),
+                                      register=True)
+        self.assertIsNotNone(archive.object_pool)
+        return archive
+
+    def get_object_path(self, content: bytes) -> str:
+        return self.pool._get_object_path('md5', hashlib.md5(content).hexdigest())
+
+    @staticmethod
+    def get_stored_path(version, relative_path: str) -> str:
+        return version._get_full_path_of_file(relative_path)
+
+    def test_identical_files_are_linked(self):
+        first_archive = self.create_pooled_archive('first')
+        first_archive.create_base()
+        second_archive = self.create_pooled_archive('second')
+        second_archive.create_base()
+
+        for relative_path in ('x.txt', os.path.join('a', 'y.txt')):
+            self.assertTrue(os.path.samefile(self.get_stored_path(first_archive.base_version, relative_path),
+                                             self.get_stored_path(second_archive.base_version, relative_path)))
+        self.assertEqual(self.pool.get_reference_count('md5', hashlib.md5(b'shared').hexdigest()), 2)
+        summary = self.pool.summarise()
+        self.assertEqual((summary['Objects'], summary['References'], summary['BytesSaved']),
+                         (2, 4, len(b'shared') + len(b'also shared')))
+
+    def test_files_of_other_modes_are_copied(self):
+        first_archive = self.create_pooled_archive('first')
+        first_archive.create_base()
+        os.chmod(os.path.join(self.source_dir, 'x.txt'), 0o755)
+        second_archive = self.create_pooled_archive('second')
+        second_archive.create_base()
+
+        stored_path = self.get_stored_path(second_archive.base_version, 'x.txt')
+        self.assertFalse(os.path.samefile(self.get_stored_path(first_archive.base_version, 'x.txt'), stored_path))
+        self.assertEqual(stat.S_IMODE(os.stat(stored_path).st_mode), 0o755)
+        self.assertNotEqual(stat.S_IMODE(os.stat(self.get_object_path(b'shared')).st_mode), 0o755)
+        # unchanged files are still linked
+        self.assertTrue(os.path.samefile(self.get_stored_path(first_archive.base_version, os.path.join('a', 'y.txt')),
+                                         self.get_stored_path(second_archive.base_version, os.path.join('a', 'y.txt'))))
+
+    def test_removing_a_version_releases_its_objects(self):
+        archive = self.create_pooled_archive('first')
+        archive.create_base()
+        self.write_source_file('x.txt', b'changed')
+        version = archive.create_version()
+        self.assertTrue(os.path.exists(self.get_object_path(b'changed')))
+
+        version.remove()
+        self.assertFalse(os.path.exists(self.get_object_path(b'changed')))
+        self.assertTrue(os.path.exists(self.get_object_path(b'shared')))
+
+    def test_removing_an_archive_releases_only_its_objects(self):
+        first_archive = self.create_pooled_archive('first')
+        first_archive.create_base()
+        self.write_source_file('a/y.txt', b'only in the second archive')
+        second_archive = self.create_pooled_archive('second')
+        second_archive.create_base()
+
+        second_archive.remove()
+        self.assertFalse(os.path.exists(self.get_object_path(b'only in the second archive')))
+        self.assertEqual(self.pool.get_reference_count('md5', hashlib.md5(b'shared').hexdigest()), 1)
+        self.assertEqual(self.pool.get_reference_count('md5', hashlib.md5(b'also shared').hexdigest()), 1)
+
+    def test_migration_releases_dropped_files(self):
+        archive = self.create_pooled_archive('first', max_number_of_versions=2)
+        archive.create_base()
+        os.remove(os.path.join(self.source_dir, 'x.txt'))
+        archive.create_version()
+        self.assertTrue(os.path.exists(self.get_object_path(b'shared')))
+
+        # a third version migrates the base into the second one, where x.txt is deleted
+        self.write_source_file('z.txt', b'new')
+        archive.create_version()
+        self.assertFalse(os.path.exists(self.get_object_path(b'shared')))
+        self.assertEqual(self.pool.get_reference_count('md5', hashlib.md5(b'also shared').hexdigest()), 1)
+
+    def test_collect_garbage(self):
+        archive = self.create_pooled_archive('first')
+        archive.create_base()
+        # a file removed behind the back of the archive leaves its object unreferenced
+        os.remove(self.get_stored_path(archive.base_version, 'x.txt'))
+
+        self.assertEqual(self.pool.collect_garbage(), 1)
+        self.assertFalse(os.path.exists(self.get_object_path(b'shared')))
+        self.assertTrue(os.path.exists(self.get_object_path(b'also shared')))
+        self.assertEqual(self.pool.collect_garbage(), 0)
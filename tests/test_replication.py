@@ -0,0 +1,91 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Tests of replicating an archive into another directory.
+"""
+
+import os
+from unittest import mock
+
+from abundant_test_case import AbundantTestCase
+from storage import transfer_object
+
+__author__ = 'Kevin'
+
+
+class ReplicationTest(AbundantTestCase):
+
+    def setUp(self):
+        super(ReplicationTest, self).setUp()
+        self.write_source_file('x.txt', b'hello')
+        self.write_source_file('a/y.txt', b'one')
+        self.write_source_file('a/b/z.txt', b'deep')
+        self.archive = self.create_archive()
+        self.archive.create_base()
+        self.replica_dir = os.path.join(self.temp_dir, 'replica')
+        os.mkdir(self.replica_dir)
+
+    def assert_replica_matches(self, replica):
+        """Assert the replica holds the same versions and stored files as the archive."""
+        self.assertEqual([version.uuid for version in replica.versions],
+                         [version.uuid for version in self.archive.versions])
+        self.assertEqual(self.read_tree(replica.storage.root_dir), self.read_tree(self.archive.storage.root_dir))
+
+    def test_replica_follows_new_versions(self):
+        self.assert_replica_matches(self.archive.replicate(self.replica_dir))
+        self.write_source_file('a/y.txt', b'two')
+        os.remove(os.path.join(self.source_dir, 'x.txt'))
+        self.archive.create_version()
+
+        self.assert_replica_matches(self.archive.replicate(self.replica_dir))
+
+    def test_lost_replica_files_are_repaired(self):
+        replica = self.archive.replicate(self.replica_dir)
+        base_uuid = self.archive.base_version.uuid
+        os.remove(replica.storage.locate(base_uuid + '/a/b/z.txt'))
+        with open(replica.storage.locate(base_uuid + '/x.txt'), mode='ab') as file:
+            file.write(b' damaged')
+
+        self.assert_replica_matches(self.archive.replicate(self.replica_dir))
+
+    def replicate_counting_transfers(self):
+        """Replicate the archive and return the replica and the number of files transferred."""
+        with mock.patch('archive.transfer_object', side_effect=transfer_object) as transfer:
+            replica = self.archive.replicate(self.replica_dir)
+        return replica, transfer.call_count
+
+    def test_migrations_are_replayed(self):
+        self.archive.replicate(self.replica_dir)
+        for content in (b'two', b'three', b'four'):
+            self.write_source_file('a/y.txt', content)
+            self.archive.create_version()
+        replica, number_of_file_transferred = self.replicate_counting_transfers()
+
+        self.assert_replica_matches(replica)
+        # files moved by migrations are moved on the replica too, only the new copies of y.txt travel
+        self.assertEqual(number_of_file_transferred, 3)
+
+    def test_unchanged_archive_transfers_nothing(self):
+        self.archive.replicate(self.replica_dir)
+        replica, number_of_file_transferred = self.replicate_counting_transfers()
+
+        self.assert_replica_matches(replica)
+        self.assertEqual(number_of_file_transferred, 0)
+
+    def test_removed_versions_and_extra_files_are_removed(self):
+        self.write_source_file('x.txt', b'changed')
+        version = self.archive.create_version()
+        replica = self.archive.replicate(self.replica_dir)
+        self.write_source_file(os.path.join(replica.storage.locate(self.archive.base_version.uuid), 'extra.txt'),
+                               b'not in the archive')
+        version.remove()
+
+        self.assert_replica_matches(self.archive.replicate(self.replica_dir))
+
+    def test_replica_directory_is_checked(self):
+        with self.assertRaises(ValueError):
+            self.archive.replicate(self.archive_dir)
+        other_archive = self.create_archive(archive_dir=os.path.join(self.temp_dir, 'other'))
+        with self.assertRaises(ValueError):
+            other_archive.replicate(self.archive.archive_dir)
@@ -0,0 +1,75 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Tests of the scheduler running due backups in worker processes.
+"""
+
+import os
+import time
+
+from abundant_test_case import AbundantTestCase
+from archive import ArchiveAgent
+from scheduler import SchedulerAgent, RUN_RECORD_TEMPLATE
+
+__author__ = 'Kevin'
+
+
+class SchedulerTest(AbundantTestCase):
+
+    def setUp(self):
+        super(SchedulerTest, self).setUp()
+        self.write_source_file('x.txt', b'hello')
+        self.hourly_archive = self.create_archive(archive_dir=os.path.join(self.temp_dir, 'hourly'), register=True)
+        self.hourly_archive.backup_interval = 60 * 60
+        self.hourly_archive.create_base()
+        self.daily_archive = self.create_archive(archive_dir=os.path.join(self.temp_dir, 'daily'), register=True)
+        self.daily_archive.create_base()
+
+    def test_due_archives(self):
+        scheduler = SchedulerAgent()
+        now = time.time()
+
+        self.assertEqual(scheduler.get_due_archives(now), [])
+        self.assertEqual([record['UUID'] for record in scheduler.get_due_archives(now + 2 * 60 * 60)],
+                         [self.hourly_archive.uuid])
+        # the most overdue comes first
+        self.assertEqual([record['UUID'] for record in scheduler.get_due_archives(now + 2 * 24 * 60 * 60)],
+                         [self.hourly_archive.uuid, self.daily_archive.uuid])
+
+    def test_run_due_jobs(self):
+        scheduler = SchedulerAgent(max_workers=2)
+        later = time.time() + 2 * 24 * 60 * 60
+        runs = scheduler.run_due_jobs(later)
+
+        self.assertEqual(set(runs), {self.hourly_archive.uuid, self.daily_archive.uuid})
+        for archive in (self.hourly_archive, self.daily_archive):
+            run = runs[archive.uuid]
+            self.assertTrue(run['Succeeded'], run['Error'])
+            self.assertEqual([version.uuid for version in ArchiveAgent(archive.archive_dir).versions][-1],
+                             run['Version'])
+            # the history survives the scheduler
+            self.assertEqual(SchedulerAgent().history.get_runs(archive.uuid), [run])
+        # backups just made are not due again
+        self.assertEqual(SchedulerAgent().get_due_archives(), [])
+
+    def test_jobs_per_device(self):
+        later = time.time() + 2 * 24 * 60 * 60
+        runs = SchedulerAgent(max_workers=2, max_jobs_per_device=1).run_due_jobs(later)
+
+        # both sources are on one device, so the second backup starts after the first ends
+        first_run, second_run = sorted(runs.values(), key=lambda run: run['StartTime'])
+        self.assertGreaterEqual(second_run['StartTime'], first_run['EndTime'])
+
+    def test_failed_jobs_are_recorded(self):
+        scheduler = SchedulerAgent()
+        scheduler.history.add_run(self.daily_archive.uuid, dict(RUN_RECORD_TEMPLATE, Succeeded=True))
+        with open(os.path.join(self.daily_archive.archive_dir, 'meta', 'version_config.json'), mode='w') as file:
+            file.write('not json')
+        runs = scheduler.run_due_jobs()
+
+        self.assertEqual(list(runs), [self.daily_archive.uuid])
+        self.assertFalse(runs[self.daily_archive.uuid]['Succeeded'])
+        self.assertIn('JSONDecodeError', runs[self.daily_archive.uuid]['Error'])
+        # a failed run does not count as a backup, so the archive stays due
+        self.assertEqual([record['UUID'] for record in scheduler.get_due_archives()], [self.daily_archive.uuid])
@@ -0,0 +1,116 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Tests of the read-only browse service, served on a free local port.
+"""
+
+import os
+import json
+import threading
+import http.client
+
+from abundant_test_case import AbundantTestCase
+from server import create_server
+
+__author__ = 'Kevin'
+
+
+class BrowseServerTest(AbundantTestCase):
+
+    def setUp(self):
+        super(BrowseServerTest, self).setUp()
+        self.write_source_file('hello.txt', b'hello world', 1500000000 * 10 ** 9)
+        self.write_source_file('a/b.txt', b'nested')
+        self.archive = self.create_archive(max_number_of_versions=2, register=True)
+        self.archive.create_base()
+
+        self.server = create_server(port=0)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def request(self, path: str, method: str = 'GET', **headers):
+        """Send a request and return (status, headers, body)."""
+        connection = http.client.HTTPConnection(*self.server.server_address[:2], timeout=10)
+        try:
+            connection.request(method, path, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.headers, response.read()
+        finally:
+            connection.close()
+
+    def file_path(self, relative_path: str, version=None) -> str:
+        return '/archives/%s/versions/%s/files/%s' % (self.archive.uuid, (version or self.archive.last_version).uuid,
+                                                      relative_path)
+
+    def test_browse(self):
+        status, headers, body = self.request('/archives/%s/versions' % self.archive.uuid)
+        self.assertEqual(status, 200)
+        self.assertEqual([record['UUID'] for record in json.loads(body)], [self.archive.base_version.uuid])
+
+        status, headers, body = self.request('/archives/%s/versions/%s/tree/' % (
+            self.archive.uuid, self.archive.base_version.uuid))
+        listing = json.loads(body)
+        self.assertEqual(listing['Directories'], ['a'])
+        self.assertEqual([(file['Name'], file['Size']) for file in listing['Files']], [('hello.txt', 11)])
+        self.assertEqual(self.request(self.file_path('missing.txt'))[0], 404)
+        self.assertEqual(self.request(self.file_path('hello.txt'), method='DELETE')[0], 405)
+
+    def test_download(self):
+        status, headers, body = self.request(self.file_path('hello.txt'))
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'hello world')
+        self.assertEqual(headers['Content-Length'], '11')
+        self.assertEqual(headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(headers['Last-Modified'], 'Fri, 14 Jul 2017 02:40:00 GMT')
+        self.assertTrue(headers['ETag'])
+
+        status, headers, body = self.request(self.file_path('a/b.txt'), method='HEAD')
+        self.assertEqual((status, headers['Content-Length'], body), (200, '6', b''))
+
+    def test_ranges(self):
+        status, headers, body = self.request(self.file_path('hello.txt'), Range='bytes=6-')
+        self.assertEqual((status, body), (206, b'world'))
+        self.assertEqual(headers['Content-Range'], 'bytes 6-10/11')
+
+        status, headers, body = self.request(self.file_path('hello.txt'), Range='bytes=-3')
+        self.assertEqual((status, body), (206, b'rld'))
+        status, headers, body = self.request(self.file_path('hello.txt'), Range='bytes=2-4')
+        self.assertEqual((status, body), (206, b'llo'))
+
+        status, headers, body = self.request(self.file_path('hello.txt'), Range='bytes=11-')
+        self.assertEqual((status, body), (416, b''))
+        self.assertEqual(headers['Content-Range'], 'bytes */11')
+
+    def test_conditional_requests(self):
+        etag = self.request(self.file_path('hello.txt'))[1]['ETag']
+
+        status, headers, body = self.request(self.file_path('hello.txt'), **{'If-None-Match': etag})
+        self.assertEqual((status, headers['ETag'], body), (304, etag, b''))
+        self.assertEqual(self.request(self.file_path('hello.txt'), **{'If-None-Match': '"other"'})[0], 200)
+
+        # a range is only honoured while the file is still the one the client has part of
+        status, headers, body = self.request(self.file_path('hello.txt'), Range='bytes=0-4', **{'If-Range': etag})
+        self.assertEqual((status, body), (206, b'hello'))
+        status, headers, body = self.request(self.file_path('hello.txt'), Range='bytes=0-4',
+                                             **{'If-Range': '"other"'})
+        self.assertEqual((status, body), (200, b'hello world'))
+
+    def test_views_follow_migrations(self):
+        first_version = self.archive.base_version
+        self.write_source_file('hello.txt', b'hello again')
+        second_version = self.archive.create_version()
+        # the unchanged file is still held by the base version
+        self.assertEqual(self.request(self.file_path('a/b.txt', second_version))[2], b'nested')
+
+        # a third version migrates the base into the second one, moving the file there
+        self.write_source_file('a/b.txt', b'changed')
+        self.archive.create_version()
+        self.assertNotIn(first_version.uuid, [version.uuid for version in self.archive.versions])
+        self.assertFalse(os.path.exists(first_version.version_dir))
+        status, headers, body = self.request(self.file_path('a/b.txt', second_version))
+        self.assertEqual((status, body), (200, b'nested'))
+        self.assertEqual(self.request(self.file_path('a/b.txt', first_version))[0], 404)
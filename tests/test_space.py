@@ -0,0 +1,120 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Tests of the space counted for versions and archives, and of the byte quota kept by migrating versions.
+"""
+
+import os
+
+from abundant_test_case import AbundantTestCase
+
+__author__ = 'Kevin'
+
+
+class SpaceTest(AbundantTestCase):
+
+    def setUp(self):
+        super(SpaceTest, self).setUp()
+        self.write_source_file('x.txt', b'x' * 100)
+        self.write_source_file('a/y.txt', b'y' * 200)
+        self.write_source_file('a/b/z.txt', b'z' * 300)
+
+    def change_source(self, step: int):
+        """Store x.txt again, delete or bring back y.txt and add a file."""
+        self.write_source_file('x.txt', b'x' * (100 + step), 10 ** 18 + step)
+        y_path = os.path.join(self.source_dir, 'a', 'y.txt')
+        if os.path.exists(y_path):
+            os.remove(y_path)
+        else:
+            self.write_source_file(y_path, b'y' * 50)
+        self.write_source_file('new/n%s.txt' % step, b'n' * 10)
+
+    @staticmethod
+    def measure_on_disk(archive) -> list:
+        """Count the space of every version by walking what is stored on disk."""
+        versions = archive.versions
+        spaces = []
+        for index, version in enumerate(versions):
+            view = {relative_path: absolute_path for relative_path, absolute_path in version.files}
+            stored = {relative_path: os.path.getsize(absolute_path)
+                      for relative_path, absolute_path in version.exact_files}
+            if index + 1 < len(versions):
+                next_version = versions[index + 1]
+                next_view = {relative_path: absolute_path for relative_path, absolute_path in next_version.files}
+                # merging into the next version frees what it does not see, or holds a copy of its own
+                reclaimable = {relative_path: size for relative_path, size in stored.items()
+                               if relative_path not in next_view or
+                               next_view[relative_path] == next_version._get_full_path_of_file(relative_path)}
+            else:
+                reclaimable = stored
+            spaces.append({
+                'TotalFiles': len(view),
+                'TotalBytes': sum(os.path.getsize(absolute_path) for absolute_path in view.values()),
+                'UniqueFiles': len(stored),
+                'UniqueBytes': sum(stored.values()),
+                'ReclaimableFiles': len(reclaimable),
+                'ReclaimableBytes': sum(reclaimable.values())
+            })
+        return spaces
+
+    def assert_space_matches(self, archive):
+        spaces = self.measure_on_disk(archive)
+        self.assertEqual([version.space for version in archive.versions], spaces)
+        summary = archive.space
+        self.assertEqual(summary['Versions'], len(spaces))
+        self.assertEqual((summary['TotalFiles'], summary['TotalBytes']),
+                         (spaces[-1]['TotalFiles'], spaces[-1]['TotalBytes']))
+        self.assertEqual((summary['StoredFiles'], summary['StoredBytes']),
+                         (sum(space['UniqueFiles'] for space in spaces), sum(space['UniqueBytes'] for space in spaces)))
+        if len(spaces) > 1:
+            self.assertEqual((summary['ReclaimableFiles'], summary['ReclaimableBytes']),
+                             (spaces[0]['ReclaimableFiles'], spaces[0]['ReclaimableBytes']))
+
+    def test_counted_space_matches_stored_files(self):
+        archive = self.create_archive(max_number_of_versions=3)
+        archive.create_base()
+        self.assert_space_matches(archive)
+        for step in range(5):
+            self.change_source(step)
+            archive.create_version()
+            # counted as files move, through every migration of the base
+            self.assert_space_matches(archive)
+
+        archive.versions[1].remove()
+        for version in archive.versions:
+            version._save_space(None)
+        # measured again from scratch once dropped
+        self.assert_space_matches(archive)
+
+    def test_quota_migrates_oldest_versions(self):
+        archive = self.create_archive(max_number_of_versions=10)
+        archive.max_archive_bytes = 1000
+        archive.create_base()
+        for step in range(6):
+            self.change_source(step)
+            archive.create_version()
+            stored_bytes = sum(os.path.getsize(os.path.join(root, name))
+                               for root, _, names in os.walk(archive.storage.root_dir) for name in names)
+            self.assertLessEqual(stored_bytes, 1000)
+            self.assertEqual(archive.space['StoredBytes'], stored_bytes)
+            self.assert_space_matches(archive)
+        self.assertEqual(archive.space['MaxArchiveBytes'], 1000)
+        # migrations have taken versions away, yet the latest one still sees the whole source
+        self.assertLess(len(archive.versions), 7)
+        self.assertEqual(archive.last_version.space['TotalFiles'],
+                         sum(len(names) for _, _, names in os.walk(self.source_dir)))
+
+    def test_quota_keeps_the_latest_version(self):
+        archive = self.create_archive()
+        archive.max_archive_bytes = 100
+        archive.create_base()
+        self.change_source(0)
+        archive.create_version()
+
+        # a version larger than the quota is never migrated away
+        self.assertEqual(len(archive.versions), 1)
+        self.assertGreater(archive.space['StoredBytes'], 100)
+        self.assertEqual(archive.enforce_byte_quota(), 0)
+        with self.assertRaises(ValueError):
+            archive.max_archive_bytes = -1
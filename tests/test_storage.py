@@ -0,0 +1,142 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Tests of the storage backends, S3 running against an in-process fake object store.
+"""
+
+import os
+import concurrent.futures
+
+from abundant_test_case import AbundantTestCase
+from fake_s3 import FakeS3Server
+from storage import LocalStorageBackend, S3StorageBackend, StorageError, transfer_object
+
+__author__ = 'Kevin'
+
+
+class S3StorageBackendTest(AbundantTestCase):
+
+    def setUp(self):
+        super(S3StorageBackendTest, self).setUp()
+        self.server = FakeS3Server(page_size=2)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.storage = self.create_storage()
+
+    def create_storage(self, **overrides) -> S3StorageBackend:
+        storage = S3StorageBackend(self.server.get_storage_config(Prefix='archives/test', **overrides))
+        self.addCleanup(storage.close)
+        return storage
+
+    def put(self, key: str, content: bytes, storage=None):
+        path = self.write_source_file(key, content)
+        (storage or self.storage).put(key, path)
+
+    def test_round_trip(self):
+        self.put('version/a b/ünïcode.txt', b'hello world')
+        self.put('version/x.txt', b'x')
+
+        self.assertTrue(self.storage.exists('version/a b/ünïcode.txt'))
+        self.assertFalse(self.storage.exists('version/missing.txt'))
+        self.assertEqual(self.storage.size('version/a b/ünïcode.txt'), 11)
+        with self.storage.open('version/a b/ünïcode.txt') as file:
+            self.assertEqual(file.read(), b'hello world')
+        self.assertEqual(self.storage.range_read('version/a b/ünïcode.txt', 6, 100), b'world')
+        self.assertEqual(self.storage.range_read('version/x.txt', 5, 1), b'')
+        destination_path = os.path.join(self.temp_dir, 'fetched')
+        self.storage.get('version/x.txt', destination_path)
+        with open(destination_path, mode='rb') as file:
+            self.assertEqual(file.read(), b'x')
+        self.assertIn('archives/test/version/x.txt', self.server.objects)
+        with self.assertRaises(FileNotFoundError):
+            self.storage.size('version/missing.txt')
+
+        self.storage.move('version/x.txt', 'other/x.txt')
+        self.assertFalse(self.storage.exists('version/x.txt'))
+        self.assertEqual(self.storage.range_read('other/x.txt', 0, 1), b'x')
+        self.storage.delete('other/x.txt')
+        self.assertEqual(list(self.storage.list('other/')), [])
+
+    def test_list_follows_pages(self):
+        keys = ['version/%02d.txt' % number for number in range(7)]
+        for key in keys:
+            self.put(key, key.encode('utf-8'))
+        self.put('versions.txt', b'outside the prefix')
+
+        self.assertEqual(sorted(self.storage.list('version/')), keys)
+        self.assertEqual(len(list(self.storage.list())), 8)
+        # seven keys in pages of two
+        self.assertGreaterEqual(self.server.count_requests('GET', 'continuation-token'), 3)
+
+    def test_prefixes_are_kept_apart_from_objects(self):
+        self.storage.create_prefix('version/')
+        self.storage.create_prefix('version/empty/')
+        self.storage.create_prefix('version/a/')
+        self.put('version/a/x.txt', b'x')
+
+        self.assertEqual(list(self.storage.list('version/')), ['version/a/x.txt'])
+        self.assertEqual(sorted(self.storage.list_prefixes('version/')), ['version/a/', 'version/empty/'])
+        self.storage.delete_prefix('version/')
+        self.assertEqual(self.server.objects, {})
+
+    def test_multipart_upload(self):
+        storage = self.create_storage(MultipartThreshold=1024, PartSize=0)
+        content = os.urandom(storage.part_size * 2 + 1024)
+        self.put('version/large.bin', content, storage)
+
+        self.assertEqual(self.server.count_requests('PUT', 'partNumber'), 3)
+        self.assertEqual(self.server.objects['archives/test/version/large.bin'], content)
+        self.assertEqual(self.server.uploads, {})
+
+    def test_server_errors_are_retried(self):
+        self.server.failures_to_inject = 2
+        self.put('version/x.txt', b'x')
+
+        self.assertEqual(self.server.count_requests('PUT'), 3)
+        self.assertEqual(self.server.objects['archives/test/version/x.txt'], b'x')
+
+    def test_server_errors_give_up_after_retries(self):
+        self.server.failures_to_inject = 3
+        with self.assertRaises(StorageError):
+            self.put('version/x.txt', b'x')
+        self.assertEqual(self.server.count_requests('PUT'), 3)
+
+    def test_wrong_secret_is_rejected_without_retries(self):
+        storage = self.create_storage(SecretKey='wrong')
+        with self.assertRaises(StorageError):
+            self.put('version/x.txt', b'x', storage)
+        self.assertEqual(self.server.count_requests('PUT'), 1)
+
+    def test_connections_are_pooled(self):
+        storage = self.create_storage(MaxConnections=2)
+        for number in range(5):
+            self.put('version/%s.txt' % number, b'x', storage)
+        self.assertEqual(self.server.connections, 1)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda number: storage.size('version/%s.txt' % (number % 5)), range(40)))
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_transfer_between_backends(self):
+        local_storage = LocalStorageBackend(os.path.join(self.temp_dir, 'local'))
+        local_storage.put('version/x.txt', self.write_source_file('x.txt', b'x'))
+        transfer_object(local_storage, 'version/x.txt', self.storage)
+        transfer_object(self.storage, 'version/x.txt', local_storage, new_key='copy/x.txt')
+
+        self.assertEqual(local_storage.range_read('copy/x.txt', 0, 1), b'x')
+
+    def test_archive_round_trip(self):
+        self.write_source_file('x.txt', b'hello')
+        self.write_source_file('a/y.txt', b'one')
+        os.makedirs(os.path.join(self.source_dir, 'empty', 'nested'))
+        archive = self.create_archive(storage_config=self.server.get_storage_config(Prefix='archives'))
+        archive.create_base()
+        self.write_source_file('a/y.txt', b'two')
+        os.remove(os.path.join(self.source_dir, 'x.txt'))
+        version = archive.create_version()
+
+        export_dir = os.path.join(self.temp_dir, 'export')
+        os.mkdir(export_dir)
+        version.export(export_dir)
+        self.assertEqual(self.read_tree(export_dir), self.read_tree(self.source_dir))
@@ -0,0 +1,68 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Tests of scrubbing stored files against their recorded digests.
+"""
+
+import os
+import json
+
+from abundant_test_case import AbundantTestCase
+
+__author__ = 'Kevin'
+
+
+class VerifyTest(AbundantTestCase):
+
+    def setUp(self):
+        super(VerifyTest, self).setUp()
+        self.write_source_file('x.txt', b'hello')
+        self.write_source_file('a/y.txt', b'one')
+        self.write_source_file('a/b/z.txt', b'deep')
+        self.archive = self.create_archive()
+        self.archive.create_base()
+        self.base_uuid = self.archive.base_version.uuid
+
+    def read_verify_state(self) -> dict:
+        with open(os.path.join(self.archive.archive_dir, 'meta', 'verify_state.json')) as file:
+            return json.load(file)['LastVerified']
+
+    def test_intact_archive(self):
+        report = self.archive.verify()
+
+        self.assertEqual((report['Verified'], report['BytesVerified'], report['Remaining']), (3, 12, 0))
+        self.assertTrue(report['Complete'])
+        self.assertEqual((report['Corrupt'], report['Missing'], report['DriftedDirectories']), ([], [], []))
+        self.assertEqual(set(self.read_verify_state()),
+                         {self.base_uuid + '/x.txt', self.base_uuid + '/a/y.txt', self.base_uuid + '/a/b/z.txt'})
+
+    def test_corrupt_and_missing_files(self):
+        with open(self.archive.storage.locate(self.base_uuid + '/x.txt'), mode='wb') as file:
+            file.write(b'jello')
+        os.remove(self.archive.storage.locate(self.base_uuid + '/a/b/z.txt'))
+        report = self.archive.verify()
+
+        self.assertEqual(report['Corrupt'], [self.base_uuid + '/x.txt'])
+        self.assertEqual(report['Missing'], [self.base_uuid + '/a/b/z.txt'])
+        self.assertEqual(report['Verified'], 1)
+        # the lost file changed the stored tree, which is told without reading anything
+        self.assertIn('%s/a/b' % self.base_uuid, report['DriftedDirectories'])
+        # only files found intact count as verified, and the lost one is forgotten
+        self.assertEqual(set(self.read_verify_state()), {self.base_uuid + '/a/y.txt'})
+
+    def test_budget_verifies_least_recently_verified_first(self):
+        verified_keys = []
+        for _ in range(3):
+            # any budget lets one file through
+            report = self.archive.verify(max_bytes=1)
+            self.assertEqual((report['Verified'], report['Remaining'], report['Complete']), (1, 2, False))
+            new_keys = set(self.read_verify_state()).difference(verified_keys)
+            self.assertEqual(len(new_keys), 1)
+            verified_keys.extend(new_keys)
+        self.assertEqual(len(set(verified_keys)), 3)
+
+        # the file verified longest ago is the next one
+        self.archive.verify(max_bytes=1)
+        last_verified = self.read_verify_state()
+        self.assertEqual(max(last_verified, key=last_verified.get), verified_keys[0])
@@ -0,0 +1,135 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+I/O throttling for backup and export.
+"""
+
+import time
+import threading
+
+from log import ABUNDANT_LOGGER
+
+__author__ = 'Kevin'
+
+THROTTLE_CONFIG_TEMPLATE = {
+    'BytesPerSecond': 0,
+    'FilesPerSecond': 0,
+    'Windows': []
+}
+
+THROTTLE_WINDOW_TEMPLATE = {
+    'From': '00:00',
+    'To': '00:00',
+    'BytesPerSecond': 0,
+    'FilesPerSecond': 0
+}
+
+
+def _parse_time_of_day(time_of_day: str) -> int:
+    """Parse HH:MM into minutes since midnight."""
+    try:
+        hours, minutes = time_of_day.split(':')
+        minutes_since_midnight = int(hours) * 60 + int(minutes)
+    except ValueError:
+        raise ValueError('Invalid time of day: %s' % time_of_day)
+    if not 0 <= minutes_since_midnight < 24 * 60:
+        raise ValueError('Invalid time of day: %s' % time_of_day)
+    return minutes_since_midnight
+
+
+class TokenBucket:
+    """Thread-safe token bucket, a rate of zero means unlimited."""
+
+    def __init__(self, rate: float, capacity=None):
+        """Create the bucket with a rate in tokens per second.
+        The bucket holds at most one second worth of tokens unless told otherwise."""
+        self.lock = threading.Lock()
+        self.capacity = capacity
+        self.rate = self.tokens = 0
+        self.last_refill = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float):
+        """Change the rate of the bucket."""
+        if rate < 0:
+            raise ValueError('Rate cannot be negative: %s' % rate)
+        with self.lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, self._get_capacity())
+
+    def _get_capacity(self) -> float:
+        """Get the number of tokens the bucket can hold."""
+        return self.capacity if self.capacity is not None else self.rate
+
+    def consume(self, amount: float):
+        """Take tokens out of the bucket, blocking until they are paid back.
+        Requests larger than the capacity are allowed and put the bucket in debt."""
+        if amount <= 0:
+            return
+        with self.lock:
+            if not self.rate:
+                return
+            now = time.monotonic()
+            self.tokens = min(self._get_capacity(), self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class ThrottleAgent:
+    """Throttle agent limits bytes and files per second, optionally by time of day.
+    One agent is meant to be shared by every read and write of an archive."""
+
+    def __init__(self, throttle_config=None):
+        """Create the agent from the throttle section of an archive config."""
+        throttle_config = dict(THROTTLE_CONFIG_TEMPLATE, **(throttle_config or {}))
+        self.default_limits = (throttle_config['BytesPerSecond'], throttle_config['FilesPerSecond'])
+        self.windows = []
+        for window in throttle_config['Windows']:
+            window = dict(THROTTLE_WINDOW_TEMPLATE, **window)
+            self.windows.append((_parse_time_of_day(window['From']), _parse_time_of_day(window['To']),
+                                 (window['BytesPerSecond'], window['FilesPerSecond'])))
+        self.byte_bucket, self.file_bucket = TokenBucket(0), TokenBucket(0)
+        self.limits = None
+        self._update_limits()
+
+    @property
+    def is_unlimited(self) -> bool:
+        """Tell if this throttle never limits anything."""
+        return not any(self.default_limits) and not any(any(limits) for _, _, limits in self.windows)
+
+    def get_limits(self, now=None) -> tuple:
+        """Get bytes and files per second in effect at a time."""
+        local_time = time.localtime(now)
+        minutes_since_midnight = local_time.tm_hour * 60 + local_time.tm_min
+        for start, end, limits in self.windows:
+            # windows such as 22:00 to 06:00 wrap around midnight
+            if start <= end and start <= minutes_since_midnight < end:
+                return limits
+            if start > end and (minutes_since_midnight >= start or minutes_since_midnight < end):
+                return limits
+        return self.default_limits
+
+    def _update_limits(self):
+        """Apply the limits of the current time window to the buckets."""
+        limits = self.get_limits()
+        if limits != self.limits:
+            self.limits = limits
+            self.byte_bucket.set_rate(limits[0])
+            self.file_bucket.set_rate(limits[1])
+            ABUNDANT_LOGGER.debug('Throttle set to %s byte(s)/s and %s file(s)/s', *limits)
+
+    def consume(self, number_of_bytes=0, number_of_files=0):
+        """Account for some I/O, blocking while over the limits."""
+        if not self.windows and not any(self.limits):
+            return
+        if self.windows:
+            self._update_limits()
+        self.file_bucket.consume(number_of_files)
+        self.byte_bucket.consume(number_of_bytes)
+
+    def __str__(self):
+        return 'ThrottleAgent %s byte(s)/s %s file(s)/s' % self.limits
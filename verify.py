@@ -0,0 +1,160 @@
+#!/usr/env/bin python
+# -*- encoding: utf-8 -*-
+
+"""
+Scrubbing archived files against their recorded digests.
+"""
+
+import os
+import time
+import concurrent.futures
+
+from config import get_config, create_config
+from manifest import create_manifest_record
+from merkle import build_directory_digests, get_differing_directories
+from log import ABUNDANT_LOGGER
+
+__author__ = 'Kevin'
+
+VERIFY_STATE_TEMPLATE = {
+    'VerifyStateVersion': 0.1,
+    'LastVerified': {}
+}
+
+VERIFY_REPORT_TEMPLATE = {
+    'Verified': 0,
+    'Enrolled': 0,
+    'BytesVerified': 0,
+    'Corrupt': [],
+    'Missing': [],
+    'DriftedDirectories': [],
+    'Remaining': 0,
+    'Complete': True
+}
+
+
+class VerifyStateAgent:
+    """Agent for the persisted last-verified time of every stored file, keyed by storage key."""
+
+    def __init__(self, archive_dir: str):
+        """Create the agent for an archive."""
+        self.verify_state_path = os.path.join(archive_dir, 'meta', 'verify_state.json')
+        if not os.path.exists(self.verify_state_path):
+            create_config(VERIFY_STATE_TEMPLATE, self.verify_state_path)
+        with get_config(self.verify_state_path) as verify_state:
+            self.last_verified = verify_state['LastVerified']
+
+    def save(self, existing_keys: set):
+        """Save the state, forgetting keys that no longer exist."""
+        with get_config(self.verify_state_path, save_change=True) as verify_state:
+            verify_state['LastVerified'] = {key: timestamp for key, timestamp in self.last_verified.items()
+                                            if key in existing_keys}
+
+
+def find_drifted_directories(version) -> list:
+    """Compare the stored directory digests of a version with digests built again from its listing and
+    manifest, without reading any file, and get the deepest directories that differ.
+    The digests built again replace the saved ones.
+    :type version: VersionAgent"""
+    saved_digests = version.merkle_tree['Stored']
+    if not saved_digests:
+        return []
+    digests = build_directory_digests(version._iterate_stored_leaves())
+    drifted_directories = get_differing_directories(saved_digests, digests)
+    if drifted_directories:
+        version.merkle_tree_agent.update(Stored=digests)
+        version.reload_merkle_tree()
+        for directory in drifted_directories:
+            ABUNDANT_LOGGER.warning('Stored files drifted from the tree of version %s in /%s', version.uuid, directory)
+    return drifted_directories
+
+
+def verify_archive(archive_agent, max_seconds=None, max_bytes=None, max_workers: int = 4) -> dict:
+    """Re-hash stored files in parallel, least recently verified first, until the budget runs out.
+    Files without a known digest are hashed and enrolled instead of judged.
+    Directories whose stored files no longer match their tree are reported first, which takes no reading.
+    :type archive_agent: ArchiveAgent"""
+    start_time = time.time()
+    state = VerifyStateAgent(archive_agent.archive_dir)
+
+    # collect every stored file with its expected digest
+    candidates = []
+    for version in archive_agent.versions:
+        records = version.manifest_records
+        listed_paths = set()
+        for relative_path, absolute_path in version.exact_files:
+            listed_paths.add(relative_path)
+            record = records.get(relative_path)
+            candidates.append((version, relative_path, record['Digest'] if record else None,
+                               record['Size'] if record else 0))
+        for relative_path in records:
+            if relative_path not in listed_paths and not records[relative_path].get('Deleted'):
+                candidates.append((version, relative_path, records[relative_path]['Digest'], -1))
+    existing_keys = {version._get_key_of_file(relative_path) for version, relative_path, _, _ in candidates}
+    candidates.sort(key=lambda x: state.last_verified.get(x[0]._get_key_of_file(x[1]), 0))
+
+    report = dict(VERIFY_REPORT_TEMPLATE, Corrupt=[], Missing=[], DriftedDirectories=[])
+    for version in archive_agent.versions:
+        report['DriftedDirectories'].extend('%s/%s' % (version.uuid, directory)
+                                            for directory in find_drifted_directories(version))
+    enrolled = {version.uuid: {} for version in archive_agent.versions}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+        candidate_index = 0
+        while candidate_index < len(candidates) or in_flight:
+            # keep the pool busy while there is budget left
+            while candidate_index < len(candidates) and len(in_flight) < max_workers * 2:
+                if max_seconds is not None and time.time() - start_time >= max_seconds:
+                    break
+                if max_bytes is not None and report['BytesVerified'] >= max_bytes:
+                    break
+                version, relative_path, digest, size = candidates[candidate_index]
+                candidate_index += 1
+                key = version._get_key_of_file(relative_path)
+                if size < 0:
+                    report['Missing'].append(key)
+                    ABUNDANT_LOGGER.error('Missing file %s', key)
+                    continue
+                report['BytesVerified'] += size
+                in_flight[executor.submit(version._hash_file, relative_path)] = (version, relative_path, digest)
+            if not in_flight:
+                break
+
+            done, not_done = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                version, relative_path, digest = in_flight.pop(future)
+                key = version._get_key_of_file(relative_path)
+                try:
+                    actual_digest = future.result()
+                except FileNotFoundError:
+                    report['Missing'].append(key)
+                    ABUNDANT_LOGGER.error('Missing file %s', key)
+                    continue
+                if digest is None:
+                    enrolled[version.uuid][relative_path] = create_manifest_record(
+                        relative_path, version.storage.size(key), actual_digest)
+                    report['Enrolled'] += 1
+                elif actual_digest != digest:
+                    report['Corrupt'].append(key)
+                    ABUNDANT_LOGGER.error('Corrupt file %s: expected %s, got %s', key, digest, actual_digest)
+                    continue
+                report['Verified'] += 1
+                state.last_verified[key] = time.time()
+
+    for version in archive_agent.versions:
+        version.manifest.update(enrolled[version.uuid])
+        version.reload_manifest()
+        # enrolled digests replace the sizes standing for unknown ones
+        if enrolled[version.uuid] and version.merkle_tree['Stored']:
+            version.build_merkle_tree(view=False)
+    state.save(existing_keys)
+
+    report['Remaining'] = len(candidates) - candidate_index
+    report['Complete'] = report['Remaining'] == 0
+    ABUNDANT_LOGGER.info('Verified %s file(s) (%s byte(s)) of archive %s in %.1fs: %s corrupt, %s missing, '
+                         '%s enrolled, %s remaining, %s drifted director(ies)', report['Verified'],
+                         report['BytesVerified'], archive_agent.uuid, time.time() - start_time, len(report['Corrupt']),
+                         len(report['Missing']), report['Enrolled'], report['Remaining'],
+                         len(report['DriftedDirectories']))
+    return report
@@ -7,13 +7,23 @@ Agents for various backup versions.
 
 import time
 import os
+import glob
 import uuid
-import shutil
+import heapq
+import itertools
 # from archive import ArchiveAgent
-from log import ABUNDANT_LOGGER
+from log import ABUNDANT_LOGGER, FileEventLog
 from hash import HashAgent
 from config import get_config, create_config
-from support import get_relative_path
+from bloom import PathFilterAgent
+from merkle import MerkleTreeAgent, DirectoryCover, ROOT_DIRECTORY, build_directory_digests, \
+    get_equal_directories
+from manifest import ManifestAgent, ManifestCursor, create_manifest_record, create_deletion_record
+from external import ExternalSorter, merge_join, get_memory_ceiling, is_memory_bounded
+from space import SpaceCounter
+from export import stream_export, ExportEngine, SyncEngine
+from support import get_relative_path, match_path
+from progress import OperationCancelled, check_cancellation
 
 __author__ = 'Kevin'
 
@@ -25,20 +35,31 @@ VERSION_CONFIG_TEMPLATE = {
 VERSION_RECORD_TEMPLATE = {
     'TimeOfCreation': '',
     'IsBaseVersion': False,
-    'UUID': ''
+    'UUID': '',
+    'Space': None
 }
 
 
 class VersionAgent:
     """Actual version agent."""
 
-    def __init__(self, uuid: str, archive_agent):
+    def __init__(self, uuid: str, archive_agent, version_record=None):
         """Create the version agent from a version uid.
+        The version record is read from the version config unless it is given.
         :type archive_agent: ArchiveAgent"""
         self.uuid, self.archive_agent = uuid, archive_agent
         self.version_config_path = os.path.join(archive_agent.archive_dir, 'meta', 'version_config.json')
-        self.hasher = HashAgent(archive_agent.algorithm)
-        self.load_config()
+        self.hasher = HashAgent(archive_agent.algorithm, throttle=archive_agent.throttle, metrics=archive_agent.metrics)
+        self.manifest = ManifestAgent(archive_agent.archive_dir, uuid)
+        self._manifest_records = self._deleted_paths = None
+        self.path_filter_agent = PathFilterAgent(archive_agent.archive_dir, uuid)
+        self._path_filter, self._path_filter_loaded = None, False
+        self.merkle_tree_agent = MerkleTreeAgent(archive_agent.archive_dir, uuid)
+        self._merkle_tree = None
+        if version_record is None:
+            self.load_config()
+        else:
+            self.version_config = dict(version_record)
 
     def load_config(self):
         """Load configuration for this version."""
@@ -46,9 +67,9 @@ class VersionAgent:
             for version in version_config['VersionRecords']:
                 if version['UUID'] == self.uuid:
                     self.version_config = dict(version)
-                    ABUNDANT_LOGGER.debug('Version record found: %s' % self.uuid)
+                    ABUNDANT_LOGGER.debug('Version record found: %s', self.uuid)
                     return
-        ABUNDANT_LOGGER.error('Cannot find config for version %s' % self.uuid)
+        ABUNDANT_LOGGER.error('Cannot find config for version %s', self.uuid)
         raise FileNotFoundError('Cannot find config for version %s' % self.uuid)
 
     @property
@@ -65,9 +86,9 @@ class VersionAgent:
                     version['IsBaseVersion'] = is_base_version
                     break
         if is_base_version:
-            ABUNDANT_LOGGER.info('Version %s is now base version' % self.uuid)
+            ABUNDANT_LOGGER.info('Version %s is now base version', self.uuid)
         else:
-            ABUNDANT_LOGGER.info('Version %s is now non-base version' % self.uuid)
+            ABUNDANT_LOGGER.info('Version %s is now non-base version', self.uuid)
 
     @property
     def time_of_creation(self) -> float:
@@ -79,6 +100,12 @@ class VersionAgent:
         """Get the directory of this version."""
         return os.path.join(self.archive_agent.archive_dir, 'archive', self.uuid)
 
+    @property
+    def storage(self):
+        """Get the storage backend holding the data of this version.
+        :rtype: StorageBackend"""
+        return self.archive_agent.storage
+
     @property
     def _base_version(self) -> 'VersionAgent':
         """Get the base version of the archive this version is in."""
@@ -87,46 +114,258 @@ class VersionAgent:
     @property
     def exact_files(self):
         """Generator for files in the directory of this version."""
-        for root_dir, dirs, files in os.walk(self.version_dir):
-            for file in files:
-                absolute_path = os.path.join(root_dir, file)
-                relative_path = self._get_relative_path_of_file(absolute_path)
-                yield relative_path, absolute_path
+        for key in self.storage.list(self.uuid + '/'):
+            relative_path = self._get_relative_path_of_key(key)
+            yield relative_path, self.storage.locate(key)
 
     @property
     def files(self):
-        """Generator for all files in this version."""
-        base_version = self.archive_agent.base_version
+        """Generator for all files in this version.
+        With a memory ceiling they come in path order from a merge of sorted runs."""
+        if is_memory_bounded():
+            for relative_path, holder in self._iterate_view():
+                yield relative_path, holder._get_full_path_of_file(relative_path)
+            return
+
+        # walk from this version back to the base version, the first
+        # version holding or deleting a file decides whether it is in this version
+        paths_seen = set()
+        version_in_work = self
+        while version_in_work:
+            for relative_path, absolute_path in version_in_work.exact_files:
+                if relative_path not in paths_seen:
+                    paths_seen.add(relative_path)
+                    yield relative_path, absolute_path
+            paths_seen.update(version_in_work.deleted_paths)
+            version_in_work = version_in_work.previous_version
 
-        # find the currently effective version for all files existing since base version
-        for root_dir, dirs, files in os.walk(base_version.version_dir):
-            for file in files:
-                effective_absolute_path = os.path.join(root_dir, file)
-                relative_path = base_version._get_relative_path_of_file(effective_absolute_path)
+    @property
+    def directories(self):
+        """Generator for the relative paths of all source directories when this version was created,
+        empty ones included."""
+        prefix = self.uuid + '/'
+        for kept_prefix in self.storage.list_prefixes(prefix):
+            yield self._get_relative_path_of_key(kept_prefix.rstrip('/'))
+
+    def _keep_directories(self, root_dir: str, dirs: list):
+        """Keep the source directories under a walked directory in the storage, so empty ones are restored."""
+        source_dir = self.archive_agent.source_dir
+        for directory in dirs:
+            relative_dir = get_relative_path(os.path.join(root_dir, directory), source_dir)
+            self.storage.create_prefix(self._get_key_of_file(relative_dir) + '/')
+
+    def _create_sorter(self, share: int = 1, key=None) -> ExternalSorter:
+        """Create a sorter spilling into the meta directory of the archive, within a share of the memory ceiling."""
+        return ExternalSorter(key, max(get_memory_ceiling() // share, 1),
+                              os.path.join(self.archive_agent.archive_dir, 'meta', 'tmp'))
+
+    def _iterate_sorted_entries(self, rank: int, share: int = 1):
+        """Get an iterator over (relative path, rank, deleted) of the files stored or deleted in this version,
+        in path order."""
+        stored_paths = self._create_sorter(share)
+        for key in self.storage.list(self.uuid + '/'):
+            stored_paths.add([self._get_relative_path_of_key(key), rank, False])
+        deleted_paths = ([record['Path'], rank, True] for record in self.manifest.records if record.get('Deleted'))
+        return heapq.merge(stored_paths, deleted_paths)
+
+    def _iterate_view(self, share: int = 1):
+        """Generator for (relative path, holding version) of all files in this version, in path order.
+        Memory stays within a share of the ceiling whatever the number of files."""
+        versions = []
+        version_in_work = self
+        while version_in_work:
+            versions.append(version_in_work)
+            version_in_work = version_in_work.previous_version
 
-                # find last appearance of this file
-                last_appearance_version = base_version._get_last_appearance_of_file(relative_path)
-                yield relative_path, last_appearance_version._get_full_path_of_file(relative_path)
+        # the newest version holding or deleting a path comes first and decides
+        last_path = None
+        for relative_path, rank, deleted in heapq.merge(*[
+                version._iterate_sorted_entries(rank, share * len(versions)) for rank, version in enumerate(versions)]):
+            if relative_path != last_path:
+                last_path = relative_path
+                if not deleted:
+                    yield relative_path, versions[rank]
+
+    def _iterate_view_records(self, share: int = 1):
+        """Generator for (relative path, holding version, manifest record or None) of all files in this version,
+        in path order."""
+        cursors = {}
+        for relative_path, holder in self._iterate_view(share):
+            if holder.uuid not in cursors:
+                cursors[holder.uuid] = ManifestCursor(holder.manifest)
+            yield relative_path, holder, cursors[holder.uuid].get(relative_path)
+
+    @staticmethod
+    def _get_digest_of_view_entry(relative_path: str, holder: 'VersionAgent', record: dict) -> str:
+        """Get the digest of a file of a view, hashing it only when the manifest does not know it."""
+        if record and record['Digest']:
+            return record['Digest']
+        return holder._hash_file(relative_path)
+
+    def _get_effective_version_of_file(self, relative_path: str) -> 'VersionAgent':
+        """Get the version holding the copy of a file effective in this version."""
+        version_in_work = self
+        while version_in_work:
+            if version_in_work.has_file(relative_path):
+                return version_in_work
+            if relative_path in version_in_work.deleted_paths:
+                return None
+            version_in_work = version_in_work.previous_version
+        return None
+
+    def resolve(self, pattern: str):
+        """Generator for files in this version matching a relative path or a glob,
+        where * stays within a directory and ** spans directories.
+        Only directories under the literal leading part of the pattern are listed."""
+        pattern = pattern.strip('/').replace(os.sep, '/')
+        if not glob.has_magic(pattern):
+            effective_version = self._get_effective_version_of_file(pattern)
+            if effective_version is not None:
+                yield pattern, effective_version._get_full_path_of_file(pattern)
+            return
+
+        # split the pattern into a literal directory prefix and the part to match
+        literal_parts = []
+        for part in pattern.split('/')[:-1]:
+            if glob.has_magic(part):
+                break
+            literal_parts.append(part)
+        key_prefix = ''.join(part + '/' for part in literal_parts)
 
-        # find all files that was added after the base version
+        paths_seen = set()
         version_in_work = self
-        while version_in_work and version_in_work != base_version:
-            for root_dir, dirs, files in os.walk(version_in_work.version_dir):
-                for file in files:
-                    absolute_path = os.path.join(root_dir, file)
-                    relative_path = version_in_work._get_relative_path_of_file(absolute_path)
-
-                    # if file exists in base version than ignore it
-                    if base_version.has_file(relative_path):
-                        continue
-
-                    # otherwise find the last appearance of that file
-                    # and yield it if that version is current version
-                    last_appearance_version = version_in_work._get_last_appearance_of_file(relative_path)
-                    if last_appearance_version == version_in_work:
-                        yield relative_path, version_in_work._get_full_path_of_file(relative_path)
+        while version_in_work:
+            for key in version_in_work.storage.list(version_in_work.uuid + '/' + key_prefix):
+                relative_path = version_in_work._get_relative_path_of_key(key)
+                if relative_path not in paths_seen and match_path(pattern, relative_path.replace(os.sep, '/')):
+                    paths_seen.add(relative_path)
+                    yield relative_path, version_in_work.storage.locate(key)
+            paths_seen.update(version_in_work.deleted_paths)
             version_in_work = version_in_work.previous_version
 
+    def _get_effective_record_of_file(self, relative_path: str) -> tuple:
+        """Get the version holding the effective copy of a file in this version and its size and digest.
+        Returns None if the file is not in this version."""
+        effective_version = self._get_effective_version_of_file(relative_path)
+        if effective_version is None:
+            return None
+        return self._get_record_of_view_entry(relative_path, effective_version,
+                                              effective_version.manifest_records.get(relative_path))
+
+    def _get_record_of_view_entry(self, relative_path: str, holder: 'VersionAgent', record: dict) -> tuple:
+        """Get the holding version, size and digest of a file of a view."""
+        if record is not None:
+            return holder, record['Size'], record['Digest']
+        return holder, self.storage.size(holder._get_key_of_file(relative_path)), ''
+
+    @staticmethod
+    def _get_change(older_record: tuple, newer_record: tuple) -> str:
+        """Get how a file changed between two effective records, None if it did not."""
+        if older_record is None and newer_record is None:
+            return None
+        if older_record is None:
+            return 'added'
+        if newer_record is None:
+            return 'removed'
+        if older_record[0] == newer_record[0] or (older_record[2] and older_record[2] == newer_record[2]):
+            return None
+        return 'modified'
+
+    @staticmethod
+    def _get_equal_view_directories(older_version: 'VersionAgent', newer_version: 'VersionAgent') -> DirectoryCover:
+        """Get the cover of the directories whose whole subtrees are equal in the views of two versions."""
+        return DirectoryCover(get_equal_directories(older_version.merkle_tree['View'],
+                                                    newer_version.merkle_tree['View']))
+
+    @staticmethod
+    def _diff_changed_paths(older_version: 'VersionAgent', newer_version: 'VersionAgent'):
+        """Generator for changes from an older version to a newer one, looking at changed paths only."""
+        # a path can only differ if some version after the older one stored or deleted it,
+        # and only if it is not in a subtree both views have the same digest for
+        equal_directories = VersionAgent._get_equal_view_directories(older_version, newer_version)
+        if equal_directories.covers_directory(ROOT_DIRECTORY):
+            return
+        paths_seen = set()
+        version_in_work = newer_version
+        while version_in_work and version_in_work != older_version:
+            changed_paths = itertools.chain((relative_path for relative_path, _ in version_in_work.exact_files),
+                                            version_in_work.deleted_paths)
+            for relative_path in changed_paths:
+                if relative_path in paths_seen:
+                    continue
+                paths_seen.add(relative_path)
+                if equal_directories.covers(relative_path):
+                    continue
+
+                older_record = older_version._get_effective_record_of_file(relative_path)
+                newer_record = newer_version._get_effective_record_of_file(relative_path)
+                change = VersionAgent._get_change(older_record, newer_record)
+                if change is not None:
+                    yield change, relative_path, older_record[1] if older_record else None, \
+                          newer_record[1] if newer_record else None
+            version_in_work = version_in_work.previous_version
+
+    @staticmethod
+    def _diff_in_path_order(older_version: 'VersionAgent', newer_version: 'VersionAgent'):
+        """Generator for changes from an older version to a newer one in bounded memory,
+        merge-joining both sorted views."""
+        equal_directories = VersionAgent._get_equal_view_directories(older_version, newer_version)
+        if equal_directories.covers_directory(ROOT_DIRECTORY):
+            return
+        for relative_path, older_entry, newer_entry in merge_join(older_version._iterate_view_records(2),
+                                                                  newer_version._iterate_view_records(2),
+                                                                  key=lambda entry: entry[0]):
+            if equal_directories.covers(relative_path):
+                continue
+            older_record = older_version._get_record_of_view_entry(*older_entry) if older_entry else None
+            newer_record = newer_version._get_record_of_view_entry(*newer_entry) if newer_entry else None
+            change = VersionAgent._get_change(older_record, newer_record)
+            if change is not None:
+                yield change, relative_path, older_record[1] if older_record else None, \
+                      newer_record[1] if newer_record else None
+
+    def diff(self, other: 'VersionAgent'):
+        """Generator for changes from this version to another one, as (change, relative path, size in this
+        version, size in the other version) where change is added, removed or modified.
+        Only paths stored or deleted by versions between the two are looked at, file contents never are,
+        and subtrees with the same directory digest in both versions are skipped.
+        With a memory ceiling both views are merge-joined in path order instead."""
+        if other == self:
+            return
+        older_version, newer_version = (self, other) if self < other else (other, self)
+        reverse = older_version != self
+
+        if is_memory_bounded():
+            changes = self._diff_in_path_order(older_version, newer_version)
+        else:
+            changes = self._diff_changed_paths(older_version, newer_version)
+        for change, relative_path, older_size, newer_size in changes:
+            if reverse:
+                change = {'added': 'removed', 'removed': 'added'}.get(change, change)
+                older_size, newer_size = newer_size, older_size
+            yield change, relative_path, older_size, newer_size
+
+    def restore(self, pattern: str, destination_dir: str) -> int:
+        """Restore files matching a relative path or a glob into destination directory.
+        Returns the number of files restored."""
+        if not os.path.exists(destination_dir):
+            ABUNDANT_LOGGER.error('Cannot find destination directory: %s', destination_dir)
+            raise FileNotFoundError('Cannot find destination directory: %s' % destination_dir)
+
+        number_of_file_restored = 0
+        throttle = self.archive_agent.throttle
+        file_events = FileEventLog()
+        for relative_path, absolute_path in self.resolve(pattern):
+            destination_path = os.path.join(destination_dir, relative_path)
+            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+            self.storage.get(self.storage.key_of(absolute_path), destination_path, throttle)
+            number_of_file_restored += 1
+            file_events.debug('Restored %s', destination_path)
+        file_events.summarise()
+        ABUNDANT_LOGGER.info('Restored %s file(s) matching %s from version %s to %s', number_of_file_restored,
+                             pattern, self.uuid, destination_dir)
+        return number_of_file_restored
+
     def __str__(self):
         return 'Version %s' % self.uuid
 
@@ -149,16 +388,217 @@ class VersionAgent:
         return self.time_of_creation <= other.time_of_creation
 
     def has_file(self, relative_path: str) -> bool:
-        """Tell if this version contains a file."""
-        return os.path.exists(self._get_full_path_of_file(relative_path))
+        """Tell if this version contains a file.
+        Files ruled out by the path filter are not looked up in the storage."""
+        path_filter = self.path_filter
+        if path_filter is not None and relative_path.replace(os.sep, '/') not in path_filter:
+            return False
+        return self.storage.exists(self._get_key_of_file(relative_path))
+
+    @property
+    def path_filter(self):
+        """Get the Bloom filter of the paths stored in this version, None if it has none.
+        :rtype: BloomFilter"""
+        if not self._path_filter_loaded:
+            self._path_filter, self._path_filter_loaded = self.path_filter_agent.load(), True
+        return self._path_filter
+
+    def build_path_filter(self):
+        """Build the path filter from the files stored in this version."""
+        prefix = self.uuid + '/'
+        number_of_files = sum(1 for _ in self.storage.list(prefix))
+        self._path_filter = self.path_filter_agent.build((key[len(prefix):] for key in self.storage.list(prefix)),
+                                                         number_of_files)
+        self._path_filter_loaded = True
+
+    @property
+    def merkle_tree(self) -> dict:
+        """Get the directory digests of this version, View for the files effective in it and Stored for
+        the files stored in it, each empty if unknown."""
+        if self._merkle_tree is None:
+            self._merkle_tree = self.merkle_tree_agent.load()
+        return self._merkle_tree
+
+    def reload_merkle_tree(self):
+        """Forget cached directory digests so they are read again on next use."""
+        self._merkle_tree = None
+
+    def _iterate_view_leaves(self):
+        """Generator for (relative path, leaf digest) of all files in this version, in path order.
+        A file without a known digest is represented by the version holding it."""
+        def get_leaf(holder: 'VersionAgent', record: dict) -> str:
+            return record['Digest'] if record and record['Digest'] else '@' + holder.uuid
+
+        if is_memory_bounded():
+            for relative_path, holder, record in self._iterate_view_records():
+                yield relative_path, get_leaf(holder, record)
+            return
+        leaves = []
+        holders = {}
+        for relative_path, absolute_path in self.files:
+            holder_uuid = self.storage.key_of(absolute_path).split('/', 1)[0]
+            if holder_uuid not in holders:
+                holders[holder_uuid] = self.archive_agent.get_version(holder_uuid)
+            holder = holders[holder_uuid]
+            leaves.append((relative_path, get_leaf(holder, holder.manifest_records.get(relative_path))))
+        yield from sorted(leaves)
+
+    def _iterate_stored_leaves(self):
+        """Generator for (relative path, leaf digest) of the files stored in this version, in path order.
+        A file without a known digest is represented by its size."""
+        def get_leaf(relative_path: str, record: dict) -> str:
+            if record and record['Digest']:
+                return record['Digest']
+            return '@%s' % self.storage.size(self._get_key_of_file(relative_path))
+
+        if is_memory_bounded():
+            stored_paths = self._create_sorter()
+            stored_paths.extend([self._get_relative_path_of_key(key)] for key in self.storage.list(self.uuid + '/'))
+            cursor = ManifestCursor(self.manifest)
+            for relative_path, in stored_paths:
+                yield relative_path, get_leaf(relative_path, cursor.get(relative_path))
+            return
+        records = self.manifest_records
+        for relative_path in sorted(relative_path for relative_path, _ in self.exact_files):
+            yield relative_path, get_leaf(relative_path, records.get(relative_path))
+
+    def build_merkle_tree(self, view=True):
+        """Build the directory digests of the files stored in this version and, unless told otherwise,
+        of the files effective in it."""
+        digests = {'Stored': build_directory_digests(self._iterate_stored_leaves())}
+        if view:
+            digests['View'] = build_directory_digests(self._iterate_view_leaves())
+        self.merkle_tree_agent.update(**digests)
+        self.reload_merkle_tree()
+
+    @property
+    def space(self) -> dict:
+        """Get the files and bytes in the view of this version, those stored in it alone and those merging it
+        into its next version would free, which for the latest version is all it stores.
+        The counts are kept in the version record as files move, and measured once for records without them."""
+        if not self.version_config.get('Space'):
+            self._save_space(self.measure_space())
+        return dict(self.version_config['Space'])
+
+    def measure_space(self) -> dict:
+        """Measure the space of this version from its stored and deleted files and the space of the
+        previous version."""
+        previous_version, next_version = self.previous_version, self.next_version
+        counter = self._start_space_count()
+        changed_paths = [relative_path for relative_path, _ in self.exact_files]
+        if previous_version:
+            for relative_path in changed_paths + sorted(self.deleted_paths):
+                previous_record = previous_version._get_effective_record_of_file(relative_path)
+                if previous_record is not None:
+                    counter.replace(previous_record[0].uuid, previous_record[1])
+        for relative_path in changed_paths:
+            counter.store(self._get_size_of_stored_file(relative_path))
+        space = counter.space
+        if next_version:
+            space['ReclaimableFiles'] = space['ReclaimableBytes'] = 0
+            for relative_path in changed_paths:
+                if next_version._overrides_file(relative_path):
+                    space['ReclaimableFiles'] += 1
+                    space['ReclaimableBytes'] += self._get_size_of_stored_file(relative_path)
+        ABUNDANT_LOGGER.debug('Measured space of version %s: %s', self.uuid, space)
+        return space
+
+    def _start_space_count(self) -> SpaceCounter:
+        """Start counting the space of this version from the view of the previous version."""
+        previous_version = self.previous_version
+        return SpaceCounter(previous_version.uuid, previous_version.space) if previous_version else SpaceCounter()
+
+    def _finish_space_count(self, counter: SpaceCounter):
+        """Keep the space counted for this version as the latest one, and what merging the previous version
+        into it would now free."""
+        self._save_space(counter.space)
+        previous_version = self.previous_version
+        if previous_version:
+            previous_version._save_space(dict(previous_version.space, ReclaimableFiles=counter.overridden_files,
+                                              ReclaimableBytes=counter.overridden_bytes))
+
+    def _save_space(self, space):
+        """Replace the space kept in the version record, None dropping it to be measured again."""
+        with get_config(self.version_config_path, save_change=True) as version_config:
+            for version in version_config['VersionRecords']:
+                if version['UUID'] == self.uuid:
+                    version['Space'] = space
+                    break
+        self.version_config['Space'] = dict(space) if space else None
+
+    def _update_space(self, reclaim_all=False, **changes):
+        """Add changes to the space kept in the version record, everything stored becoming reclaimable if asked.
+        A space yet to be measured is left alone, the measurement will see the changes anyway."""
+        with get_config(self.version_config_path, save_change=True) as version_config:
+            for version in version_config['VersionRecords']:
+                if version['UUID'] == self.uuid and version.get('Space'):
+                    space = version['Space']
+                    for name, change in changes.items():
+                        space[name] += change
+                    if reclaim_all:
+                        space.update(ReclaimableFiles=space['UniqueFiles'], ReclaimableBytes=space['UniqueBytes'])
+                    self.version_config['Space'] = dict(space)
+                    break
+
+    def _overrides_file(self, relative_path: str) -> bool:
+        """Tell if this version stores or deletes a file, so the copy in the previous version is not seen."""
+        return self.has_file(relative_path) or relative_path in self.deleted_paths
+
+    def _get_size_of_stored_file(self, relative_path: str) -> int:
+        """Get the size of a file stored in this version, asking the storage only when the manifest does not
+        know it."""
+        record = self.manifest_records.get(relative_path)
+        if record is not None and not record.get('Deleted'):
+            return record['Size']
+        return self.storage.size(self._get_key_of_file(relative_path))
+
+    def _get_key_of_file(self, relative_path: str) -> str:
+        """Get the storage key of a file."""
+        return '%s/%s' % (self.uuid, relative_path.replace(os.sep, '/'))
+
+    def _get_relative_path_of_key(self, key: str) -> str:
+        """Get the relative path of a storage key."""
+        return key[len(self.uuid) + 1:].replace('/', os.sep)
 
     def _get_full_path_of_file(self, relative_path: str) -> str:
         """Get the full path of a file."""
-        return os.path.join(self.version_dir, relative_path)
+        return self.storage.locate(self._get_key_of_file(relative_path))
 
     def _get_relative_path_of_file(self, absolute_path: str) -> str:
         """Get the relative path of a file."""
-        return absolute_path.replace(self.version_dir, '', 1).lstrip('/').lstrip('\\')
+        return self._get_relative_path_of_key(self.storage.key_of(absolute_path))
+
+    def _hash_file(self, relative_path: str) -> str:
+        """Hash a file stored in this version."""
+        with self.storage.open(self._get_key_of_file(relative_path)) as file:
+            return self.hasher.hash_file(file)
+
+    @property
+    def manifest_records(self) -> dict:
+        """Get manifest records of files stored in this version, keyed by relative path."""
+        if self._manifest_records is None:
+            self._manifest_records = self.manifest.load()
+        return self._manifest_records
+
+    @property
+    def deleted_paths(self) -> set:
+        """Get relative paths of files deleted from the source in this version."""
+        if self._deleted_paths is None:
+            self._deleted_paths = {relative_path for relative_path, record in self.manifest_records.items()
+                                   if record.get('Deleted')}
+        return self._deleted_paths
+
+    def reload_manifest(self):
+        """Forget cached manifest records so they are read again on next use."""
+        self._manifest_records = self._deleted_paths = None
+
+    def _get_digest_of_file(self, relative_path: str) -> str:
+        """Get the digest of a file stored in this version,
+        hashing it only when the manifest does not know it."""
+        record = self.manifest_records.get(relative_path)
+        if record and record['Digest']:
+            return record['Digest']
+        return self._hash_file(relative_path)
 
     def _get_previous_version_of_file(self, relative_path: str, from_version=None, until_version=None):
         """Get the last version of a file."""
@@ -166,8 +606,7 @@ class VersionAgent:
         while version_candidate:
             if from_version and version_candidate > from_version:
                 continue
-            full_path_in_that_version = version_candidate._get_full_path_of_file(relative_path)
-            if os.path.exists(full_path_in_that_version):
+            if version_candidate.has_file(relative_path):
                 return version_candidate
             version_candidate = version_candidate.previous_version
             if until_version and version_candidate < until_version:
@@ -202,8 +641,7 @@ class VersionAgent:
         while version_candidate:
             if from_version and version_candidate < from_version:
                 continue
-            full_path_in_that_version = version_candidate._get_full_path_of_file(relative_path)
-            if os.path.exists(full_path_in_that_version):
+            if version_candidate.has_file(relative_path):
                 return version_candidate
             if until_version and version_candidate > until_version:
                 break
@@ -229,21 +667,27 @@ class VersionAgent:
                 return self.archive_agent.versions[i + 1]
         return None
 
-    def migrate_to_next_version(self):
-        """Migrate this version to its next version."""
+    def migrate_to_next_version(self, progress=None):
+        """Migrate this version to its next version.
+        :type progress: ProgressReporter"""
         next_version = self.next_version
-        ABUNDANT_LOGGER.debug('Migrating version %s to %s...' % (self.uuid, next_version.uuid))
-
-        # copy all files from current version to another version
-        # unless they already exists
-        number_of_file_copied = 0
-        for relative_path, absolute_path in self.exact_files:
-            if not next_version.has_file(relative_path):
-                absolute_path_in_another_version = next_version._get_full_path_of_file(relative_path)
-                shutil.move(absolute_path, absolute_path_in_another_version)
-                number_of_file_copied += 1
-                ABUNDANT_LOGGER.debug('Copied %s' % absolute_path_in_another_version)
-        ABUNDANT_LOGGER.info('Copied %s file(s)' % number_of_file_copied)
+        ABUNDANT_LOGGER.debug('Migrating version %s to %s...', self.uuid, next_version.uuid)
+
+        # the filter loaded before moving still answers for the paths of this version,
+        # but the saved one goes until it is built again
+        if next_version.path_filter is not None:
+            next_version.path_filter_agent.remove()
+        next_version.merkle_tree_agent.update(Stored=None)
+        if is_memory_bounded():
+            moved_space = self._move_files_in_path_order(next_version, progress)
+        else:
+            moved_space = self._move_files(next_version, progress)
+        with self.archive_agent.metrics.phase('Manifest'):
+            next_version.reload_manifest()
+            next_version.build_path_filter()
+            # the view of the next version stays the same
+            next_version.build_merkle_tree(view=False)
+            next_version._update_space(**moved_space)
 
         # set base version
         if self.is_base_version:
@@ -254,50 +698,322 @@ class VersionAgent:
 
         # refresh status
         next_version.load_config()
-        ABUNDANT_LOGGER.info('Migrated %s to %s' % (self.uuid, next_version.uuid))
+        ABUNDANT_LOGGER.info('Migrated %s to %s', self.uuid, next_version.uuid)
 
-    def copy_files(self):
-        """Copy files from source directory to version directory."""
+    def _move_files(self, next_version: 'VersionAgent', progress=None) -> dict:
+        """Move the files of this version into the next one unless they are stored or deleted there,
+        dropping the deleted ones, and merge their records into its manifest.
+        Returns the space the moved files add to the next version.
+        :type progress: ProgressReporter"""
+        # copy all files from current version to another version
+        # unless they already exists or were deleted there
+        metrics = self.archive_agent.metrics
+        number_of_file_copied = 0
+        moved_records = {}
+        dropped_digests = []
+        next_deleted_paths = next_version.deleted_paths
+        # moved files are stored in the next version alone, and free again once a later version overrides them
+        following_version = next_version.next_version
+        moved_space = dict.fromkeys(['UniqueFiles', 'UniqueBytes', 'ReclaimableFiles', 'ReclaimableBytes'], 0)
+        file_events = FileEventLog()
+        with metrics.phase('Migrate'):
+            for relative_path, absolute_path in self.exact_files:
+                metrics.count(FilesScanned=1)
+                if progress is not None:
+                    record = self.manifest_records.get(relative_path)
+                    progress.advance(1, record['Size'] if record else 0)
+                if relative_path in next_deleted_paths:
+                    self.storage.delete(self._get_key_of_file(relative_path))
+                    if relative_path in self.manifest_records:
+                        dropped_digests.append(self.manifest_records[relative_path]['Digest'])
+                    metrics.count(FilesDeleted=1)
+                    file_events.debug('Dropped deleted file %s', relative_path)
+                elif not next_version.has_file(relative_path):
+                    absolute_path_in_another_version = next_version._get_full_path_of_file(relative_path)
+                    size = self._get_size_of_stored_file(relative_path)
+                    moved_space['UniqueFiles'] += 1
+                    moved_space['UniqueBytes'] += size
+                    if following_version is None or following_version._overrides_file(relative_path):
+                        moved_space['ReclaimableFiles'] += 1
+                        moved_space['ReclaimableBytes'] += size
+                    self.storage.move(self._get_key_of_file(relative_path),
+                                      next_version._get_key_of_file(relative_path))
+                    if relative_path in self.manifest_records:
+                        moved_records[relative_path] = self.manifest_records[relative_path]
+                    number_of_file_copied += 1
+                    metrics.count(FilesCopied=1)
+                    file_events.debug('Copied %s', absolute_path_in_another_version)
+                else:
+                    metrics.count(FilesSkipped=1)
+        file_events.summarise()
+        if self.archive_agent.object_pool is not None:
+            self.archive_agent.object_pool.release(self.hasher.algorithm, dropped_digests)
+        with metrics.phase('Manifest'):
+            next_records = next_version.manifest.load()
+            next_records.update(moved_records)
+            if self.is_base_version:
+                # nothing precedes a base version, so deletion records mean nothing there
+                next_records = {relative_path: record for relative_path, record in next_records.items()
+                                if not record.get('Deleted')}
+            next_version.manifest.save(next_records)
+        ABUNDANT_LOGGER.info('Copied %s file(s)', number_of_file_copied)
+        return moved_space
+
+    def _move_files_in_path_order(self, next_version: 'VersionAgent', progress=None) -> dict:
+        """Move files as _move_files does in bounded memory: the files of this version are merge-joined in
+        path order with the entries of the next and following versions, moved records are merged into
+        the manifest of the next version.
+        :type progress: ProgressReporter"""
+        metrics = self.archive_agent.metrics
+        number_of_file_copied = 0
+        following_version = next_version.next_version
+        moved_space = dict.fromkeys(['UniqueFiles', 'UniqueBytes', 'ReclaimableFiles', 'ReclaimableBytes'], 0)
+        file_events = FileEventLog()
+
+        # the stored paths, the entries of the next and following versions, the moved records
+        # and the dropped digests each get a fifth of the ceiling
+        stored_paths = self._create_sorter(5)
+        stored_paths.extend([self._get_relative_path_of_key(key)] for key in self.storage.list(self.uuid + '/'))
+        next_entries = next_version._iterate_sorted_entries(1, 5)
+        # moved files are stored in the next version alone, and free again once a later version overrides them
+        following_entries = following_version._iterate_sorted_entries(2, 5) if following_version else ()
+        moved_records = self._create_sorter(5, key=lambda record: record['Path'])
+        dropped_digests = self._create_sorter(5)
+        records = ManifestCursor(self.manifest)
+        stored_entries = ((relative_path, next_entry) for relative_path, stored_entry, next_entry
+                          in merge_join(stored_paths, next_entries, key=lambda entry: entry[0])
+                          if stored_entry is not None)
+        with metrics.phase('Migrate'):
+            for relative_path, stored_entry, following_entry in merge_join(stored_entries, following_entries,
+                                                                           key=lambda entry: entry[0]):
+                if stored_entry is None:
+                    continue
+                metrics.count(FilesScanned=1)
+                record = records.get(relative_path)
+                if progress is not None:
+                    progress.advance(1, record['Size'] if record else 0)
+                next_entry = stored_entry[1]
+                if next_entry is not None and next_entry[2]:
+                    self.storage.delete(self._get_key_of_file(relative_path))
+                    if record is not None:
+                        dropped_digests.add([record['Digest']])
+                    metrics.count(FilesDeleted=1)
+                    file_events.debug('Dropped deleted file %s', relative_path)
+                elif next_entry is None:
+                    size = record['Size'] if record is not None and not record.get('Deleted') \
+                        else self.storage.size(self._get_key_of_file(relative_path))
+                    moved_space['UniqueFiles'] += 1
+                    moved_space['UniqueBytes'] += size
+                    if following_version is None or following_entry is not None:
+                        moved_space['ReclaimableFiles'] += 1
+                        moved_space['ReclaimableBytes'] += size
+                    self.storage.move(self._get_key_of_file(relative_path),
+                                      next_version._get_key_of_file(relative_path))
+                    if record is not None:
+                        moved_records.add(record)
+                    number_of_file_copied += 1
+                    metrics.count(FilesCopied=1)
+                    file_events.debug('Copied %s', next_version._get_full_path_of_file(relative_path))
+                else:
+                    metrics.count(FilesSkipped=1)
+        file_events.summarise()
+        object_pool = self.archive_agent.object_pool
+        if object_pool is not None:
+            object_pool.release(self.hasher.algorithm, (digest for digest, in dropped_digests))
+        with metrics.phase('Manifest'):
+            # nothing precedes a base version, so deletion records mean nothing there
+            next_version.manifest.merge(moved_records, drop_deleted=self.is_base_version)
+        ABUNDANT_LOGGER.info('Copied %s file(s)', number_of_file_copied)
+        return moved_space
+
+    def _start_copy_progress(self, progress):
+        """Start reporting a copy with the total size of the source directory.
+        :type progress: ProgressReporter"""
+        total_files = total_bytes = 0
+        for root_dir, dirs, files in os.walk(self.archive_agent.source_dir):
+            for file in files:
+                try:
+                    total_bytes += os.path.getsize(os.path.join(root_dir, file))
+                except OSError:
+                    continue
+                total_files += 1
+        progress.start('create_base' if self.is_base_version else 'create_version', total_files, total_bytes)
+
+    def _copy_file(self, relative_path: str, source_absolute_path: str, get_previous_digest, progress,
+                   file_events: FileEventLog) -> dict:
+        """Copy a source file unless the previous version holds the same content.
+        The digest of the previous copy, None if there is none, is only asked for when needed.
+        Returns the manifest record of the copy, None if the file was skipped.
+        :type progress: ProgressReporter"""
+        metrics = self.archive_agent.metrics
+        metrics.count(FilesScanned=1)
+        object_pool = self.archive_agent.object_pool
+        hashed_stat = os.stat(source_absolute_path) if object_pool is not None else None
+
+        # under following circumstances file will be treated
+        # as already existing in previous versions and will
+        # not be copied
+        # if this is not a base version
+        # and if there is a previous version for this file
+        # and if that previous version is identical to current one
+        with metrics.phase('Hash'):
+            source_digest = self.hasher.hash(source_absolute_path)
+        if not self.is_base_version and get_previous_digest() == source_digest:
+            metrics.count(FilesSkipped=1)
+            if progress is not None:
+                progress.advance(1, os.path.getsize(source_absolute_path))
+            file_events.debug('Skipping %s', source_absolute_path)
+            return None
+
+        # otherwise link the shared object of the same content or just copy the file
+        key = self._get_key_of_file(relative_path)
+        if object_pool is not None and object_pool.link(self.hasher.algorithm, source_digest, hashed_stat.st_size,
+                                                        hashed_stat.st_mode, self.storage.locate(key)):
+            metrics.count(FilesLinked=1)
+            if progress is not None:
+                progress.advance(1, hashed_stat.st_size)
+            file_events.debug('Linked file %s', relative_path)
+            return create_manifest_record(relative_path, hashed_stat.st_size, source_digest,
+                                          hashed_stat.st_mtime_ns)
+        with metrics.phase('Copy'):
+            self.storage.put(key, source_absolute_path, self.archive_agent.throttle)
+        source_stat = os.stat(source_absolute_path)
+        # only a copy of what was hashed may become the shared object of its digest
+        if object_pool is not None:
+            copied_state = source_stat.st_size, source_stat.st_mtime_ns
+            hashed_state = hashed_stat.st_size, hashed_stat.st_mtime_ns
+            if copied_state == hashed_state:
+                object_pool.add(self.hasher.algorithm, source_digest, self.storage.locate(key))
+        metrics.count(FilesCopied=1, BytesRead=source_stat.st_size, BytesWritten=source_stat.st_size)
+        if progress is not None:
+            progress.advance(1, source_stat.st_size)
+        file_events.debug('Copied file %s', relative_path)
+        return create_manifest_record(relative_path, source_stat.st_size, source_digest, source_stat.st_mtime_ns)
+
+    def copy_files(self, progress=None, cancellation=None):
+        """Copy files from source directory to version directory.
+        With a memory ceiling the source and the previous version are compared in path order instead.
+        Cancellation stops between two files, before the manifest is written.
+        :type progress: ProgressReporter
+        :type cancellation: CancellationToken"""
         ABUNDANT_LOGGER.debug('Copying files...')
+        if progress is not None:
+            self._start_copy_progress(progress)
+        if is_memory_bounded():
+            return self._copy_files_in_path_order(progress, cancellation)
 
         # copy new or modified files
         source_dir = self.archive_agent.source_dir
+        metrics = self.archive_agent.metrics
         number_of_file_copied = 0
+        records = {}
+        source_paths = set()
+        file_events = FileEventLog()
+        space_counter = self._start_space_count()
         for root_dir, dirs, files in os.walk(source_dir):
-            for dir in dirs:
-                absolute_dir = os.path.join(root_dir, dir)
-                relative_dir = get_relative_path(absolute_dir, source_dir)
-                os.makedirs(self._get_full_path_of_file(relative_dir), exist_ok=True)
+            self._keep_directories(root_dir, dirs)
             for file in files:
+                check_cancellation(cancellation)
                 source_absolute_path = os.path.join(root_dir, file)
                 relative_path = get_relative_path(source_absolute_path, source_dir)
+                source_paths.add(relative_path)
 
                 # find the previous version of this file
-                previous_version = self._get_previous_version_of_file(relative_path)
-
-                # under following circumstances file will be treated
-                # as already existing in previous versions and will
-                # not be copied
-                # if this is not a base version
-                # and if there is a previous version for this file
-                # and if that previous version is identical to current one
-                if not self.is_base_version \
-                        and previous_version is not None \
-                        and self.hasher.hash(previous_version._get_full_path_of_file(relative_path)) \
-                                == self.hasher.hash(source_absolute_path):
-                    ABUNDANT_LOGGER.debug('Skipping %s' % source_absolute_path)
-                    continue
-
-                # otherwise just copy the file
-                shutil.copy(source_absolute_path, self._get_full_path_of_file(relative_path))
+                previous_version = self.previous_version._get_effective_version_of_file(relative_path) \
+                    if self.previous_version else None
+                record = self._copy_file(
+                    relative_path, source_absolute_path,
+                    lambda: previous_version._get_digest_of_file(relative_path) if previous_version else None,
+                    progress, file_events)
+                if record is not None:
+                    records[relative_path] = record
+                    number_of_file_copied += 1
+                    if previous_version:
+                        holder, size, _ = self._get_record_of_view_entry(
+                            relative_path, previous_version, previous_version.manifest_records.get(relative_path))
+                        space_counter.replace(holder.uuid, size)
+                    space_counter.store(record['Size'])
+        file_events.summarise()
+
+        # remember files deleted from the source since the previous version
+        number_of_file_deleted = 0
+        if self.previous_version:
+            with metrics.phase('DeletionScan'):
+                for relative_path, absolute_path in self.previous_version.files:
+                    if relative_path not in source_paths:
+                        records[relative_path] = create_deletion_record(relative_path)
+                        number_of_file_deleted += 1
+                        holder, size, _ = self.previous_version._get_effective_record_of_file(relative_path)
+                        space_counter.replace(holder.uuid, size)
+            metrics.count(FilesDeleted=number_of_file_deleted)
+            ABUNDANT_LOGGER.debug('Found %s deleted file(s)', number_of_file_deleted)
+        with metrics.phase('Manifest'):
+            self.manifest.update(records)
+            self.reload_manifest()
+            self._finish_space_count(space_counter)
+        if progress is not None:
+            progress.finish()
+        ABUNDANT_LOGGER.info('Copied %s file(s)', number_of_file_copied)
+
+    def _copy_files_in_path_order(self, progress=None, cancellation=None):
+        """Copy files in bounded memory: source paths are sorted on disk and merge-joined with
+        the sorted view of the previous version, new records are merged into the manifest.
+        :type progress: ProgressReporter
+        :type cancellation: CancellationToken"""
+        source_dir = self.archive_agent.source_dir
+        metrics = self.archive_agent.metrics
+        number_of_file_copied = number_of_file_deleted = 0
+        file_events = FileEventLog()
+        space_counter = self._start_space_count()
+
+        # the source paths, the previous view and the new records each get a third of the ceiling
+        with metrics.phase('Scan'):
+            source_paths = self._create_sorter(3)
+            for root_dir, dirs, files in os.walk(source_dir):
+                self._keep_directories(root_dir, dirs)
+                for file in files:
+                    check_cancellation(cancellation)
+                    source_paths.add([get_relative_path(os.path.join(root_dir, file), source_dir)])
+        previous_files = self.previous_version._iterate_view_records(3) if self.previous_version else ()
+        records = self._create_sorter(3, key=lambda record: record['Path'])
+
+        for relative_path, source_entry, previous_entry in merge_join(source_paths, previous_files,
+                                                                      key=lambda entry: entry[0]):
+            check_cancellation(cancellation)
+            if source_entry is None:
+                # remember files deleted from the source since the previous version
+                records.add(create_deletion_record(relative_path))
+                number_of_file_deleted += 1
+                holder, size, _ = self._get_record_of_view_entry(*previous_entry)
+                space_counter.replace(holder.uuid, size)
+                continue
+            record = self._copy_file(relative_path, os.path.join(source_dir, relative_path),
+                                     lambda: self._get_digest_of_view_entry(*previous_entry) if previous_entry
+                                     else None, progress, file_events)
+            if record is not None:
+                records.add(record)
                 number_of_file_copied += 1
-                ABUNDANT_LOGGER.debug('Copied file %s' % relative_path)
-        ABUNDANT_LOGGER.info('Copied %s file(s)' % number_of_file_copied)
+                if previous_entry:
+                    holder, size, _ = self._get_record_of_view_entry(*previous_entry)
+                    space_counter.replace(holder.uuid, size)
+                space_counter.store(record['Size'])
+        file_events.summarise()
+        metrics.count(FilesDeleted=number_of_file_deleted)
+        ABUNDANT_LOGGER.debug('Found %s deleted file(s)', number_of_file_deleted)
+
+        with metrics.phase('Manifest'):
+            self.manifest.merge(records)
+            self.reload_manifest()
+            self._finish_space_count(space_counter)
+        if progress is not None:
+            progress.finish()
+        ABUNDANT_LOGGER.info('Copied %s file(s)', number_of_file_copied)
 
     def remove(self, base_version_pardon=False):
-        """Remove this version."""
+        """Remove this version, then the shared objects only it referred to."""
         if not base_version_pardon and self.is_base_version:
             raise PermissionError('Base version cannot be removed')
+        previous_version, next_version = self.previous_version, self.next_version
 
         # delete version record
         with get_config(self.version_config_path, save_change=True) as version_config:
@@ -306,33 +1022,56 @@ class VersionAgent:
             version_config['VersionRecords'].remove(current_version_record)
 
         # delete directory
-        shutil.rmtree(self.version_dir)
+        object_pool = self.archive_agent.object_pool
+        self.storage.delete_prefix(self.uuid + '/')
+        if object_pool is not None:
+            object_pool.release(self.hasher.algorithm, (record['Digest'] for record in self.manifest.records))
+        self.manifest.remove()
+        self.path_filter_agent.remove()
+        self.merkle_tree_agent.remove()
+
+        # the previous version is the latest again, or follows another version to be measured against
+        if previous_version:
+            if next_version is None:
+                previous_version._update_space(reclaim_all=True)
+            else:
+                previous_version._save_space(None)
 
         # update version records
         self.archive_agent.load_versions()
 
-        ABUNDANT_LOGGER.info('Removed version %s' % self.uuid)
-
-    def export(self, destination_dir: str, exact=False):
-        """Export files in this version to destination directory."""
-        ABUNDANT_LOGGER.debug('Exporting version %s to %s' % (self.uuid, destination_dir))
+        ABUNDANT_LOGGER.info('Removed version %s', self.uuid)
+
+    def export(self, destination_dir: str, exact=False, archive_format=None, max_workers=None, progress=None,
+               cancellation=None) -> dict:
+        """Export files in this version to destination directory.
+        With an archive format such as tar.gz or zip, the files are instead streamed into
+        an archive written to destination, which may be '-' for standard output.
+        Returns the throughput report of a directory export.
+        :type progress: ProgressReporter
+        :type cancellation: CancellationToken"""
+        if archive_format is not None:
+            stream_export(self, destination_dir, archive_format, exact, progress, cancellation)
+            return None
 
-        if not os.path.exists(destination_dir):
-            ABUNDANT_LOGGER.error('Cannot find destination directory: %s' % destination_dir)
-            raise FileNotFoundError('Cannot find destination directory: %s' % destination_dir)
+        with self.archive_agent.record_run('export', self.uuid):
+            report = ExportEngine(self, destination_dir, exact, max_workers, progress, cancellation).run()
+            ABUNDANT_LOGGER.info('Exported version %s to %s', self.uuid, destination_dir)
+            return report
 
-        file_source = self.files if not exact else self.exact_files
-        for relative_path, absolute_path in file_source:
-            destination_path = os.path.join(destination_dir, relative_path)
-            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
-            shutil.copy(absolute_path, destination_path)
-            ABUNDANT_LOGGER.debug('Copied %s' % destination_path)
-        ABUNDANT_LOGGER.info('Exported version %s to %s' % (self.uuid, destination_dir))
+    def sync(self, destination_dir: str, delete_extra=False, max_workers=None) -> dict:
+        """Restore this version into an existing directory, copying only files that differ
+        and optionally deleting files the version does not have."""
+        with self.archive_agent.record_run('sync', self.uuid):
+            return SyncEngine(self, destination_dir, delete_extra, max_workers).run()
 
 
-def create_version(is_base_version: bool, archive_agent) -> VersionAgent:
+def create_version(is_base_version: bool, archive_agent, progress=None, cancellation=None) -> VersionAgent:
     """Create a version.
-    :type archive_agent: ArchiveAgent"""
+    If the copy is cancelled the partial version is removed again.
+    :type archive_agent: ArchiveAgent
+    :type progress: ProgressReporter
+    :type cancellation: CancellationToken"""
     # generate version uuid
     version_uuid = str(uuid.uuid4())
     while archive_agent.get_version(version_uuid):
@@ -345,27 +1084,35 @@ def create_version(is_base_version: bool, archive_agent) -> VersionAgent:
         'IsBaseVersion': is_base_version,
         'UUID': version_uuid
     })
-    ABUNDANT_LOGGER.debug('Creating %s version: %s' % ('base' if is_base_version else 'non-base', version_uuid))
+    ABUNDANT_LOGGER.debug('Creating %s version: %s', 'base' if is_base_version else 'non-base', version_uuid)
 
     # create version config if no version is present
     version_config_path = os.path.join(archive_agent.archive_dir, 'meta', 'version_config.json')
     if not os.path.exists(version_config_path):
         create_config(VERSION_CONFIG_TEMPLATE, version_config_path)
-        ABUNDANT_LOGGER.debug('Created version config: %s' % archive_agent.uuid)
+        ABUNDANT_LOGGER.debug('Created version config: %s', archive_agent.uuid)
 
     # add version record
     with get_config(version_config_path, save_change=True) as version_config:
         version_config['VersionRecords'].append(version_record)
     archive_agent.load_versions()
-    ABUNDANT_LOGGER.info('Added version record: %s' % version_uuid)
+    ABUNDANT_LOGGER.info('Added version record: %s', version_uuid)
 
     # create version directory and copy files
     version = archive_agent.get_version(version_uuid)
-    if not os.path.exists(version.version_dir):
-        os.mkdir(version.version_dir)
-    version.copy_files()
-
-    ABUNDANT_LOGGER.info('Created %s version %s' % ('base' if is_base_version else 'non-base', version_uuid))
+    archive_agent.metrics.set_version(version_uuid)
+    archive_agent.storage.create_prefix(version_uuid + '/')
+    try:
+        with archive_agent.metrics.phase('CopyFiles'):
+            version.copy_files(progress, cancellation)
+        version.build_path_filter()
+        version.build_merkle_tree()
+    except OperationCancelled:
+        ABUNDANT_LOGGER.warning('Cancelled creating version %s, removing it', version_uuid)
+        version.remove(base_version_pardon=True)
+        raise
+
+    ABUNDANT_LOGGER.info('Created %s version %s', 'base' if is_base_version else 'non-base', version_uuid)
     return version
 
 
@@ -377,5 +1124,5 @@ def get_versions(archive_agent) -> list:
         return list()
 
     with get_config(version_config_path) as version_config:
-        return [VersionAgent(version_record['UUID'], archive_agent) for version_record in
+        return [VersionAgent(version_record['UUID'], archive_agent, version_record) for version_record in
                 version_config['VersionRecords']]